@@ -0,0 +1,214 @@
+import os
+import shutil
+import argparse
+import H4Dtools_functions as tools
+import H4Dtools_scheduler as scheduler
+import H4Dtools_store as store
+import H4Dtools_jobs as jobs
+import H4Dtools_telemetry as telemetry
+import H4Dtools_state as state
+import H4Dtools_sweep as sweep
+import H4Dtools_pilot as pilot
+
+"""
+
+Tuning of ins/des speed v, time step dt and maximum altitude wmax per solute with short pilot runs
+
+    Input files :
+
+        database file (.csv) with 3 columns : solute_name \t solute's PMV \t refence HFE
+        solutein direcrory : containing structure files solute_name.in and (optinal) force field files solute_name.top
+        input-files directory : containing files for launching H4D-MC
+        classes file (optional) : solute_name \t class, pilots are run for the first solute of each class
+
+    Input parameters :
+
+        -s, --solutes : database file name
+        -c, --classes : classes file
+        -v, -dt, -wmax : values of the pilot grid
+        -eq, --equil : nb of equilibration cycles for des of the pilots
+        -nacc : nb of accumulations of the pilot ins/des runs
+        -f, -b, -w, -N, -T, -P, -C, -E, -m, -E2, -Hrange, -dH : as in 1-initilisation.py
+        -flex, -nii, -nid, -nvac, -ds, -pws, -dw, -rw, -fb, -Vxp, -lnV : as in 2-production.py
+        -j : job handeling system (slurm, loadleveler or local)
+        -np, --ncores : nb of jobs run at the same time with -j local
+        -stg, --staging : files copied to the compute node : only those of the run (minimal) or the whole solute directory (full)
+        -dp, --deploy, --store : deployment of shared input files as in 1-initilisation.py
+        -o, --output : pilot table
+        -ns, --nostart : do not launch jobs
+        --trace : json lines file of timed phases (csv, setup, copy, input, submit, wait, state ...)
+        --profile : cProfile and tracemalloc of the run (profile-{script}.prof)
+
+    Each call goes as far as possible : initialisation of the pilots, then their ins/des runs, then
+    the table ; with -j local all at once, with slurm / loadleveler call again when the jobs are done.
+
+    Output :
+
+        pilot/{configuration}/{solute_name} : pilot runs of each (v, dt, wmax) configuration
+        pilot-params.tsv : best v, dt, wmax per solute with the error, CPU time and cost (err**2 x CPU time)
+                           of the pilot, read by 1-initilisation.py -pt
+"""
+
+# Parse input params #
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s','--solutes', default='FreeSolv-nm-V0-mu0.csv', help="File containing solute's name, volume and referce HFE (default: %(default)s)" )
+parser.add_argument('-c','--classes', help="File containing solute's name and class (default: %(default)s)" )
+parser.add_argument('-v', type=float, nargs='+', default=[0.025,0.05,0.1], help="ins/des speeds of the pilots (default: %(default)s sqrt(kT/M))" )
+parser.add_argument('-dt', type=float, nargs='+', default=[0.01,0.02,0.04], help="time steps of the pilots (default: %(default)s sqrt(M/kT)Å)" )
+parser.add_argument('-wmax', type=float, nargs='+', default=[3], help="maximum altitudes of the pilots (default: %(default)s Å)" )
+parser.add_argument('-eq','--equil', type=int, default=1000, help="nb of MC equilibartion cycles for destruction (default: %(default)s)" )
+parser.add_argument('-nacc', type=int, default=100, help="nb of accumulations of pilot runs (default: %(default)s)" )
+parser.add_argument('-f','--infile', default='100tip3p',help="refernce input files (default: %(default)s)" )
+parser.add_argument('-b','--create_box', action='store_true', help="create simulation box (default: %(default)s)" )
+parser.add_argument('-w','--water', default='TIP3P', help="water force field (default: %(default)s)" )
+parser.add_argument('-N', type=int, default=100, help="number of solvent molecules (default: %(default)s)" )
+parser.add_argument('-T', type=float, default=298.15, help="temperature (default: %(default)s K)" )
+parser.add_argument('-P', type=int, default=100000, help="pressure (default: %(default)s Pa)" )
+parser.add_argument('-C', type=float, default=55.4, help="concentration (default: %(default)s M)" )
+parser.add_argument('-E','--Ewald', type=int, nargs=3, default=[8,4,4], help="Ewald params KL sr sk (default: %(default)s)" )
+parser.add_argument('-m','--mass', type=int, default=10e20, help="solute site mass during ins/des (default: %(default)s)" )
+parser.add_argument('-E2','--Ewald2', type=int, nargs=3, default=[8,3,3], help="Ewald params KL sr sk during ins/des (default: %(default)s)" )
+parser.add_argument('-Hrange', type=int, default=2000, help="accumulation range (default: %(default)s)" )
+parser.add_argument('-dH', type=float, default=0.5, help="accumulation bin size (default: %(default)s kT)" )
+parser.add_argument('-flex', action='store_true', help="solute flexibility (default: %(default)s)" )
+parser.add_argument('-nii','--nint_ins', type=int, help="insertion interval  (default rigid/flex : 100/100)" )
+parser.add_argument('-nid','--nint_des', type=int, help="destruction interval  (default rigid/flex: 100/10000)" )
+parser.add_argument('-nvac','--ngen_vac', type=int, help="nb of cycles for conformer generation in vacuum  (default rigid/flex 100/10000)" )
+parser.add_argument('-ds', type=int, help="maximum displacement of solute sites (default rigid/flex : 0/0.1 Å)" )
+parser.add_argument('-pws','--prob_wat_sol', type=int, nargs=2, help="relative probablities to move a solute or a solute site (default rigid/flex: 1 1 / 1 5)" )
+parser.add_argument('-dw', type=float, default=0.3, help="maximum trastation of a solvent molecule (default: %(default)s Å)" )
+parser.add_argument('-rw', type=int, default=30, help="maximum rotation of a solvent molecule (default: %(default)s deg)" )
+parser.add_argument('-fb','--force_bias', type=float, nargs=2, default=[0.5,0.5], help="Force bias parameters (default rigid/flex: 1 1 / 1 5)" )
+parser.add_argument('-Vxp','--vol_ex_prob', type=float, default=0.2, help=" Volume exchange probability (default: %(default)s)" )
+parser.add_argument('-lnV', type=float, default=0.05, help="maximum ln(volume) exchange (default: %(default)s)" )
+parser.add_argument('-j', default="slurm", choices=list(scheduler.SCHEDULERS), help=" Job handeling system : slurm, loadleveler or local (default: %(default)s)" )
+parser.add_argument('-np','--ncores', type=int, help="nb of jobs run at the same time on this machine with -j local (default: nb of cores)" )
+parser.add_argument('-stg','--staging', default='minimal', choices=jobs.STAGING, help="files copied to the compute node : those read by the run, or the whole solute directory (default: %(default)s)" )
+parser.add_argument('-dp','--deploy', default='auto', choices=store.STRATEGIES, help="deployment of shared input files : auto (reflink, hardlink or copy), reflink, hardlink, symlink or copy (default: %(default)s)" )
+parser.add_argument('--store', default='.h4d-store', help="shared store of input files (default: %(default)s)" )
+parser.add_argument('-o','--output', default=pilot.TABLE, help="pilot table (default: %(default)s)" )
+parser.add_argument('-ns','--nostart', action='store_true', help="do not launch jobs (default: %(default)s)" )
+parser.add_argument('--trace', help="append timed phases of the run to TRACE as json lines (default: %(default)s)" )
+parser.add_argument('--profile', action='store_true', help="profile the Python side with cProfile and tracemalloc (default: %(default)s)" )
+args = parser.parse_args()
+tools.instrument(args,__file__)
+sched = scheduler.get_scheduler(args.j,ncores=args.ncores)
+
+# default parameters for single conformer / flexible solute (as 2-production.py)
+if args.flex == False :
+    args.nint_ins = args.nint_ins if args.nint_ins else 100
+    args.nint_des = args.nint_des if args.nint_des else 100
+    args.ngen_vac = args.ngen_vac if args.ngen_vac else 0
+    args.ds = args.ds if args.ds else 0
+    args.prob_wat_sol = args.prob_wat_sol if args.prob_wat_sol else [1,1]
+if args.flex == True :
+    args.nint_ins = args.nint_ins if args.nint_ins else 100
+    args.nint_des = args.nint_des if args.nint_des else 1000
+    args.ngen_vac = args.ngen_vac if args.ngen_vac else 10000
+    args.ds = args.ds if args.ds else 0.1
+    args.prob_wat_sol = args.prob_wat_sol if args.prob_wat_sol else [1,5]
+print(args)
+
+# Load solutes with their volumes and reference HFEs, pilots for one solute per class
+data = tools.from_file_to_dict(args.solutes,'\t')
+dict_solutes = dict(zip(['V0','mu0'],data))
+classes = pilot.read_classes(args.classes,list(dict_solutes['V0'].keys()))
+solutes = list(pilot.representatives(classes).values())
+
+home_dir = "%s" % os.getcwd()
+input_dir = os.path.join(home_dir,'input-files')
+sol_dir = os.path.join(home_dir,'solutein')
+pilot_dir = os.path.join(home_dir,'pilot')
+store_dir = os.path.join(home_dir,args.store)
+
+# One pilot campaign per (v, dt, wmax)
+camps = sweep.campaigns(pilot.spec(args.v,args.dt,args.wmax),args,pilot_dir)
+sweep.setup(pilot_dir,camps,args.solutes,input_dir=input_dir)
+print('{} pilot configurations x {} solutes'.format(len(camps),len(solutes)))
+
+# CPU time of the pilots from telemetry
+wrapper = telemetry.wrapper_command()
+
+def submit(rows,stage):
+    ''' Submit runs (campaign directory, db, solute, stage, index) : one job array or one job per run '''
+    if len(rows) == 0 or args.nostart == True :
+        return
+    template = os.path.join(input_dir,'job-ini' if stage == 'ini' else 'job-ins')
+    if sched.supports_array :
+        job_file, ntasks = jobs.write_array(home_dir,template,[(os.path.relpath(os.path.join(d,mol),home_dir),s,i) for d,db,mol,s,i in rows],
+                                            'pilot-' + stage,wrapper=wrapper,staging=args.staging)
+        with tools.timer('submit') :
+            job_id = sched.submit(job_file,home_dir,array=(ntasks,0))
+        for task,(d,db,mol,s,i) in enumerate(rows,start=1):
+            state.record_job(db,mol,s,i,'{}_{}'.format(job_id,task))
+    else :
+        for d,db,mol,s,i in rows:
+            mol_dir = os.path.join(d,mol)
+            job_file = jobs.write_job_script(os.path.join(input_dir,'job-' + s),mol_dir,index=i if s != 'ini' else None,wrapper=wrapper,staging=args.staging)
+            with tools.timer('submit') :
+                state.record_job(db,mol,s,i,sched.submit(job_file,mol_dir))
+    with tools.timer('wait') :
+        sched.wait()
+
+def pilot_state():
+    ''' (campaign directory, db, arguments, solute, latest indices) of pilots not queued '''
+    out = []
+    for camp_dir, camp_args, config in camps:
+        db = state.connect(camp_dir)
+        state.update_jobs(db,sched)
+        with tools.timer('state') :
+            state.refresh(db,camp_dir,solutes)
+        for mol in solutes:
+            # jobs of previous calls are unknown to the local scheduler
+            if sched.name != 'local' and state.queued(db,mol) :
+                continue
+            out.append((camp_dir,db,camp_args,mol,state.indices(db,mol)))
+    return out
+
+# Initialisation of the pilots
+rows = []
+for camp_dir, db, camp_args, mol, index in pilot_state():
+    if index['ins'] >= 0 and index['des'] >= 0 :
+        continue
+    mol_dir = os.path.join(camp_dir,mol)
+    with tools.timer('setup') :
+        tools.mkdir_p(mol_dir)
+    shared = ['h4dmc.x','dummy.in','dummy.top'] + (['acc_' + camp_args.infile, 'r_' + camp_args.infile] if camp_args.create_box == False else [])
+    with tools.timer('copy',solute=mol) :
+        store.deploy_files({name: store.store_add(os.path.join(input_dir,name),store_dir) for name in shared},mol_dir,store_dir,strategy=args.deploy)
+        shutil.copy(os.path.join(sol_dir,mol + '.in'),mol_dir)
+        if os.path.isfile(os.path.join(sol_dir,mol+'.top')) == True:
+            shutil.copy(os.path.join(sol_dir,mol + '.top'),mol_dir)
+    tools.create_initialisation_input(camp_args,solute=mol,V0=dict_solutes['V0'][mol],mu0=dict_solutes['mu0'][mol],mol_dir=mol_dir)
+    telemetry.write_run_params(mol_dir,'ini',**telemetry.run_params(camp_args,mol_dir,mol,'ini',index=0))
+    rows.append((camp_dir,db,mol,'ini',0))
+submit(rows,'ini')
+
+# Pilot ins/des runs
+rows = []
+for camp_dir, db, camp_args, mol, index in pilot_state():
+    if index['ins'] != 0 or index['des'] != 0 :
+        continue
+    mol_dir = os.path.join(camp_dir,mol)
+    run_args = argparse.Namespace(**vars(camp_args))
+    run_args.i = 0
+    for stage, create_input in [('ins',tools.create_ins_input),('des',tools.create_des_input)]:
+        create_input(run_args,solute=mol,mol_dir=mol_dir)
+        telemetry.write_run_params(mol_dir,stage,**telemetry.run_params(run_args,mol_dir,mol,stage,index=1))
+        rows.append((camp_dir,db,mol,stage,1))
+submit(rows,'prod')
+
+# Best settings per solute
+finished = pilot_state()
+done = [mol for mol in solutes if all(index['ins'] >= 1 and index['des'] >= 1 for d,db,a,m,index in finished if m == mol)
+                                and sum(m == mol for d,db,a,m,index in finished) == len(camps)]
+results = pilot.results(camps,done)
+for row in sorted(results,key=lambda r: (r['solute'],r['cost'])):
+    print('{solute}\t v {v:g}\t dt {dt:g}\t wmax {wmax:g}\t err {err:.4f} kT\t cpu {cpu:.4g} s\t cost {cost:.4g} s'.format(**row))
+tuned = pilot.best(results)
+if len(tuned) > 0 :
+    n = pilot.write_table(args.output,tuned,classes)
+    print('Best settings of {} solutes ({} pilots) written in {}'.format(n,len(tuned),args.output))
+if len(done) < len(solutes) :
+    print('{} solutes with unfinished pilots : call again when their jobs are done'.format(len(solutes) - len(done)))
@@ -5,6 +5,13 @@ import argparse
 import random
 import json 
 import H4Dtools_functions as tools
+import H4Dtools_scheduler as scheduler
+import H4Dtools_store as store
+import H4Dtools_jobs as jobs
+import H4Dtools_pack as pack
+import H4Dtools_telemetry as telemetry
+import H4Dtools_state as state
+import H4Dtools_sweep as sweep
 
 """
 
@@ -37,7 +44,21 @@ Creates initilised and equilibrated starting ins and des files for accumulating
         -Hrange : accumlation range
         -dH : accumulation bin size
         -eq, --equil : nb of equilibration cycles for des
-        -j : job handeler
+        -j : job handeler (slurm, loadleveler or local)
+        -np, --ncores : nb of jobs run at the same time with -j local
+        -stg, --staging : files copied to the compute node : only those of the run (minimal) or the whole solute directory (full)
+        -a, --array : submit all solutes as one job array (manifest array-ini.tsv + job-array-ini)
+        -at, --array_throttle : maximum nb of array tasks running at the same time
+        -pk, --pack : pack runs into jobs of PACK cores (longest-processing-time-first on estimated costs)
+        -npk, --pack_jobs : nb of packed jobs (default: enough jobs to fill the cores)
+        -tm, --telemetry : record wall/CPU time, memory and I/O of each h4dmc.x run (metrics-ini-0.json)
+        -dp, --deploy : how shared input files are put in solute directories (auto, reflink, hardlink, symlink, copy)
+        --store : directory of the shared store of input files
+        -pt, --pilot_table : v, dt and wmax per solute from the pilot runs (0-pilot.py), instead of -v, -dt, -wmax
+        -sw, --sweep : sweep spec (json, see H4Dtools_sweep.py) : one campaign per configuration in its own
+                       sub-directory, all of them submitted at once (job array, or packed jobs with -pk)
+        --trace : json lines file of timed phases (csv, setup, copy, input, submit, wait, state ...)
+        --profile : cProfile and tracemalloc of the run (profile-{script}.prof)
 
     Output :
 
@@ -45,6 +66,8 @@ Creates initilised and equilibrated starting ins and des files for accumulating
             input-ini
             acc_{solute_name}_ins0, r_{solute_name}_ins0, acc_{solute_name}_des0, r_{solute_name}_des0
         params_ini.out file : recapitulation of initiliasation params in json form
+        campaign-state.db : state of solutes and submitted runs (python H4Dtools_state.py status)
+        with --sweep : the above in each configuration directory {configuration}, sweep.json
 """
 
 # Parse input params #
@@ -68,10 +91,34 @@ parser.add_argument('-E2','--Ewald2', type=int, nargs=3, default=[8,3,3], help="
 parser.add_argument('-Hrange', type=int, default=2000, help="accumulation range (default: %(default)s)" )
 parser.add_argument('-dH', type=float, default=0.5, help="accumulation bin size (default: %(default)s kT)" )
 parser.add_argument('-eq','--equil', type=int, default=10000, help="nb of MC equilibartion cycles for destruction (default: %(default)s kT)" )
-parser.add_argument('-j', default="slurm", help=" Job handeling system : slumr or loadleveler  (default: %(default)s)" )
+parser.add_argument('-j', default="slurm", choices=list(scheduler.SCHEDULERS), help=" Job handeling system : slurm, loadleveler or local (default: %(default)s)" )
+parser.add_argument('-np','--ncores', type=int, help="nb of jobs run at the same time on this machine with -j local (default: nb of cores)" )
+parser.add_argument('-stg','--staging', default='minimal', choices=jobs.STAGING, help="files copied to the compute node : those read by the run, or the whole solute directory (default: %(default)s)" )
+parser.add_argument('-a','--array', action='store_true', help="submit a single job array (default: %(default)s)" )
+parser.add_argument('-at','--array_throttle', type=int, default=0, help="maximum nb of running array tasks, 0 for no limit (default: %(default)s)" )
+parser.add_argument('-pk','--pack', type=int, default=0, help="pack runs into jobs of PACK cores, 0 for one job per run (default: %(default)s)" )
+parser.add_argument('-npk','--pack_jobs', type=int, help="nb of packed jobs (default: enough jobs to fill the cores)" )
+parser.add_argument('-tm','--telemetry', action='store_true', help="record resource usage of h4dmc.x runs (default: %(default)s)" )
+parser.add_argument('-dp','--deploy', default='auto', choices=store.STRATEGIES, help="deployment of shared input files : auto (reflink, hardlink or copy), reflink, hardlink, symlink or copy (default: %(default)s)" )
+parser.add_argument('--store', default='.h4d-store', help="shared store of input files (default: %(default)s)" )
+parser.add_argument('-pt','--pilot_table', help="table of tuned v, dt, wmax per solute (default: %(default)s)" )
+parser.add_argument('-sw','--sweep', help="sweep spec file : one campaign per configuration (default: %(default)s)" )
 parser.add_argument('-ns','--nostart', action='store_true', help="do not launch jobs (default: %(default)s)" )
+parser.add_argument('--trace', help="append timed phases of the run to TRACE as json lines (default: %(default)s)" )
+parser.add_argument('--profile', action='store_true', help="profile the Python side with cProfile and tracemalloc (default: %(default)s)" )
 args = parser.parse_args()
+tools.instrument(args,__file__)
 print(args)
+sched = scheduler.get_scheduler(args.j,ncores=args.ncores)
+if args.array == True and sched.supports_array == False :
+    parser.error('job arrays are not available with {}'.format(args.j))
+if args.array == True and args.pack > 0 :
+    parser.error('-a/--array and -pk/--pack cannot be used together')
+# a sweep is submitted at once : job array, or packed jobs
+if args.sweep and args.pack == 0 :
+    if sched.supports_array == False :
+        parser.error('-sw/--sweep needs -pk/--pack with {}'.format(args.j))
+    args.array = True
 
 # Read parameters from .json file if given
 if args.load_json: args = tools.json2args(args.load_json)
@@ -89,39 +136,105 @@ home_dir = "%s" % os.getcwd()
 input_dir = os.path.join(home_dir,'input-files')
 sol_dir = os.path.join(home_dir,'solutein')
 
-# Iterate over solutes
-for mol in dict_solutes['V0'].keys():
-
-    # Create directory per solute
-    mol_dir = os.path.join(home_dir,mol)
-    tools.mkdir_p(mol)
-
-    # Copy input files
-    shutil.copy(os.path.join(input_dir,'h4dmc.x'),mol_dir)
-    shutil.copy(os.path.join(input_dir,'dummy.in'),mol_dir)
-    shutil.copy(os.path.join(input_dir,'dummy.top'),mol_dir)
-    shutil.copy(os.path.join(sol_dir,mol + '.in'),mol_dir)
-    if os.path.isfile(os.path.join(sol_dir,mol+'.top')) == True:
-        shutil.copy(os.path.join(sol_dir,mol + '.top'),mol_dir)
-
-    if args.infile is not None :
-        shutil.copy(os.path.join(input_dir,'acc_' + args.infile),mol_dir)
-        shutil.copy(os.path.join(input_dir,'r_' + args.infile),mol_dir)
-
-    # Crete and launch H4D initialisation
-    tools.create_initialisation_input(args,solute=mol,V0=dict_solutes['V0'][mol],mu0=dict_solutes['mu0'][mol],mol_dir=mol_dir)
-
-    if args.nostart == True :
-        continue
-    else :
-        if args.j == "slurm" :
-            shutil.copy(os.path.join(input_dir,'job-ini'),mol_dir)
-            job_file = os.path.join(mol_dir,'job-ini')
-            os.system("cd {0}; sbatch {1}; cd ..".format(mol_dir,job_file))
-        if args.j == "loadleveler" :
-            shutil.copy(os.path.join(input_dir,'job-ini'),mol_dir)
-            job_file = os.path.join(mol_dir,'job-ini')
-            os.system("cd {0}; llsubmit {1}; cd ..".format(mol_dir,job_file))
-
-
-
+wrapper = telemetry.wrapper_command() if args.telemetry == True else None
+
+# Campaigns : this directory, or one sub-directory per configuration of the sweep
+if args.sweep :
+    camps = sweep.campaigns(sweep.read_spec(args.sweep),args,home_dir)
+    with tools.timer('setup') :
+        sweep.setup(home_dir,camps,args.solutes)
+    print('{} configurations : {}'.format(len(camps),', '.join(os.path.basename(c[0]) for c in camps)))
+else :
+    camps = [(home_dir,args,{})]
+
+# Tuned ins/des parameters per solute (parameters of the sweep are kept)
+if args.pilot_table :
+    # pilot tools need NumPy, imported only with -pt
+    import H4Dtools_pilot as pilot
+tuned = pilot.read_table(args.pilot_table) if args.pilot_table else {}
+
+# Add shared input files to the store once (reference boxes of configurations with the same water settings are the same object)
+store_dir = os.path.join(home_dir,args.store)
+digests = {}
+def shared_files(camp_args):
+    shared = ['h4dmc.x','dummy.in','dummy.top']
+    if camp_args.infile is not None and camp_args.create_box == False :
+        shared += ['acc_' + camp_args.infile, 'r_' + camp_args.infile]
+    for name in shared :
+        if name not in digests :
+            digests[name] = store.store_add(os.path.join(input_dir,name),store_dir)
+    return {name: digests[name] for name in shared}
+
+# Iterate over campaigns and solutes
+batch_rows = []
+batch_dbs = []
+for camp_dir, camp_args, config in camps:
+
+    db = state.connect(camp_dir)
+    camp_files = shared_files(camp_args)
+    if args.sweep :
+        tools.args2json(os.path.join(camp_dir,'params_ini.out'),camp_args)
+
+    for mol in dict_solutes['V0'].keys():
+
+        # Create directory per solute
+        mol_dir = os.path.join(camp_dir,mol)
+        with tools.timer('setup') :
+            tools.mkdir_p(mol_dir)
+
+        # Deploy shared input files and copy solute files
+        with tools.timer('copy',solute=mol) :
+            store.deploy_files(camp_files,mol_dir,store_dir,strategy=args.deploy)
+            shutil.copy(os.path.join(sol_dir,mol + '.in'),mol_dir)
+            if os.path.isfile(os.path.join(sol_dir,mol+'.top')) == True:
+                shutil.copy(os.path.join(sol_dir,mol + '.top'),mol_dir)
+
+        # Crete and launch H4D initialisation
+        mol_args = camp_args
+        if mol in tuned :
+            mol_args = argparse.Namespace(**vars(camp_args))
+            mol_args.__dict__.update({k: v for k,v in tuned[mol].items() if k not in config})
+        tools.create_initialisation_input(mol_args,solute=mol,V0=dict_solutes['V0'][mol],mu0=dict_solutes['mu0'][mol],mol_dir=mol_dir)
+        telemetry.write_run_params(mol_dir,'ini',**telemetry.run_params(mol_args,mol_dir,mol,'ini',index=0))
+
+        if args.array == True or args.pack > 0 :
+            # solute directory relative to the submission directory
+            batch_rows.append((os.path.relpath(mol_dir,home_dir),'ini',0))
+            batch_dbs.append((db,mol,camp_args))
+        elif args.nostart == True :
+            continue
+        else :
+            with tools.timer('input') :
+                job_file = jobs.write_job_script(os.path.join(input_dir,'job-ini'),mol_dir,wrapper=wrapper,staging=args.staging)
+            with tools.timer('submit') :
+                state.record_job(db,mol,'ini',0,sched.submit(job_file,mol_dir))
+
+# Submit all solutes as one job array
+if args.array == True :
+    with tools.timer('input') :
+        job_file, ntasks = jobs.write_array(home_dir,os.path.join(input_dir,'job-ini'),batch_rows,'ini',throttle=args.array_throttle,wrapper=wrapper,staging=args.staging)
+    if args.nostart == False :
+        with tools.timer('submit') :
+            job_id = sched.submit(job_file,home_dir,array=(ntasks,args.array_throttle))
+        for task,((mol_path,stage,index),(db,mol,camp_args)) in enumerate(zip(batch_rows,batch_dbs),start=1):
+            state.record_job(db,mol,stage,index,'{}_{}'.format(job_id,task))
+
+# Submit runs packed into multi-core jobs
+if args.pack > 0 :
+    costs = [pack.estimate_cost(camp_args,os.path.join(home_dir,mol_path),mol,stage) for (mol_path,stage,index),(db,mol,camp_args) in zip(batch_rows,batch_dbs)]
+    run_db = {row[0]: info[:2] for row,info in zip(batch_rows,batch_dbs)}
+    for job_file, manifest, load in pack.write_packs(home_dir,os.path.join(input_dir,'job-ini'),batch_rows,costs,'ini',args.pack,njobs=args.pack_jobs,wrapper=wrapper,staging=args.staging):
+        if args.nostart == False :
+            with tools.timer('submit') :
+                job_id = sched.submit(job_file,home_dir)
+            for task,mol_path,stage,index in jobs.read_manifest(manifest):
+                db, mol = run_db[mol_path]
+                state.record_job(db,mol,stage,index,job_id)
+
+with tools.timer('wait') :
+    sched.wait()
+for camp_dir, camp_args, config in camps:
+    db = state.connect(camp_dir)
+    state.update_jobs(db,sched)
+    with tools.timer('state') :
+        state.refresh(db,camp_dir,list(dict_solutes['V0'].keys()))
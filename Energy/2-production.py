@@ -1,9 +1,17 @@
 import csv
 import os
+import sys
 import shutil
 import argparse
 import random
+import math
 import H4Dtools_functions as tools
+import H4Dtools_scheduler as scheduler
+import H4Dtools_jobs as jobs
+import H4Dtools_pack as pack
+import H4Dtools_telemetry as telemetry
+import H4Dtools_state as state
+import H4Dtools_dag as dag
 
 """
 
@@ -32,16 +40,46 @@ Accumulation of ins/des for a set of solutes
         -fb : force bias parameters
         -Vxp : volume exchange probablity
         -lnV : maximum volume exchange
-        -auto : automatic determination of the starting index i
+        -auto : automatic determination of the starting index i, separately for ins and des (campaign-state.db)
         -i : manual determination of the starting index
-        -j : job handeling system
+        -j : job handeling system (slurm, loadleveler or local)
+        -np, --ncores : nb of jobs run at the same time with -j local
+        -stg, --staging : files copied to the compute node : only those of the run (minimal) or the whole solute directory (full)
+        -a, --array : submit all ins/des runs as one job array (manifest array-prod.tsv + job-array-prod)
+        -at, --array_throttle : maximum nb of array tasks running at the same time
+        -pk, --pack : pack runs into jobs of PACK cores (longest-processing-time-first on estimated costs)
+        -npk, --pack_jobs : nb of packed jobs (default: enough jobs to fill the cores)
+        -te, --target_err : adaptive mode, target BAR error (kT) : converged solutes are not resubmitted,
+                            the others get the accumulations needed to reach it (between -nmin and -nmax) ;
+                            errors of the h4dmc.x analyses of 3-analysis.py, or of the Python estimator
+                            once 3-analysis.py --check agrees with h4dmc.x
+        -nmin, -nmax : minimum and maximum nb of accumulations per solute in adaptive mode
+        -B, --budget : core-hours of the segment in adaptive mode (needs -wm), solutes with the largest errors first
+        -vs, --variance_split : ins/des accumulations per solute from their contributions to the BAR variance
+                                and their costs (minimum error per CPU time), with or without -te
+                                (Python estimator only : needs 3-analysis.py --check in agreement)
+        -rep, --replicas : K independent replicas of each ins/des run started from the same files, each with its
+                           own seed and output files, merged into acc_{solute_name}_ins{j} / _des{j} when all are done ;
+                           sets with replicas that failed or were never submitted are reported (runs of campaign-state.db)
+        -seed : campaign seed, combined with solute, stage, index and replica into the seed of each run
+        -dag : submit the next DAG segments of each solute at once, each after the successful end of the
+               previous one (initialisation first for solutes set up with 1-initilisation.py -ns), then the
+               analysis of the campaign (3-analysis.py -auto) after all of them
+        -tm, --telemetry : record wall/CPU time, memory and I/O of each h4dmc.x run (metrics-{stage}-{index}.json)
+        -wm, --walltime_model : wall time model (H4Dtools_telemetry.py fit) giving --time limits and packing costs
+        --trace : json lines file of timed phases (csv, setup, copy, input, submit, wait, state ...)
+        --profile : cProfile and tracemalloc of the run (profile-{script}.prof)
 
     Output :
 
         solute directory : {solute_name}
-            input-ins + input-des
+            input-ins + input-des, params-ins.json + params-des.json (run parameters for telemetry)
+            with -dag : input-ins.{j} + input-des.{j}, params-ins.{j}.json + params-des.{j}.json, job-ins.{j} + job-des.{j}
+                        job-analysis (and job-dag, job steps of the whole graph with -j loadleveler) in the campaign directory
+            with --replicas : input-ins-r{k} + input-des-r{k}, acc_{solute_name}_ins{j}-r{k}, ... (k = 1 .. K)
             acc_{solute_name}_ins{j}, r_{solute_name}_ins{j}, acc_{solute_name}_des{j}, r_{solute_name}_des{j}
         params_run_{j}.json file : recapitulation of run parameters
+        campaign-state.db : latest indices of solutes and submitted runs (python H4Dtools_state.py status)
 """
 
 
@@ -65,10 +103,38 @@ parser.add_argument('-Vxp','--vol_ex_prob', type=float, default=0.2, help=" Volu
 parser.add_argument('-lnV', type=float, default=0.05, help="maximum ln(volume) exchange (default: %(default)s)" )
 parser.add_argument('-i', type=int,  help="index of starting file (default: %(default)s)" )
 parser.add_argument('-auto','--auto_continue', action='store_true', help="automatic determination of starting index (default: %(default)s)" )
-parser.add_argument('-j', default="slurm", help=" Job handeling system : slumr or loadleveler  (default: %(default)s)" )
+parser.add_argument('-j', default="slurm", choices=list(scheduler.SCHEDULERS), help=" Job handeling system : slurm, loadleveler or local (default: %(default)s)" )
+parser.add_argument('-np','--ncores', type=int, help="nb of jobs run at the same time on this machine with -j local (default: nb of cores)" )
+parser.add_argument('-stg','--staging', default='minimal', choices=jobs.STAGING, help="files copied to the compute node : those read by the run, or the whole solute directory (default: %(default)s)" )
+parser.add_argument('-a','--array', action='store_true', help="submit a single job array (default: %(default)s)" )
+parser.add_argument('-at','--array_throttle', type=int, default=0, help="maximum nb of running array tasks, 0 for no limit (default: %(default)s)" )
+parser.add_argument('-pk','--pack', type=int, default=0, help="pack runs into jobs of PACK cores, 0 for one job per run (default: %(default)s)" )
+parser.add_argument('-npk','--pack_jobs', type=int, help="nb of packed jobs (default: enough jobs to fill the cores)" )
+parser.add_argument('-te','--target_err', type=float, help="target BAR error for adaptive accumulation (default: %(default)s kT)" )
+parser.add_argument('-nmin','--nacc_min', type=int, default=100, help="minimum nb of accumulations per solute in adaptive mode (default: %(default)s)" )
+parser.add_argument('-nmax','--nacc_max', type=int, help="maximum nb of accumulations per solute in adaptive mode (default: 10 x nacc)" )
+parser.add_argument('-B','--budget', type=float, help="core-hours of the segment in adaptive mode (default: %(default)s)" )
+parser.add_argument('-vs','--variance_split', action='store_true', help="split accumulations between ins and des to minimise the BAR error per CPU time (default: %(default)s)" )
+parser.add_argument('-rep','--replicas', type=int, default=1, help="nb of independent replicas of each run (default: %(default)s)" )
+parser.add_argument('-dag', type=int, default=0, help="nb of segments of each solute submitted at once with dependencies, then the analysis, 0 for the next one only (default: %(default)s)" )
+parser.add_argument('-seed', type=int, default=0, help="campaign seed of the runs (default: %(default)s)" )
+parser.add_argument('-tm','--telemetry', action='store_true', help="record resource usage of h4dmc.x runs (default: %(default)s)" )
+parser.add_argument('-wm','--walltime_model', help="wall time model file for --time limits and job packing (default: %(default)s)" )
 parser.add_argument('-ns','--nostart', action='store_true', help="do not launch jobs (default: %(default)s)" )
+parser.add_argument('--trace', help="append timed phases of the run to TRACE as json lines (default: %(default)s)" )
+parser.add_argument('--profile', action='store_true', help="profile the Python side with cProfile and tracemalloc (default: %(default)s)" )
 args = parser.parse_args()
+tools.instrument(args,__file__)
 print(args)
+sched = scheduler.get_scheduler(args.j,ncores=args.ncores)
+if args.array == True and sched.supports_array == False :
+    parser.error('job arrays are not available with {}'.format(args.j))
+if args.array == True and args.pack > 0 :
+    parser.error('-a/--array and -pk/--pack cannot be used together')
+if args.budget and not (args.target_err and args.walltime_model) :
+    parser.error('-B/--budget needs -te/--target_err and -wm/--walltime_model')
+if args.dag > 0 and (args.array == True or args.pack > 0 or args.replicas > 1) :
+    parser.error('-dag cannot be used with -a/--array, -pk/--pack or -rep/--replicas')
 
 # default parameters for single conformer solute
 if args.flex == False :
@@ -89,55 +155,240 @@ print(args)
 # Read parameters from .json file if given
 if args.load_json: args = tools.json2args(args.load_json)
 
+# BAR errors (adaptive accumulation) and replica merges need NumPy, imported only when used
+if args.target_err or args.variance_split :
+    import H4Dtools_adaptive as adaptive
+    import H4Dtools_bar as bar
+if args.replicas > 1 :
+    import H4Dtools_merge as merge
+
+# Wrapper of h4dmc.x runs and wall time model
+wrapper = telemetry.wrapper_command() if args.telemetry == True else None
+model = telemetry.load_model(args.walltime_model) if args.walltime_model else None
+if args.budget and not all(stage in model for stage in ['ins','des']) :
+    parser.error('-B/--budget needs ins and des runs in {} (H4Dtools_telemetry.py fit)'.format(args.walltime_model))
+
+def time_options(seconds):
+    ''' --time limit of a job from its predicted wall time (slurm only) '''
+    if model is None or seconds is None or sched.name != 'slurm':
+        return None
+    return ['--time={}'.format(telemetry.time_limit(model,seconds))]
+
 # get solute names
-with open(args.solutes,'r') as f:
-    lines = f.readlines()
-    molecules = []
-    for line in lines:
-        molecules.append(line.split('\t')[0])
-molecules.remove('Name')
+with tools.timer('csv') :
+    with open(args.solutes,'r') as f:
+        lines = f.readlines()
+        molecules = []
+        for line in lines:
+            molecules.append(line.split('\t')[0])
+    molecules.remove('Name')
 
 home_dir = "%s" % os.getcwd()
 input_dir = os.path.join(home_dir,'input-files')
 sol_dir = os.path.join(home_dir,'solutein')
 
-# Iterate over solutes
-for mol in molecules:
+# Read state of solute directories (one scan of the directories changed since the last run)
+db = state.connect(home_dir)
+with tools.timer('state') :
+    state.refresh(db,home_dir,molecules)
 
-    mol_dir = os.path.join(home_dir,mol)
+def merge_replicas(solutes):
+    ''' Merge replicas of the next ins/des runs of solutes once all of them are done,
+        report sets with replicas that failed or were never submitted (from the runs table) '''
+    merged, incomplete = 0, 0
+    for mol in solutes:
+        index = state.indices(db,mol)
+        for stage in ['ins','des']:
+            mol_dir = os.path.join(home_dir,mol)
+            with tools.timer('merge',solute=mol) :
+                done = merge.merge_replicas(mol_dir,mol,stage,index[stage]+1,args.replicas)
+            merged += done
+            missing = {} if done else merge.incomplete_replicas(mol_dir,mol,stage,index[stage]+1,args.replicas,state.runs(db,mol,index[stage]+1))
+            if missing :
+                incomplete += 1
+                print('{} {}{} : replica set incomplete, {}'.format(mol,stage,index[stage]+1,', '.join('r{} {}'.format(k,s) for k,s in missing.items())))
+    if merged > 0 :
+        print('{} replica sets merged'.format(merged))
+        with tools.timer('state') :
+            state.refresh(db,home_dir,solutes)
+    if incomplete > 0 :
+        print('{} replica sets incomplete : not merged until their missing replicas are run again'.format(incomplete))
+
+if args.replicas > 1 :
+    state.update_jobs(db,sched)
+    merge_replicas(molecules)
+replicas = range(1,args.replicas+1) if args.replicas > 1 else [0]
+create_input = dict(ins=tools.create_ins_input, des=tools.create_des_input)
+
+# Adaptive accumulation : accumulations per solute (and per direction) from its BAR error, converged solutes retired
+nacc_solute = {}
+if args.target_err or args.variance_split :
+    # latest index of each direction
+    index = {mol: state.indices(db,mol) if args.auto_continue == True else dict(ins=args.i, des=args.i) for mol in molecules}
+    # Python estimator only where 3-analysis.py --check found it in agreement with h4dmc.x
+    native = bar.validated(home_dir)
+    if native == False :
+        print('BAR errors of h4dmc.x analyses (3-analysis.py, HFE_cache.json){}'.format(
+              ' : no variance split before 3-analysis.py --check agrees (bar-check.json)' if args.variance_split else ''))
+    with tools.timer('bar') :
+        errors = adaptive.latest_errors(home_dir,index,native=native)
+
+    def segment_cost(mol,n):
+        ''' core-hours of ins and des runs of n = {ins, des} accumulations '''
+        seconds = 0
+        for stage in ['ins','des']:
+            seg_args = argparse.Namespace(**vars(args))
+            seg_args.nacc = n[stage]
+            seconds += telemetry.predict(model,stage,telemetry.run_params(seg_args,os.path.join(home_dir,mol),mol,stage)) if n[stage] > 0 else 0
+        return seconds / 3600
+
+    def unit_cost(mol):
+        ''' cost of one ins / des accumulation : predicted wall time, or relative estimate '''
+        mol_dir = os.path.join(home_dir,mol)
+        seconds = {stage: telemetry.predict(model,stage,telemetry.run_params(args,mol_dir,mol,stage)) if model else None for stage in ['ins','des']}
+        if None not in seconds.values() :
+            return {stage: seconds[stage] / args.nacc for stage in ['ins','des']}
+        return {stage: pack.estimate_cost(args,mol_dir,mol,stage) / args.nacc for stage in ['ins','des']}
+
+    with tools.timer('adaptive') :
+        plan, converged = adaptive.allocate(errors,args.target_err,args.nacc,args.nacc_min,args.nacc_max or 10*args.nacc,
+                                            cost=segment_cost if model else None,budget=args.budget,
+                                            unit_cost=unit_cost,variance_split=args.variance_split)
+    nacc_solute = dict(plan)
+    for mol in molecules:
+        err = 'unknown' if math.isnan(errors[mol]['err']) else '{:.4f} kT'.format(errors[mol]['err'])
+        if mol in nacc_solute :
+            plan_str = 'nacc ins {ins} des {des}'.format(**nacc_solute[mol])
+        else :
+            plan_str = 'converged' if mol in converged else 'out of budget'
+        print('{}\t error {}\t {}'.format(mol,err,plan_str))
+    molecules = [mol for mol,n in plan]
+    if len(molecules) == 0 :
+        print('All solutes converged to {} kT'.format(args.target_err))
 
-    shutil.copy(os.path.join(input_dir,'job-ins'),mol_dir)
-    shutil.copy(os.path.join(input_dir,'job-des'),mol_dir)
+# Whole campaign graph : next args.dag segments of each solute, each after the previous one, then the analysis
+if args.dag > 0 :
+    state.update_jobs(db,sched)
+    nodes, ends = [], []
+    for mol in molecules:
+        mol_dir = os.path.join(home_dir,mol)
+        if state.queued(db,mol) :
+            print('{} : runs already queued, left out'.format(mol))
+            continue
+        index = state.indices(db,mol)
+        start = dict(ins=index['ins'], des=index['des']) if args.auto_continue == True else dict(ins=args.i, des=args.i)
+        first = None
+        if start['ins'] is None :
+            sys.exit('No staring index : add manually with -i or automatic determination with -auto')
+        # initialisation set up by 1-initilisation.py -ns
+        if start['ins'] < 0 and start['des'] < 0 :
+            if not os.path.isfile(os.path.join(mol_dir,'input-ini')) :
+                print('{} : no initialisation input (1-initilisation.py -ns), left out'.format(mol))
+                continue
+            with tools.timer('input') :
+                job_file = jobs.write_job_script(os.path.join(input_dir,'job-ini'),mol_dir,wrapper=wrapper,staging=args.staging)
+            first = (mol,'ini',0)
+            nodes.append(dag.node(first,job_file,mol_dir))
+            start = dict(ins=0, des=0)
+        for stage in ['ins','des']:
+            prev = first
+            for k in range(start[stage]+1,start[stage]+args.dag+1):
+                stage_args = argparse.Namespace(**vars(args))
+                stage_args.i = k-1
+                stage_args.nacc = nacc_solute[mol][stage] if mol in nacc_solute else args.nacc
+                create_input[stage](stage_args,solute=mol,mol_dir=mol_dir,input_file='input-{}.{}'.format(stage,k),chained=prev is not None)
+                params = telemetry.run_params(stage_args,mol_dir,mol,stage,index=k)
+                telemetry.write_run_params(mol_dir,stage,per_index=True,**params)
+                with tools.timer('input') :
+                    job_file = jobs.write_job_script(os.path.join(input_dir,'job-' + stage),mol_dir,index=k,
+                                                     wrapper=wrapper,staging=args.staging,per_index=True)
+                seconds = telemetry.predict(model,stage,params) if model else None
+                nodes.append(dag.node((mol,stage,k),job_file,mol_dir,[prev],options=time_options(seconds)))
+                prev = (mol,stage,k)
+            ends.append(prev)
+    # analysis of the campaign once all chains are done
+    command = 'PYTHONPATH={}:${{PYTHONPATH}} python3 {} -s {} -auto'.format(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                                          os.path.abspath(__file__).replace('2-production.py','3-analysis.py'),os.path.abspath(args.solutes))
+    nodes.append(dag.node(('analysis',),dag.analysis_job(os.path.join(input_dir,'job-ins'),home_dir,command),home_dir,[e for e in ends if e]))
+    if args.nostart == False and len(nodes) > 1 :
+        with tools.timer('submit') :
+            ids = dag.submit(sched,nodes) if sched.supports_dependencies == True else dag.submit_steps(sched,nodes)
+        for key,job_id in ids.items():
+            if len(key) == 3 :
+                state.record_job(db,key[0],key[1],key[2],job_id)
+    print('{} jobs in the campaign graph'.format(len(nodes)))
 
-    # if auto continuation determine starting index
+# Iterate over solutes (one segment, without -dag)
+batch_rows = []
+planned = {}
+for mol in (molecules if args.dag == 0 else []):
+
+    mol_dir = os.path.join(home_dir,mol)
+
+    # if auto continuation determine starting index of ins and des
+    start = dict(ins=args.i, des=args.i)
     if args.auto_continue == True :
-        args.i = tools.auto_sim_index(mol,mol_dir=mol_dir)    
+        index = state.indices(db,mol)
+        args.i = state.sim_index(index)
+        start = dict(ins=index['ins'], des=index['des'])
     
     # Check that index have been defined
     if args.i == None:
-        print('No staring index : add manually with -i or automatic determination with -auto')
-
-    tools.create_ins_input(args,solute=mol,mol_dir=mol_dir)
-    tools.create_des_input(args,solute=mol,mol_dir=mol_dir)
-
-    if args.nostart == True :
-        continue
-    else :
-        if args.j == "slurm" :
-            shutil.copy(os.path.join(input_dir,'job-ins'),mol_dir)
-            shutil.copy(os.path.join(input_dir,'job-des'),mol_dir)
-            job_ins_file = os.path.join(mol_dir,'job-ins')
-            job_des_file = os.path.join(mol_dir,'job-des')
-            os.system('sed -i "s/YY/{0}/g" {1}'.format(args.i+1,job_ins_file))
-            os.system('sed -i "s/YY/{0}/g" {1}'.format(args.i+1,job_des_file))
-            os.system("cd {0}; sbatch {1}; sbatch {2};  cd ..".format(mol_dir,job_ins_file,job_des_file))
-        if args.j == "loadleveler" :
-            shutil.copy(os.path.join(input_dir,'job-ins'),mol_dir)
-            shutil.copy(os.path.join(input_dir,'job-des'),mol_dir)
-            job_ins_file = os.path.join(mol_dir,'job-ins')
-            job_des_file = os.path.join(mol_dir,'job-des')
-            os.system('sed -i "s/YY/{0}/g" {1}'.format(args.i+1,job_ins_file))
-            os.system('sed -i "s/YY/{0}/g" {1}'.format(args.i+1,job_des_file))
-            os.system("cd {0}; llsubmit {1}; sbatch {2};  cd ..".format(mol_dir,job_ins_file,job_des_file))
-
-tools.args2json('params_run_{}.out'.format(args.i+1),args)    
+        sys.exit('No staring index : add manually with -i or automatic determination with -auto')
+
+    for stage in ['ins','des']:
+        stage_args = argparse.Namespace(**vars(args))
+        stage_args.i = start[stage]
+        stage_args.nacc = nacc_solute[mol][stage] if mol in nacc_solute else args.nacc
+        for r in replicas:
+            # run name : stage, or stage-r{k} for replica k
+            name = telemetry.run_name(stage,r)
+            create_input[stage](stage_args,solute=mol,mol_dir=mol_dir,replica=r)
+            params = telemetry.run_params(stage_args,mol_dir,mol,stage,index=start[stage]+1)
+            telemetry.write_run_params(mol_dir,stage,replica=r,**params)
+            planned[(mol,name)] = (stage_args,params)
+            with tools.timer('input') :
+                job_file = jobs.write_job_script(os.path.join(input_dir,'job-' + stage),mol_dir,index=start[stage]+1,
+                                                 wrapper=wrapper,suffix=tools.replica_suffix(r),staging=args.staging)
+            if args.array == True or args.pack > 0 :
+                batch_rows.append((mol,name,start[stage]+1))
+            elif args.nostart == False :
+                seconds = telemetry.predict(model,stage,params) if model else None
+                with tools.timer('submit') :
+                    job_id = sched.submit(job_file,mol_dir,options=time_options(seconds))
+                state.record_job(db,mol,name,start[stage]+1,job_id)
+
+# Submit all ins/des runs as one job array
+if args.array == True :
+    job_file, ntasks = jobs.write_array(home_dir,os.path.join(input_dir,'job-ins'),batch_rows,'prod',throttle=args.array_throttle,wrapper=wrapper,staging=args.staging)
+    if args.nostart == False :
+        seconds = [telemetry.predict(model,telemetry.split_name(name)[0],planned[(mol,name)][1]) if model else None for mol,name,index in batch_rows]
+        seconds = None if None in seconds else max(seconds)
+        with tools.timer('submit') :
+            job_id = sched.submit(job_file,home_dir,array=(ntasks,args.array_throttle),options=time_options(seconds))
+        for task,(mol,name,index) in enumerate(batch_rows,start=1):
+            state.record_job(db,mol,name,index,'{}_{}'.format(job_id,task))
+
+# Submit runs packed into multi-core jobs
+if args.pack > 0 :
+    # costs : predicted wall times with a wall time model (of all stages packed), relative estimates otherwise
+    costs = [telemetry.predict(model,telemetry.split_name(name)[0],planned[(mol,name)][1]) if model else None for mol,name,index in batch_rows]
+    if None in costs :
+        costs = [pack.estimate_cost(planned[(mol,name)][0],os.path.join(home_dir,mol),mol,telemetry.split_name(name)[0]) for mol,name,index in batch_rows]
+    for job_file, manifest, load in pack.write_packs(home_dir,os.path.join(input_dir,'job-ins'),batch_rows,costs,'prod',args.pack,njobs=args.pack_jobs,wrapper=wrapper,staging=args.staging):
+        if args.nostart == False :
+            with tools.timer('submit') :
+                job_id = sched.submit(job_file,home_dir,options=time_options(load))
+            for task,mol,stage,index in jobs.read_manifest(manifest):
+                state.record_job(db,mol,stage,index,job_id)
+
+with tools.timer('wait') :
+    sched.wait()
+state.update_jobs(db,sched)
+with tools.timer('state') :
+    state.refresh(db,home_dir,molecules)
+if args.replicas > 1 :
+    merge_replicas(molecules)
+
+if args.i is not None :
+    tools.args2json('params_run_{}.out'.format(args.i+1),args)    
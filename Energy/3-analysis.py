@@ -1,10 +1,16 @@
 import csv
 import os
+import sys
 import shutil
 import argparse
 import random
 import H4Dtools_functions as tools
+import H4Dtools_cache as cache
+import H4Dtools_state as state
+import H4Dtools_archive as archive
+import H4Dtools_results as results_db
 import json
+import concurrent.futures
 """
 
 Accumulation of ins/des for a set of solutes
@@ -25,13 +31,40 @@ Accumulation of ins/des for a set of solutes
         -e, --evol : evolution of HFE as a function of accumulations
         -auto : automatic determination of the starting index i
         -i : manual determination of the starting index
+        -nj, --jobs : nb of h4dmc.x analyses run in parallel
+        -native : compute HFEs with the Python BAR estimator from the acc files instead of running h4dmc.x
+        --check : run both h4dmc.x and the Python BAR estimator on all pairs (cached ones too), print their
+                  differences and record the comparison in bar-check.json (agreement within --check_tol),
+                  which the other uses of the Python estimator (-te/-vs errors, -bs intervals) require
+        --check_tol : largest HFE difference (kJ/mol) between both estimators counted as agreement
+        -nc, --no_cache : do not reuse or store results in the analysis cache
+        --cache_file : analysis cache file
+        --cache_hash : identify acc files by content hash instead of size and mtime
+        --cache_evict : remove cache entries whose acc files changed or disappeared
+        --cache_invalidate : remove cache entries of the given solutes
+        --cache_clear : empty the analysis cache
+        (--cache_evict, --cache_invalidate and --cache_clear only update the cache, without analysis)
+        -bs, --bootstrap : nb of block bootstrap resamples over the segments 0 .. i of each solute (confidence
+                           interval, error, statistical inefficiency and correlation of consecutive segments) ;
+                           the interval is the one of the Python estimator (around its HFE), given with
+                           -native or once --check found it in agreement with h4dmc.x
+        -bl, --block_length : nb of consecutive segments per bootstrap block
+        -ci : confidence level of the bootstrap interval
+        -seed : seed of the bootstrap resamples
+        -rdb, --results_db : results store (SQLite) the HFEs of all analysed (solute, index) pairs are appended to
+        -cfg, --config : configuration of the results in the store (default: campaign directory relative to the store)
+        -nr, --no_results : do not append results to the results store
+        --trace : json lines file of timed phases (csv, setup, copy, input, submit, wait, state ...)
+        --profile : cProfile and tracemalloc of the run (profile-{script}.prof)
 
     Output :
 
         solute directory : {solute_name}
             input-ana
             pinsdes_{solute_name}_{i}.csv (optional)
-        HFE-{i}.csv or HFE_evol.csv
+        HFE-{i}.csv or HFE_evol.csv (with -bs : confidence interval ci_lo, ci_hi and statistical inefficiency in HFE-{i}.csv)
+        HFE_cache.json : results of already analysed (solute, index) pairs
+        HFE-results.db : HFE, error, nacc, mu0 and V0 per (configuration, solute, index) (python H4Dtools_results.py accuracy)
 
 """
 
@@ -47,12 +80,38 @@ parser.add_argument('-e','--evol', action='store_true', help="save evolution of
 parser.add_argument('-i', type=int,  help="index of starting file (default: %(default)s)" )
 parser.add_argument('-auto','--auto_continue', action='store_true', help="automatic determination of starting index (default: %(default)s)" )
 parser.add_argument('-j', default="slurm", help=" Job handeling system : slumr or loadleveler  (default: %(default)s)" )
+parser.add_argument('-nj','--jobs', type=int, default=1, help="nb of h4dmc.x analyses run in parallel (default: %(default)s)" )
+parser.add_argument('-native', action='store_true', help="compute HFEs with the Python BAR estimator instead of h4dmc.x (default: %(default)s)" )
+parser.add_argument('--check', action='store_true', help="compare Python BAR estimator with h4dmc.x (default: %(default)s)" )
+parser.add_argument('--check_tol', type=float, default=0.1, help="largest HFE difference counted as agreement by --check (default: %(default)s kJ/mol)" )
+parser.add_argument('-nc','--no_cache', action='store_true', help="do not use the analysis cache (default: %(default)s)" )
+parser.add_argument('--cache_file', default='HFE_cache.json', help="analysis cache file (default: %(default)s)" )
+parser.add_argument('--cache_hash', action='store_true', help="identify acc files by content hash instead of size and mtime (default: %(default)s)" )
+parser.add_argument('--cache_evict', action='store_true', help="remove cache entries whose acc files changed or disappeared (default: %(default)s)" )
+parser.add_argument('--cache_invalidate', nargs='+', help="remove cache entries of the given solutes" )
+parser.add_argument('--cache_clear', action='store_true', help="empty the analysis cache (default: %(default)s)" )
+parser.add_argument('-bs','--bootstrap', type=int, default=0, help="nb of block bootstrap resamples over segments, 0 for none (default: %(default)s)" )
+parser.add_argument('-bl','--block_length', type=int, default=1, help="nb of consecutive segments per bootstrap block (default: %(default)s)" )
+parser.add_argument('-ci', type=float, default=0.95, help="confidence level of the bootstrap interval (default: %(default)s)" )
+parser.add_argument('-seed', type=int, default=0, help="seed of the bootstrap resamples (default: %(default)s)" )
+parser.add_argument('-rdb','--results_db', default=results_db.DATABASE, help="results store the HFEs are appended to (default: %(default)s)" )
+parser.add_argument('-cfg','--config', help="configuration of the results in the store (default: campaign directory relative to the store)" )
+parser.add_argument('-nr','--no_results', action='store_true', help="do not append results to the results store (default: %(default)s)" )
+parser.add_argument('--trace', help="append timed phases of the run to TRACE as json lines (default: %(default)s)" )
+parser.add_argument('--profile', action='store_true', help="profile the Python side with cProfile and tracemalloc (default: %(default)s)" )
 args = parser.parse_args()
+tools.instrument(args,__file__)
 print(args)
 
 # Read parameters from .json file if given
 if args.load_json: args = tools.json2args(args.load_json)
 
+# Python estimator and bootstrap (NumPy) only for -native, --check and -bs : h4dmc.x analyses run without NumPy
+if args.native == True or args.check == True or args.bootstrap > 0 :
+    import numpy as np
+    import H4Dtools_bar as bar
+    import H4Dtools_bootstrap as bootstrap
+
 # Load solutes with their volumes and reference HFEs
 data = tools.from_file_to_dict(args.solutes,'\t')
 keys = ['V0','mu0']
@@ -62,78 +121,190 @@ dict_solutes = dict(zip(keys,data))
 home_dir = "%s" % os.getcwd()
 input_dir = os.path.join(home_dir,'input-files')
 
-if args.evol == True:
-    dict_HFE = {}
-# Iterate over solutes
-j = 0
-for mol,mu0 in dict_solutes['mu0'].items():
+order = {mol:n for n,mol in enumerate(dict_solutes['mu0'])}
+
+# Analysis cache
+dict_cache = {} if args.no_cache == True else cache.load_cache(args.cache_file)
+if args.cache_clear == True :
+    print('Cache cleared : {} entries removed'.format(len(dict_cache)))
+    dict_cache = {}
+if args.cache_invalidate :
+    print('Cache invalidated : {} entries removed'.format(cache.invalidate(dict_cache,args.cache_invalidate)))
+if args.cache_evict == True :
+    print('Cache evicted : {} entries removed'.format(cache.evict(dict_cache,home_dir)))
+if args.cache_clear == True or args.cache_invalidate or args.cache_evict == True :
+    if args.no_cache == False :
+        cache.save_cache(args.cache_file,dict_cache)
+    sys.exit(0)
+# Block bootstrap : intervals of the Python estimator, with HFEs of h4dmc.x only once --check found both in agreement
+# (or if this --check does) ; signatures of results with a bootstrap hold its parameters and the earlier segments
+boot_sig = args.bootstrap > 0 and (args.native == True or args.check == True or bar.validated(home_dir) == True)
+# results of --check runs are those of h4dmc.x
+cache_params = dict(pid=args.pid, native=args.native == True and args.check == False)
+if boot_sig == True :
+    cache_params.update(bootstrap=args.bootstrap, block_length=args.block_length, ci=args.ci, seed=args.seed)
+
+# Determine index from the first solute
+if args.auto_continue == True :
+    mol = next(iter(dict_solutes['mu0']))
+    args.i = tools.auto_sim_index(mol,mol_dir=os.path.join(home_dir,mol),db=state.connect(home_dir))
+# Check that index have been defined
+if args.i == None:
+    sys.exit('No staring index : add manually with -i or automatic determination with -auto')
 
+# List (solute, index) analyses and create inputs of those not in the cache
+tasks = []
+cached = {}
+for mol,mu0 in dict_solutes['mu0'].items():
     mol_dir = os.path.join(home_dir,mol)
+    indices = range(1,args.i+1) if args.evol == True else [args.i]
+    imax = args.i
+    for i in indices:
+        args.i = i
+        sig = None
+        if args.no_cache == False :
+            sig = cache.entry_signature(mol,i,mu0,cache_params,mol_dir,content_hash=args.cache_hash,segments=boot_sig)
+            result = cache.lookup(dict_cache,mol,i,sig)
+            # --check compares the estimators on all pairs
+            if result is not None and args.check == False :
+                cached[(mol,i)] = result
+                continue
+        input_file = 'input-ana-{}'.format(i) if args.evol == True else 'input-ana'
+        if args.native == False or args.check == True :
+            tools.create_analysis_input(args,solute=mol,mu0=mu0,mol_dir=mol_dir,input_file=input_file)
+        tasks.append((mol,i,mu0,mol_dir,input_file,sig))
+    args.i = imax
+
+def analyse(task):
+    ''' Run h4dmc.x analysis for one (solute, index) and collect its HFE '''
+    mol, i, mu0, mol_dir, input_file, sig = task
+    try:
+        output_file = 'out-ana' if args.evol == False else None
+        status, stdout, stderr = tools.run_h4dmc(mol_dir,input_file,output_file=output_file)
+        if status != 0:
+            raise RuntimeError('h4dmc.x exit status {}: {}'.format(status,stderr.strip()[-200:]))
+        nacc, hfe, err = tools.read_hfe(stdout.splitlines())
+        return dict(mol=mol,i=i,nacc=nacc,hfe=hfe+mu0,err=err)
+    except Exception as e:
+        return dict(mol=mol,i=i,error=str(e))
+
+def analyse_native(tasks):
+    ''' BAR from the acc files of all (solute, index) pairs, solved in one batch '''
+    results = [None] * len(tasks)
+    pairs, rows = [], []
+    for n,(mol, i, mu0, mol_dir, input_file, sig) in enumerate(tasks):
+        pair = [os.path.join(mol_dir,'acc_{}_{}{}'.format(mol,kind,i)) for kind in ['ins','des']]
+        missing = [f for f in pair if not archive.restore(f)]
+        if missing:
+            results[n] = dict(mol=mol,i=i,error='missing {}'.format(', '.join(missing)))
+        else:
+            pairs.append(pair)
+            rows.append(n)
+    if pairs:
+        errors = {}
+        dF, err, nacc, T = bar.bar_files(pairs,errors=errors)
+        for k,n in enumerate(rows):
+            mol, i, mu0 = tasks[n][:3]
+            if k in errors:
+                results[n] = dict(mol=mol,i=i,error=errors[k])
+            elif np.isnan(dF[k]):
+                results[n] = dict(mol=mol,i=i,error='empty ins or des distribution')
+            else:
+                kT = bar.kT(T[k])
+                results[n] = dict(mol=mol,i=i,nacc=str(int(nacc[k])),hfe=float(dF[k])*kT+mu0,err='{:.4f}'.format(float(err[k])*kT))
+    return results
+
+# Run analyses
+print('{} analyses to run, {} taken from the cache'.format(len(tasks),len(cached)))
+if args.native == True and args.check == False :
+    with tools.timer('bar',n=len(tasks)) :
+        new_results = analyse_native(tasks)
+else :
+    with tools.timer('analysis',n=len(tasks)) :
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs,1)) as pool:
+            new_results = list(pool.map(analyse,tasks))
+
+# Cross-check Python BAR estimator against h4dmc.x
+if args.check == True :
+    print('name\t index\t HFE(h4dmc)\t HFE(python)\t diff\t err(h4dmc)\t err(python)')
+    compared = []
+    for r,p in zip(new_results,analyse_native(tasks)):
+        if 'error' in r or 'error' in p:
+            print('{}\t {}\t not compared : {}'.format(r['mol'],r['i'],r.get('error',p.get('error'))))
+            continue
+        print('{}\t {}\t {:.4f}\t {:.4f}\t {:.4f}\t {}\t {}'.format(r['mol'],r['i'],r['hfe'],p['hfe'],p['hfe']-r['hfe'],r['err'],p['err']))
+        compared.append((r['mol'],r['i'],r['hfe'],p['hfe']))
+    agree = bar.record_check(home_dir,compared,args.check_tol)
+    print('{} pairs compared : Python estimator {} h4dmc.x within {} kJ/mol (recorded in {})'.format(
+          len(compared),'agrees with' if agree == True else 'does not agree with',args.check_tol,bar.CHECK))
+
+# Block bootstrap over the segments of each solute (one batch of resamples per solute, solutes over -nj threads)
+if args.bootstrap > 0 and args.native == False and bar.validated(home_dir) == False :
+    print('No bootstrap : the Python estimator has not been found in agreement with h4dmc.x (3-analysis.py --check, {})'.format(bar.CHECK))
+elif args.bootstrap > 0 :
+    done = [r for r in new_results if 'error' not in r]
+    with tools.timer('bootstrap',n=len(done)) :
+        boot, failed = bootstrap.bootstrap_results(home_dir,[(r['mol'],r['i']) for r in done],nboot=args.bootstrap,
+                                                   length=args.block_length,level=args.ci,seed=args.seed,jobs=args.jobs)
+    for mol,error in failed.items():
+        print('Bootstrap failed for {} : {}'.format(mol,error))
+    for r in done:
+        b = boot.get((r['mol'],r['i']))
+        if b is not None :
+            mu0 = dict_solutes['mu0'][r['mol']]
+            r.update(ci_lo=b['lo']+mu0, ci_hi=b['hi']+mu0, err_boot=b['err'], ineff=b['ineff'], seg_corr=b['seg_corr'])
+
+for task,r in zip(tasks,new_results):
+    if 'error' in r:
+        print('Analysis failed for {} (index {}) : {}'.format(r['mol'],r['i'],r['error']))
+    else:
+        # results without the bootstrap interval of their signature are not cached, so that the next run computes it
+        if boot_sig == False or 'ci_lo' in r :
+            cache.store(dict_cache,r['mol'],r['i'],task[-1],r,content_hash=args.cache_hash)
+        cached[(r['mol'],r['i'])] = r
+if args.no_cache == False :
+    cache.save_cache(args.cache_file,dict_cache)
+# Remove copies of archived acc files restored for the analyses
+archive.release()
+
+# Results in the order of the solute file and of indices
+results = [cached[k] for k in sorted(cached,key=lambda k: (order[k[0]],k[1]))]
+
+# Append results to the results store
+if args.no_results == False and len(results) > 0 :
+    with tools.timer('output') :
+        db = results_db.connect(args.results_db)
+        config = args.config or results_db.config_name(home_dir,args.results_db)
+        results_db.append(db,config,results,V0=dict_solutes['V0'],mu0=dict_solutes['mu0'])
+        db.close()
+
+# Print single HFE
+if args.evol == False and len(results) > 0 :
+    f1 = open('HFE-{}.csv'.format(results[0]['nacc']),'w')
+    if any('ci_lo' in r for r in results) :
+        f1.write('Name\t HFE\t err\t ci_lo\t ci_hi\t ineff\n')
+        for r in results:
+            f1.write('{}\t {}\t {}\t {:.4f}\t {:.4f}\t {:.2f}\n'.format(r['mol'],r['hfe'],r['err'],*(r.get(k,float('nan')) for k in ['ci_lo','ci_hi','ineff'])))
+    else :
+        f1.write('Name\t HFE\t err\n')
+        for r in results:
+            f1.write('{}\t {}\t {}\n'.format(r['mol'],r['hfe'],r['err']))
+    f1.close()
+
+# Print evolution of HFEs
+if args.evol == True and len(results) > 0 :
+    # Columns are named after the nb of accumulations of the first solute at each index
+    columns = {}
+    for r in results:
+        columns.setdefault(r['i'],r['nacc'])
+    dict_HFE = {}
+    for i in sorted(columns):
+        dict_HFE['HFE-{}'.format(columns[i])] = {}
+        dict_HFE['err-{}'.format(columns[i])] = {}
+    for r in results:
+        dict_HFE['HFE-{}'.format(columns[r['i']])][r['mol']] = r['hfe']
+        dict_HFE['err-{}'.format(columns[r['i']])][r['mol']] = r['err']
 
-    # Determine index
-    if j == 0 :
-        # if auto continuation determine starting index
-        if args.auto_continue == True :
-            args.i = tools.auto_sim_index(mol,mol_dir=mol_dir)            
-        # Check that index have been defined
-        if args.i == None:
-            print('No staring index : add manually with -i or automatic determination with -auto')
-
-    # Print single HFE
-    if args.evol == False :
-        # Create input-ana
-        tools.create_analysis_input(args,solute=mol,mu0=mu0,mol_dir=mol_dir)
-        # Run analysis
-        os.system("cd {0}; pwd; ./h4dmc.x < input-ana > out-ana; cd ..".format(mol_dir))
-        out_file = os.path.join(mol_dir,'out-ana')
-        
-        # Collect HFE from out-ana
-        with open(out_file,'r') as f :
-            lines = f.readlines()
-            for index,line in enumerate(lines):
-                # Create output file
-                if 'Nombre d\'accumulations' in line :
-                    nacc = lines[index].split()[-1]
-                if 'BAR' in line :
-                    hfe=float(lines[index+9].split()[1]) + mu0
-                    err=lines[index+9].split()[2]
-        if j == 0 :
-            f1 = open('HFE-{}.csv'.format(nacc),'w')
-            f1.write('Name\t HFE\t err\n')
-            j = 100
-        f1.write('{}\t {}\t {}\n'.format(mol,hfe,err))
-
-    # Print evolution of HFEs
-    if args.evol == True :
-        imax = args.i
-        for i in range(1,imax+1):
-            args.i = i
-            # Create input-ana
-            tools.create_analysis_input(args,solute=mol,mu0=mu0,mol_dir=mol_dir)
-            # Run analysis
-            os.system("cd {0}; pwd; ./h4dmc.x < input-ana > out-ana; cd ..".format(mol_dir))
-            out_file = os.path.join(mol_dir,'out-ana')
-            
-            # Collect HFE from out-ana
-            with open(out_file,'r') as f :
-                lines = f.readlines()
-                for index,line in enumerate(lines):
-                    # Create output file
-                    if 'Nombre d\'accumulations' in line :
-                        nacc = lines[index].split()[-1]
-                    if 'BAR' in line :
-                        hfe=lines[index+9].split()[1]
-                        err=lines[index+9].split()[2]
-            if j == 0 :
-                dict_HFE['HFE-{}'.format(nacc)] = {}
-                dict_HFE['err-{}'.format(nacc)] = {}
-
-            dict_HFE['HFE-{}'.format(nacc)][mol] = float(hfe) + mu0
-            dict_HFE['err-{}'.format(nacc)][mol] = err
-        
-        j = 100
-
-if args.evol == True :
     # json file
     with open('HFE_evol.json', 'w') as fp:
         json.dump(dict_HFE, fp)
@@ -143,9 +314,12 @@ if args.evol == True :
     for k in dict_HFE.keys():
         f2.write('{}\t'.format(k))
     f2.write('\n')
-    
-    for mol in dict_HFE['HFE-{}'.format(nacc)].keys():
+
+    for mol in dict_solutes['mu0'].keys():
+        if not any(mol in v for v in dict_HFE.values()):
+            continue
         f2.write('{}\t'.format(mol))
         for k in dict_HFE.keys():
-            f2.write('{:.4f}\t'.format(float(dict_HFE[k][mol])))
+            f2.write('{:.4f}\t'.format(float(dict_HFE[k].get(mol,'nan'))))
         f2.write('\n')
+    f2.close()
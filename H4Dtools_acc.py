@@ -0,0 +1,193 @@
+import os
+import re
+import sys
+import zipfile
+import numpy as np
+
+"""
+
+Reader for h4dmc.x accumulation files (acc_*)
+
+    An acc_ file is a list of named sections (parametres, iacc OO, OH, HH, iacc alp, en q, en angles,
+    pour le solute, iacc solute-O, iacc solute-H, en dH, intra flexible). Inside a section, consecutive
+    lines with the same number of values form a block, stored as a 2D array (nrows x ncols),
+    a 1D array (single value per line or single line) or an array of strings (file names).
+
+    Arrays are named '{section}.{k}' with section in SECTIONS and k the block number inside the section,
+    e.g. 'en_dH.1' is the energy histogram and 'iacc_solute_O.0' the solute-O histogram.
+
+    read_acc() parses the text once and writes a binary sidecar acc_*.npz (stored uncompressed)
+    next to the file. Later reads use the sidecar and memory-map its arrays as long as the size
+    and mtime of the text file did not change.
+
+"""
+
+SECTIONS = ['parametres', 'iacc OO, OH, HH', 'iacc alp', 'en q', 'en angles', 'pour le solute',
+            'iacc solute-O', 'iacc solute-H', 'en dH', 'intra flexible']
+
+# Position of named values in the parametres section, as printed by h4dmc.x
+HEADER = dict(N=0, T=1, P=2, sig=3, eps=4, l=6, ang=7, qH=8, KL=9, eps0=12, mnmax=13, nr=14, dr=15, niter=16, nacc=17)
+
+SIDECAR = '.npz'
+_fortran_exp = re.compile(r'(\d)([+-]\d{3})')
+
+
+def section_name(title):
+    ''' Array name prefix of a section title : 'iacc OO, OH, HH' --> 'iacc_OO_OH_HH' '''
+    return re.sub(r'[^0-9A-Za-z]+','_',title).strip('_')
+
+
+def _to_array(lines,ncols):
+    ''' Convert a block of text lines into a float array '''
+    text = ' '.join(lines)
+    try:
+        values = np.array(text.split(), dtype=np.float64)
+    except ValueError:
+        # Fortran drops the E of 3 digit exponents (1.0-100)
+        values = np.array(_fortran_exp.sub(r'\1E\2',text).split(), dtype=np.float64)
+    if ncols == 1 or len(lines) == 1:
+        return values
+    return values.reshape(len(lines),ncols)
+
+
+def _is_number(token):
+    try:
+        float(_fortran_exp.sub(r'\1E\2',token))
+        return True
+    except ValueError:
+        return False
+
+
+def iter_blocks(lines):
+    ''' Blocks of the lines of an acc_ file
+        Output : (section, block number, line numbers, nb of columns, strings) for each block '''
+
+    section, nblock = None, 0
+    block, ncols, strings = [], None, False
+    for n,line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped in SECTIONS:
+            if block and section is not None:
+                yield section, nblock, block, ncols, strings
+                nblock += 1
+            block, ncols, strings = [], None, False
+            section, nblock = stripped, 0
+            continue
+        tokens = stripped.split()
+        if not _is_number(tokens[0]):
+            # file names (solute .in / .top) inside a section
+            if not strings:
+                if block and section is not None:
+                    yield section, nblock, block, ncols, strings
+                    nblock += 1
+                block, ncols, strings = [], None, True
+            block.append(n)
+            continue
+        if strings or len(tokens) != ncols:
+            if block and section is not None:
+                yield section, nblock, block, ncols, strings
+                nblock += 1
+            block, ncols, strings = [], len(tokens), False
+        block.append(n)
+    if block and section is not None:
+        yield section, nblock, block, ncols, strings
+
+
+def parse_acc(file):
+    ''' Parse an acc_ text file in one pass
+        Output : dict of named arrays '''
+
+    with open(file,'r') as f:
+        lines = f.read().split('\n')
+    data = {}
+    for section, nblock, block, ncols, strings in iter_blocks(lines):
+        text = [lines[n].strip() for n in block]
+        data['{}.{}'.format(section_name(section),nblock)] = np.array(text) if strings else _to_array(text,ncols)
+    return data
+
+
+def header(data):
+    ''' Named values of the parametres section (N, T, P, nr, dr, nacc, ...) '''
+    values = np.concatenate([np.atleast_1d(data[k]).ravel() for k in section_keys(data,'parametres')])
+    return {k: values[i] for k,i in HEADER.items() if i < len(values)}
+
+
+def section_keys(data,title):
+    ''' Names of the arrays of a section, in file order '''
+    prefix = section_name(title) + '.'
+    keys = [k for k in data if k.startswith(prefix)]
+    return sorted(keys,key=lambda k: int(k[len(prefix):]))
+
+
+def table(data,title):
+    ''' Largest array of a section (the histogram for iacc sections) '''
+    return max((data[k] for k in section_keys(data,title)),key=lambda a: a.size)
+
+
+def _signature(file):
+    st = os.stat(file)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+def write_sidecar(file,data):
+    ''' Save arrays of acc file to file.npz (uncompressed, so that arrays can be memory-mapped) '''
+    tmp = file + SIDECAR + '.tmp'
+    with open(tmp,'wb') as f:
+        np.savez(f, __source__=_signature(file), **data)
+    os.replace(tmp,file + SIDECAR)
+
+
+def load_sidecar(file,mmap=True):
+    ''' Load arrays from file.npz, None if the sidecar is missing or older than the text file '''
+    sidecar = file + SIDECAR
+    if not os.path.isfile(sidecar):
+        return None
+    data = {}
+    with zipfile.ZipFile(sidecar) as z, open(sidecar,'rb') as f:
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')]
+            # skip local file header to reach the .npy member
+            f.seek(info.header_offset + 26)
+            nname, nextra = [int(n) for n in np.frombuffer(f.read(4),dtype='<u2')]
+            f.seek(info.header_offset + 30 + nname + nextra)
+            version = np.lib.format.read_magic(f)
+            if version == (1,0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if mmap and dtype.itemsize > 0 and int(np.prod(shape)) > 0:
+                data[name] = np.memmap(sidecar, dtype=dtype, mode='r', shape=shape,
+                                       order='F' if fortran else 'C', offset=f.tell())
+            else:
+                data[name] = np.lib.format.read_array(f)
+    source = data.pop('__source__',None)
+    if source is None or not np.array_equal(source,_signature(file)):
+        return None
+    return data
+
+
+def read_acc(file,use_sidecar=True,mmap=True):
+    ''' Read acc file from its sidecar if up to date, otherwise parse the text and write the sidecar
+        Output : dict of named arrays '''
+    if use_sidecar:
+        data = load_sidecar(file,mmap=mmap)
+        if data is not None:
+            return data
+    data = parse_acc(file)
+    if use_sidecar:
+        try:
+            write_sidecar(file,data)
+        except OSError as e:
+            print('Cannot write sidecar for {} : {}'.format(file,e))
+    return data
+
+
+if __name__ == "__main__":
+    # Build sidecars and print the content of acc files given on the command line
+    for file in sys.argv[1:]:
+        data = read_acc(file)
+        print(file)
+        for k,v in data.items():
+            print('    {:24s} {:10s} {}'.format(k,str(v.dtype),v.shape))
@@ -0,0 +1,150 @@
+import os
+import math
+import numpy as np
+import H4Dtools_acc as acc
+import H4Dtools_bar as bar
+import H4Dtools_cache as cache
+import H4Dtools_archive as archive
+
+"""
+
+Convergence driven accumulation (2-production.py --target_err) and split of accumulations between
+insertions and destructions (2-production.py --variance_split)
+
+    The BAR error of each solute is the h4dmc.x error of its analysis at the latest index reached by
+    both directions, as cached by 3-analysis.py (HFE_cache.json). In campaigns where 3-analysis.py
+    --check found the Python estimator in agreement with h4dmc.x (bar-check.json), it is instead
+    computed from the ins/des histograms of the latest file of each direction (as 3-analysis.py
+    -native), with the variance components of both directions. Nb of samples are the accumulations
+    of the files. As the error decreases as 1/sqrt(nacc), a solute with error err after nacc
+    accumulations needs nacc*((err/target)^2 - 1) more accumulations to reach the target error :
+        err <= target : solute converged, no more runs
+        otherwise     : accumulations of the next segment = that estimate, between nacc_min and nacc_max
+    Solutes are submitted by decreasing error. With a budget (core-hours) and a cost per solute,
+    solutes are accepted in that order until the budget is spent, the last one with fewer accumulations.
+
+    Variance split : err**2 = a/n_ins + c/n_des, with a and c the variances per sample of both
+    directions (from the BAR variance components, Python estimator only). For a cost t_ins / t_des of one accumulation,
+    the error per CPU time is minimal for n_ins/n_des = sqrt(a t_des / (c t_ins)). Totals reaching
+    the target are
+        n_ins = sqrt(a/t_ins) (sqrt(a t_ins) + sqrt(c t_des)) / target**2  (and the same for des)
+    and without a target the cost of nacc ins + nacc des accumulations is shared in that ratio.
+    A direction that already has enough samples gets nacc_min accumulations in the segment (at least 1,
+    even with nacc_min 0), so that ins and des files keep the same indices (analyses pair acc_ins{i}
+    with acc_des{i}).
+
+"""
+
+STAGES = ['ins','des']
+
+
+def latest_errors(home_dir,index,native=False,cache_file='HFE_cache.json'):
+    ''' BAR error (kT) of solutes at their latest indices {solute: dict(ins, des)}
+        native : Python estimator on the latest file of each direction, solved in one batch, with the
+                 ins/des variance components ; otherwise h4dmc.x error cached by 3-analysis.py at the
+                 index reached by both directions (no variance components)
+        Output : {solute: dict(err, var_ins, var_des, n_ins, n_des)}, n in accumulations,
+                 nan error for solutes without files (or without an up to date analysis) '''
+    errors = {mol: dict(err=np.nan, var_ins=np.nan, var_des=np.nan, n_ins=0, n_des=0) for mol in index}
+    if native == False:
+        dict_cache = cache.load_cache(os.path.join(home_dir,cache_file))
+        for mol,i in index.items():
+            if None in i.values():
+                continue
+            i = min(i['ins'],i['des'])
+            mol_dir = os.path.join(home_dir,mol)
+            r = cache.cached_result(dict_cache,mol,i,mol_dir) if i >= 0 else None
+            if r is None or r.get('nacc') is None:
+                continue
+            file = os.path.join(mol_dir,'acc_{}_ins{}'.format(mol,i))
+            restored = not os.path.isfile(file)
+            if not archive.restore(file):
+                continue
+            T = float(acc.header(acc.read_acc(file))['T'])
+            if restored:
+                archive.release([file])
+            errors[mol].update(err=float(r['err'])/bar.kT(T), n_ins=int(r['nacc']), n_des=int(r['nacc']))
+        return errors
+    pairs, mols = [], []
+    for mol,i in index.items():
+        files = [os.path.join(home_dir,mol,'acc_{}_{}{}'.format(mol,stage,i[stage])) for stage in STAGES]
+        if None not in i.values() and min(i.values()) >= 0 and all(os.path.isfile(f) for f in files):
+            pairs.append(tuple(files))
+            mols.append(mol)
+    if pairs:
+        res = bar.bar_variances(pairs)
+        for k,mol in enumerate(mols):
+            errors[mol] = dict(zip(['err','var_ins','var_des','n_ins','n_des'],(float(r[k]) for r in res[1:])))
+    return errors
+
+
+def needed_accumulations(err,nacc,target):
+    ''' Accumulations still needed to reach target error (0 if converged, None if unknown) '''
+    if math.isnan(err) or nacc <= 0:
+        return None
+    if err <= target:
+        return 0
+    return int(math.ceil(nacc * ((err/target)**2 - 1)))
+
+
+def split(e,nacc,target=None,unit_cost=None):
+    ''' Accumulations {ins, des} of the next segment minimising the error per CPU time
+        e : dict(err, var_ins, var_des, n_ins, n_des), unit_cost : dict(ins, des) cost of one accumulation '''
+    t = unit_cost or dict(ins=1.0, des=1.0)
+    a, c = e['var_ins']*e['n_ins'], e['var_des']*e['n_des']
+    s = math.sqrt(a*t['ins']) + math.sqrt(c*t['des'])
+    if target is None:
+        total = nacc * (t['ins'] + t['des'])
+        return dict(ins=total*math.sqrt(a/t['ins'])/s, des=total*math.sqrt(c/t['des'])/s)
+    return dict(ins=math.sqrt(a/t['ins'])*s/target**2 - e['n_ins'], des=math.sqrt(c/t['des'])*s/target**2 - e['n_des'])
+
+
+def plan_solute(e,target,nacc,nacc_min,nacc_max,unit_cost=None,variance_split=False):
+    ''' Accumulations {ins, des} of the next segment of a solute, None if converged '''
+    if math.isnan(e['err']) or e['n_ins'] <= 0 or e['n_des'] <= 0:
+        return dict(ins=nacc, des=nacc)
+    if target is not None and e['err'] <= target:
+        return None
+    # both directions run in every segment
+    nacc_min = max(nacc_min,1)
+    if variance_split and e['var_ins'] > 0 and e['var_des'] > 0:
+        n = split(e,nacc,target,unit_cost)
+        if max(n.values()) > 0:
+            return {stage: int(min(max(math.ceil(n[stage]),nacc_min),nacc_max)) for stage in STAGES}
+    n = nacc if target is None else needed_accumulations(e['err'],min(e['n_ins'],e['n_des']),target)
+    n = min(max(n,nacc_min),nacc_max)
+    return dict(ins=n, des=n)
+
+
+def allocate(errors,target,nacc,nacc_min,nacc_max,cost=None,budget=None,unit_cost=None,variance_split=False):
+    ''' Accumulations of the next segment per solute
+        errors : {solute: latest_errors dict}, nacc : default for solutes with unknown error
+        cost(solute, n) : core-hours of a segment of n = {ins, des} accumulations, budget : total core-hours
+        unit_cost(solute) : {ins, des} cost of one accumulation for the variance split
+        Output : [(solute, {ins, des})] by decreasing error, [converged solutes] '''
+
+    plan, converged = [], []
+    # unknown errors first, then by decreasing error
+    for mol in sorted(errors,key=lambda m: -errors[m]['err'] if not math.isnan(errors[m]['err']) else -math.inf):
+        n = plan_solute(errors[mol],target,nacc,nacc_min,nacc_max,
+                        unit_cost=unit_cost(mol) if unit_cost and variance_split else None,variance_split=variance_split)
+        if n is None:
+            converged.append(mol)
+        else:
+            plan.append((mol,n))
+
+    if budget is None or cost is None:
+        return plan, converged
+    accepted, spent = [], 0.0
+    for mol,n in plan:
+        c = cost(mol,n)
+        if spent + c > budget:
+            # fewer accumulations for the last solute if at least nacc_min fit in the budget
+            f = (budget - spent) / c
+            n = {stage: int(n[stage]*f) for stage in STAGES}
+            if max(n.values()) >= nacc_min:
+                accepted.append((mol,{stage: max(n[stage],nacc_min,1) for stage in STAGES}))
+            break
+        accepted.append((mol,n))
+        spent += c
+    return accepted, converged
@@ -0,0 +1,233 @@
+import os
+import re
+import lzma
+import argparse
+import concurrent.futures
+import H4Dtools_state as state
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+
+Compressed archive of old acc_/r_ segment files of solute directories
+
+    acc_{solute}_{ins|des|s}{i} and r_ files are text files made mostly of runs of 0.0000000000000000,
+    which xz (LZMA, standard library) or zstd (zstandard package, if installed) compress to a few percent
+    of their size. Old segments are replaced by {name}.xz (or .zst) next to them, with the mtime of the
+    original file, under a retention policy : index 0 (starting files of the chains) and the latest
+    --keep indices of ins, des and s are left uncompressed.
+
+    Archived files count as present for the campaign state (-auto continuation), and are restored
+    transparently where they are read : create_*_input when a run loads an archived index, 3-analysis.py
+    and 3-analysis-structure.py. Restored copies keep the mtime of the archive, which is kept : analyses
+    remove their restored copies when they are done (release), and archiving a restored copy that did
+    not change only removes it. Analysis cache signatures of archived files are those of the archive,
+    so that restoring does not invalidate the cache.
+
+    python H4Dtools_archive.py archive -s solutes.csv -k 2
+    python H4Dtools_archive.py restore -s solutes.csv -i 3
+    python H4Dtools_archive.py status -s solutes.csv
+
+"""
+
+CODECS = dict(xz='.xz', zst='.zst')
+CHUNK = 1 << 20
+_restored = []
+
+
+def _pattern(solute):
+    return re.compile(r'^(acc|r)_{}_(ins|des|s)(\d+)(\.xz|\.zst)?$'.format(re.escape(solute)))
+
+
+def _writer(codec,f,level):
+    if codec == 'xz':
+        return lzma.open(f,'wb',preset=6 if level is None else level)
+    if zstandard is None:
+        raise RuntimeError('zst archives need the zstandard package (pip install zstandard)')
+    return zstandard.ZstdCompressor(level=19 if level is None else level).stream_writer(f,closefd=False)
+
+
+def _reader(path):
+    if path.endswith('.xz'):
+        return lzma.open(path,'rb')
+    if zstandard is None:
+        raise RuntimeError('{} : zst archives need the zstandard package (pip install zstandard)'.format(path))
+    return zstandard.ZstdDecompressor().stream_reader(open(path,'rb'),closefd=True)
+
+
+def archived(path):
+    ''' Archive of a file (None if it is not archived) '''
+    for ext in CODECS.values():
+        if os.path.isfile(path + ext):
+            return path + ext
+    return None
+
+
+def signature_path(path):
+    ''' File standing for path in signatures : its archive if it is archived and the file is missing or
+        an unchanged restored copy, the file itself otherwise (None if neither exists) '''
+    archive = archived(path)
+    if archive is None:
+        return path if os.path.isfile(path) else None
+    if not os.path.isfile(path) or os.stat(path).st_mtime_ns == os.stat(archive).st_mtime_ns:
+        return archive
+    return path
+
+
+def compress(path,codec='xz',level=None):
+    ''' Replace a file by its archive, with the same mtime
+        Output : (bytes before, bytes after) '''
+    archive = archived(path)
+    st = os.stat(path)
+    if archive is not None and os.stat(archive).st_mtime_ns == st.st_mtime_ns:
+        # restored copy that did not change
+        os.remove(path)
+        return st.st_size, os.stat(archive).st_size
+    archive = path + CODECS[codec]
+    tmp = archive + '.tmp'
+    with open(path,'rb') as fin, open(tmp,'wb') as f:
+        with _writer(codec,f,level) as fout:
+            for block in iter(lambda: fin.read(CHUNK), b''):
+                fout.write(block)
+    os.utime(tmp,ns=(st.st_atime_ns,st.st_mtime_ns))
+    os.replace(tmp,archive)
+    for ext in CODECS.values():
+        if path + ext != archive and os.path.isfile(path + ext):
+            os.remove(path + ext)
+    os.remove(path)
+    return st.st_size, os.stat(archive).st_size
+
+
+def restore(path):
+    ''' Make sure a file is present, restoring it from its archive if needed
+        Output : True if the file is present '''
+    if os.path.isfile(path):
+        return True
+    archive = archived(path)
+    if archive is None:
+        return False
+    tmp = path + '.restore.tmp'
+    with _reader(archive) as fin, open(tmp,'wb') as fout:
+        for block in iter(lambda: fin.read(CHUNK), b''):
+            fout.write(block)
+    st = os.stat(archive)
+    os.utime(tmp,ns=(st.st_atime_ns,st.st_mtime_ns))
+    os.replace(tmp,path)
+    _restored.append(path)
+    return True
+
+
+def restore_run(mol_dir,name):
+    ''' Restore acc_{name} and r_{name} loaded by a run
+        Output : True if acc_{name} is present '''
+    restore(os.path.join(mol_dir,'r_' + name))
+    return restore(os.path.join(mol_dir,'acc_' + name))
+
+
+def release(paths=None):
+    ''' Remove copies restored by this process (or paths) that did not change since
+        Output : nb of removed copies '''
+    removed = 0
+    for path in list(_restored if paths is None else paths):
+        archive = archived(path)
+        if archive is not None and os.path.isfile(path) and os.stat(path).st_mtime_ns == os.stat(archive).st_mtime_ns:
+            os.remove(path)
+            removed += 1
+    if paths is None:
+        _restored.clear()
+    return removed
+
+
+def old_files(mol_dir,solute,keep=1):
+    ''' Uncompressed acc_/r_ files of a solute directory outside the retention policy
+        (index 0 and the latest keep indices of each kind are kept) '''
+    pattern = _pattern(solute)
+    found = {kind: set() for kind in state.KINDS}
+    plain = []
+    with os.scandir(mol_dir) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match:
+                found[match.group(2)].add(int(match.group(3)))
+                if match.group(4) is None:
+                    plain.append((entry.name,match.group(2),int(match.group(3))))
+    latest = {kind: max(found[kind]) if found[kind] else -1 for kind in state.KINDS}
+    return sorted(name for name,kind,i in plain if 0 < i <= latest[kind] - max(keep,1))
+
+
+def archive_solute(mol_dir,solute,keep=1,codec='xz',level=None):
+    ''' Archive old segment files of a solute
+        Output : (nb of files, bytes before, bytes after) '''
+    n, before, after = 0, 0, 0
+    for name in old_files(mol_dir,solute,keep):
+        b, a = compress(os.path.join(mol_dir,name),codec,level)
+        n, before, after = n + 1, before + b, after + a
+    return n, before, after
+
+
+def usage(mol_dir,solute):
+    ''' (nb of files, bytes) of uncompressed and archived acc_/r_ files of a solute '''
+    pattern = _pattern(solute)
+    out = dict(plain=[0,0], archived=[0,0])
+    with os.scandir(mol_dir) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match:
+                kind = 'plain' if match.group(4) is None else 'archived'
+                out[kind][0] += 1
+                out[kind][1] += entry.stat().st_size
+    return out
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compressed archive of old acc_/r_ segment files")
+    parser.add_argument('command', choices=['archive','restore','release','status'], help="archive old segments, restore or release (remove unchanged restored copies of) archived ones, or print disk usage")
+    parser.add_argument('-s','--solutes', help="File containing solute's names (default: solutes in campaign-state.db)" )
+    parser.add_argument('-k','--keep', type=int, default=2, help="latest indices of ins, des and s left uncompressed, at least 1 (default: %(default)s)" )
+    parser.add_argument('-c','--codec', choices=list(CODECS), default='xz', help="compression, zst needs the zstandard package (default: %(default)s)" )
+    parser.add_argument('-l','--level', type=int, help="compression level (default: 6 for xz, 19 for zst)" )
+    parser.add_argument('-i', type=int, nargs='+', help="indices to restore (default: all)" )
+    parser.add_argument('-nj','--jobs', type=int, default=os.cpu_count() or 1, help="solute directories processed in parallel (default: %(default)s)" )
+    args = parser.parse_args()
+
+    home_dir = os.getcwd()
+    db = state.connect(home_dir)
+    solutes = state.read_solutes(args.solutes) if args.solutes else [r[0] for r in db.execute('SELECT solute FROM solutes ORDER BY solute')]
+    solutes = [mol for mol in solutes if os.path.isdir(os.path.join(home_dir,mol))]
+
+    def restore_solute(mol):
+        mol_dir = os.path.join(home_dir,mol)
+        pattern = _pattern(mol)
+        names = [m.group(0)[:-len(m.group(4))] for m in map(pattern.match,os.listdir(mol_dir))
+                 if m and m.group(4) and (args.i is None or int(m.group(3)) in args.i)]
+        return sum(1 for name in names if not os.path.isfile(os.path.join(mol_dir,name)) and restore(os.path.join(mol_dir,name)))
+
+    def release_solute(mol):
+        mol_dir = os.path.join(home_dir,mol)
+        pattern = _pattern(mol)
+        return release([os.path.join(mol_dir,name) for name in os.listdir(mol_dir) if pattern.match(name) and pattern.match(name).group(4) is None])
+
+    if args.command == 'status':
+        total = dict(plain=[0,0], archived=[0,0])
+        print('solute\tplain\tsize(MB)\tarchived\tsize(MB)')
+        for mol in solutes:
+            u = usage(os.path.join(home_dir,mol),mol)
+            print('{}\t{}\t{:.1f}\t{}\t{:.1f}'.format(mol,u['plain'][0],u['plain'][1]/1e6,u['archived'][0],u['archived'][1]/1e6))
+            for kind in total:
+                total[kind] = [a + b for a,b in zip(total[kind],u[kind])]
+        print('total\t{}\t{:.1f}\t{}\t{:.1f}'.format(total['plain'][0],total['plain'][1]/1e6,total['archived'][0],total['archived'][1]/1e6))
+    else:
+        work = dict(archive=lambda mol: archive_solute(os.path.join(home_dir,mol),mol,args.keep,args.codec,args.level),
+                    restore=restore_solute, release=release_solute)[args.command]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs,1)) as pool:
+            results = list(pool.map(work,solutes))
+        if args.command == 'archive':
+            n, before, after = [sum(r[k] for r in results) for k in range(3)]
+            print('{} files archived : {:.1f} MB --> {:.1f} MB'.format(n,before/1e6,after/1e6))
+        else:
+            print('{} files {}d'.format(sum(results),args.command))
+        state.refresh(db,home_dir,solutes)
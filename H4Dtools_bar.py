@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import numpy as np
+import H4Dtools_acc as acc
+
+"""
+
+Bennett acceptance ratio (BAR) estimator over the insertion / destruction energy histograms
+('en dH' section) of acc_{solute}_ins{i} / acc_{solute}_des{i} files.
+
+    Histograms of all (solute, index) pairs are put on a common energy grid x (in kT) and solved
+    together : rows are pairs, columns are energy bins, and the root of the BAR equation is found
+    for all rows at once by a safeguarded Newton iteration.
+
+    With f(x) = 1/(1+exp(x)), M = ln(n_ins/n_des) and dF the free energy (in kT), BAR reads
+        sum_ins h_ins(u) f(M + u - dF) = sum_des h_des(u) f(dF - M - u)
+    where u is the insertion energy and the destruction histogram holds the energy of the
+    solute to be removed (des_sign=-1 if it holds the destruction work instead).
+
+    These conventions (sign of the destruction histogram, 'en dH' grid centred on 0 without the
+    mu0 / V0 shift of the analysis deck, histograms normalised to 1 counted as nacc samples) are
+    read from the acc files and not from h4dmc.x itself : 3-analysis.py --check compares both
+    estimators on all (solute, index) pairs and records the comparison in bar-check.json.
+    Uses of the estimator instead of h4dmc.x outside 3-analysis.py -native (adaptive errors,
+    bootstrap intervals) are only made in campaigns where that comparison agreed (validated).
+
+"""
+
+CHECK = 'bar-check.json'
+
+def fermi(x):
+    ''' 1/(1+exp(x)), without overflow '''
+    return 0.5 * (1 - np.tanh(0.5*x))
+
+
+def read_histogram(file):
+    ''' Energy histogram of an acc file
+        Output : (dH, hist, nacc, T) '''
+    data = acc.read_acc(file)
+    dH = float(data['en_dH.0'][0])
+    hist = np.asarray(data['en_dH.1'],dtype=np.float64)
+    head = acc.header(data)
+    return dH, hist, float(head.get('nacc',0)), float(head['T'])
+
+
+def stack_histograms(histograms):
+    ''' Put histograms [(dH, hist, nacc, T), ...] centred on 0 on a common grid
+        Output : x (K), h (M x K), nacc (M) '''
+    dH = histograms[0][0]
+    for h in histograms:
+        if not np.isclose(h[0],dH):
+            raise ValueError('histograms with different bin sizes : {} and {}'.format(dH,h[0]))
+    n = max((len(h[1])-1)//2 for h in histograms)
+    x = dH * np.arange(-n,n+1)
+    stack = np.zeros((len(histograms),2*n+1))
+    for row,h in enumerate(histograms):
+        m = (len(h[1])-1)//2
+        stack[row,n-m:n+m+1] = h[1]
+    return x, stack, np.array([h[2] for h in histograms])
+
+
+def counts(h,nacc):
+    ''' Nb of samples of each histogram, nacc when histograms are normalised '''
+    n = h.sum(axis=1)
+    return np.where((n <= 1 + 1e-6) & (nacc > 0), nacc, n)
+
+
+def solve_bar(x,h_ins,h_des,n_ins=None,n_des=None,des_sign=1,tol=1e-10,maxiter=100,components=False):
+    ''' Solve BAR for all rows of h_ins / h_des (M x K) on energy grid x (K or M x K)
+        Output : dF, err (M), in kT ; nan for rows with an empty histogram
+                 (+ var_ins, var_des contributions to err**2 if components) '''
+
+    x = np.broadcast_to(x,h_ins.shape)
+    u_des = x if des_sign == 1 else -x
+    n_ins = h_ins.sum(axis=1) if n_ins is None else np.asarray(n_ins,dtype=np.float64)
+    n_des = h_des.sum(axis=1) if n_des is None else np.asarray(n_des,dtype=np.float64)
+    ok = (n_ins > 0) & (n_des > 0)
+    # normalised weights
+    w_ins = h_ins / np.where(h_ins.sum(axis=1) > 0, h_ins.sum(axis=1), 1)[:,None]
+    w_des = h_des / np.where(h_des.sum(axis=1) > 0, h_des.sum(axis=1), 1)[:,None]
+    M = np.log(np.where(ok, n_ins/np.where(ok,n_des,1), 1))[:,None]
+
+    def g(dF):
+        f_ins = fermi(M + x - dF[:,None])
+        f_des = fermi(dF[:,None] - M - u_des)
+        val = n_ins*(w_ins*f_ins).sum(axis=1) - n_des*(w_des*f_des).sum(axis=1)
+        der = n_ins*(w_ins*f_ins*(1-f_ins)).sum(axis=1) + n_des*(w_des*f_des*(1-f_des)).sum(axis=1)
+        return val, der
+
+    # Bracket : g is increasing in dF
+    lo = np.full(len(ok), x.min() - 50.0) - np.abs(M[:,0])
+    hi = np.full(len(ok), x.max() + 50.0) + np.abs(M[:,0])
+    dF = 0.5*(lo + hi)
+    for it in range(maxiter):
+        val, der = g(dF)
+        lo = np.where(val < 0, dF, lo)
+        hi = np.where(val > 0, dF, hi)
+        step = np.where(der > 0, val/np.where(der > 0, der, 1), np.inf)
+        new = dF - step
+        # bisection when Newton leaves the bracket
+        new = np.where((new > lo) & (new < hi), new, 0.5*(lo + hi))
+        done = np.abs(new - dF) < tol
+        dF = new
+        if np.all(done | ~ok):
+            break
+
+    var_ins, var_des = variance_components(x,w_ins,w_des,n_ins,n_des,dF,M,u_des)
+    err = np.sqrt(var_ins + var_des)
+    if components:
+        return np.where(ok, dF, np.nan), np.where(ok, err, np.nan), np.where(ok, var_ins, np.nan), np.where(ok, var_des, np.nan)
+    return np.where(ok, dF, np.nan), np.where(ok, err, np.nan)
+
+
+def variance_components(x,w_ins,w_des,n_ins,n_des,dF,M,u_des):
+    ''' Contributions of insertions and destructions to the asymptotic BAR variance of dF
+        var = (<f^2>/<f>^2 - 1)/n on each side '''
+    f_ins = fermi(M + x - dF[:,None])
+    f_des = fermi(dF[:,None] - M - u_des)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        var_ins = ((w_ins*f_ins**2).sum(axis=1) / (w_ins*f_ins).sum(axis=1)**2 - 1) / n_ins
+        var_des = ((w_des*f_des**2).sum(axis=1) / (w_des*f_des).sum(axis=1)**2 - 1) / n_des
+    return var_ins, var_des
+
+
+def _read_pair(pair):
+    h = [read_histogram(f) for f in pair]
+    if not np.isclose(h[0][0],h[1][0]):
+        raise ValueError('ins and des histograms with different bin sizes : {} and {}'.format(h[0][0],h[1][0]))
+    return h
+
+
+def _batch(pairs,des_sign,components):
+    ''' Solve pairs in one batch per bin size, a pair that cannot be read or solved failing alone
+        Output : results (nan for failed pairs), nacc of ins and des files, T of ins files, n_ins, n_des, errors {row: message} '''
+    M = len(pairs)
+    res = [np.full(M,np.nan) for k in range(4 if components else 2)]
+    nacc, T, n_ins, n_des = np.zeros((2,M)), np.full(M,np.nan), np.zeros(M), np.zeros(M)
+    hist, groups, errors = {}, {}, {}
+    for row,pair in enumerate(pairs):
+        try:
+            hist[row] = _read_pair(pair)
+        except Exception as e:
+            errors[row] = str(e)
+            continue
+        groups.setdefault(round(hist[row][0][0],12),[]).append(row)
+    for rows in groups.values():
+        try:
+            x, h, nacc_g = stack_histograms([h for row in rows for h in hist[row]])
+            h_ins, h_des = h[0::2], h[1::2]
+            n_ins_g, n_des_g = counts(h_ins,nacc_g[0::2]), counts(h_des,nacc_g[1::2])
+            # drop bins empty for every pair
+            used = (h_ins > 0).any(axis=0) | (h_des > 0).any(axis=0)
+            if not used.any():
+                used[:] = True
+            out = solve_bar(x[used],h_ins[:,used],h_des[:,used],n_ins=n_ins_g,n_des=n_des_g,des_sign=des_sign,components=components)
+        except Exception as e:
+            errors.update({row: str(e) for row in rows})
+            continue
+        for r,o in zip(res,out):
+            r[rows] = o
+        nacc[0,rows], nacc[1,rows], n_ins[rows], n_des[rows] = nacc_g[0::2], nacc_g[1::2], n_ins_g, n_des_g
+        T[rows] = [hist[row][0][3] for row in rows]
+    return res, nacc, T, n_ins, n_des, errors
+
+
+def bar_files(pairs,des_sign=1,errors=None):
+    ''' BAR for a list of (acc_ins, acc_des) files, solved in one batch (per bin size)
+        Output : dF, err (in kT), nacc and T (of ins files), nan for pairs that failed
+                 (with their messages in errors {row: message} if given) '''
+    (dF, err), nacc, T, n_ins, n_des, failed = _batch(pairs,des_sign,False)
+    if errors is not None:
+        errors.update(failed)
+    return dF, err, nacc[0], T
+
+
+def bar_variances(pairs,des_sign=1,errors=None):
+    ''' Contributions of insertions and destructions to the BAR variance for a list of (acc_ins, acc_des) files
+        Output : dF, err, var_ins, var_des (in kT, kT**2) and nb of accumulations of the ins / des files
+                 (not of histogram samples, var_ins * nacc_ins is the variance of one accumulation), nan for pairs that failed '''
+    (dF, err, var_ins, var_des), nacc, T, n_ins, n_des, failed = _batch(pairs,des_sign,True)
+    if errors is not None:
+        errors.update(failed)
+    return dF, err, var_ins, var_des, nacc[0], nacc[1]
+
+
+def record_check(home_dir,rows,tol):
+    ''' Save the comparison of the Python estimator with h4dmc.x in home_dir/bar-check.json,
+        rows are (solute, index, HFE h4dmc, HFE python) in kJ/mol
+        Output : True if all HFEs agree within tol '''
+    diffs = [float(abs(p - h)) for mol,i,h,p in rows]
+    record = dict(time=time.time(), n=len(rows), tol=tol, max_diff=max(diffs) if diffs else None,
+                  agree=len(rows) > 0 and max(diffs) <= tol,
+                  worst=sorted([[mol,int(i),float(p - h)] for mol,i,h,p in rows],key=lambda r: -abs(r[2]))[:10])
+    with open(os.path.join(home_dir,CHECK),'w') as f:
+        json.dump(record, f, indent=1)
+    return record['agree']
+
+
+def validated(home_dir):
+    ''' True if the last comparison with h4dmc.x (3-analysis.py --check) in home_dir agreed '''
+    path = os.path.join(home_dir,CHECK)
+    if not os.path.isfile(path):
+        return False
+    with open(path,'r') as f:
+        return json.load(f).get('agree') == True
+
+
+def kT(T):
+    ''' kT in kJ/mol, as in create_initialisation_input '''
+    return T * 1.3806 * 10**-23 * 10**-3 * 6.0221409 * 10**23
@@ -0,0 +1,172 @@
+import os
+import zlib
+import concurrent.futures
+import numpy as np
+import H4Dtools_bar as bar
+import H4Dtools_archive as archive
+
+"""
+
+Block bootstrap of BAR over the accumulated segments of a solute (3-analysis.py -bs)
+
+    acc_{solute}_{ins|des}{i} hold the histograms accumulated from index 0 to i : the statistics of
+    segment i are the difference of the histograms (in counts) of indices i and i-1 (an error if a bin
+    loses samples : files that are not cumulative), each direction up to its own latest file. Segments
+    are the blocks of the bootstrap : a resample draws as many segments as there are, with replacement, in
+    moving blocks of --block_length consecutive segments, independently for ins and des (separate
+    chains of runs). The histograms of all resamples are built as one product (resample weights x
+    segment histograms) and their BAR equations are solved in one batch (H4Dtools_bar), so thousands
+    of resamples cost a few NumPy operations and no h4dmc.x run. Solutes are spread over threads (NumPy
+    releases the GIL in these operations), so that scripts without a __main__ guard such as 3-analysis.py
+    are not re-executed by worker processes.
+
+    Output per (solute, index), in kT :
+        dF, err_bar       : BAR on all segments and its asymptotic error (independent samples)
+        err, lo, hi       : standard deviation and percentile confidence interval of the resamples (around
+                            dF of this Python estimator, not shifted onto the h4dmc.x HFE)
+        ineff             : (err / err_bar)**2, statistical inefficiency of the samples (1 if uncorrelated)
+        seg_corr          : lag-1 autocorrelation of the BAR estimates of single segments, correlation of
+                            consecutive segments (if large, use a --block_length of several segments)
+
+"""
+
+STAGES = ['ins','des']
+CHUNK = 1000
+
+
+def latest_index(mol_dir,solute,stage,imax):
+    ''' Last index (at most imax) of the contiguous chain of acc_{solute}_{stage}{i} files, archived ones included (-1 if none) '''
+    i = 0
+    while i <= imax and archive.signature_path(os.path.join(mol_dir,'acc_{}_{}{}'.format(solute,stage,i))) is not None:
+        i += 1
+    return i - 1
+
+
+def segment_blocks(mol_dir,solute,imax):
+    ''' Ins/des histograms of the segments of a solute (differences of the cumulative acc files),
+        segments 0 .. imax[stage] of each direction
+        Output : x (K), blocks_ins, blocks_des (imax[stage]+1 x K, counts), T '''
+    hist, restored = [], []
+    for stage in STAGES:
+        for i in range(imax[stage]+1):
+            file = os.path.join(mol_dir,'acc_{}_{}{}'.format(solute,stage,i))
+            if not os.path.isfile(file):
+                restored.append(file)
+            if not archive.restore(file):
+                raise FileNotFoundError(file)
+            hist.append(bar.read_histogram(file))
+    # remove copies of archived segments once read
+    archive.release(restored)
+    x, h, nacc = bar.stack_histograms(hist)
+    total = h.sum(axis=1)
+    cumulative = h * (bar.counts(h,nacc) / np.where(total > 0, total, 1))[:,None]
+    blocks = []
+    for stage,rows in zip(STAGES,np.split(cumulative,[imax['ins']+1])):
+        diff = np.diff(rows,axis=0,prepend=0)
+        # cumulative files only gain samples (up to rounding of normalised histograms)
+        negative = diff < -1e-6 * np.maximum(rows.max(axis=1,keepdims=True),1)
+        if negative.any():
+            i = int(np.nonzero(negative.any(axis=1))[0][0])
+            raise ValueError('acc_{}_{}{} has fewer samples than acc_{}_{}{} in some bins : not cumulative'.format(solute,stage,i,solute,stage,i-1))
+        blocks.append(np.clip(diff,0,None))
+    return x, blocks[0], blocks[1], hist[0][3]
+
+
+def resample_weights(nblocks,nboot,length,rng):
+    ''' Times each of nblocks segments is drawn in nboot moving block resamples (blocks of length segments)
+        Output : nboot x nblocks '''
+    length = min(max(length,1),nblocks)
+    starts = rng.integers(0,nblocks - length + 1,size=(nboot,-(-nblocks // length)))
+    drawn = (starts[:,:,None] + np.arange(length)).reshape(nboot,-1)[:,:nblocks]
+    w = np.zeros((nboot,nblocks))
+    np.add.at(w,(np.arange(nboot)[:,None],drawn),1)
+    return w
+
+
+def _lag1(values):
+    values = values[~np.isnan(values)]
+    if len(values) < 4 or values.std() == 0:
+        return np.nan
+    return float(np.corrcoef(values[:-1],values[1:])[0,1])
+
+
+def bootstrap(x,blocks_ins,blocks_des,nboot=1000,length=1,level=0.95,rng=None,des_sign=1):
+    ''' Block bootstrap of BAR over segment histograms blocks_ins / blocks_des (S x K counts)
+        Output : dict(dF, err_bar, err, lo, hi, ineff, seg_corr), in kT '''
+    rng = np.random.default_rng(rng)
+    blocks_ins = blocks_ins[blocks_ins.sum(axis=1) > 0]
+    blocks_des = blocks_des[blocks_des.sum(axis=1) > 0]
+    out = dict(dF=np.nan, err_bar=np.nan, err=np.nan, lo=np.nan, hi=np.nan, ineff=np.nan, seg_corr=np.nan)
+    if len(blocks_ins) == 0 or len(blocks_des) == 0:
+        return out
+    # drop bins empty in every segment
+    used = (blocks_ins > 0).any(axis=0) | (blocks_des > 0).any(axis=0)
+    x, blocks_ins, blocks_des = x[used], blocks_ins[:,used], blocks_des[:,used]
+    dF, err_bar = bar.solve_bar(x,blocks_ins.sum(axis=0)[None],blocks_des.sum(axis=0)[None],des_sign=des_sign)
+    out.update(dF=float(dF[0]), err_bar=float(err_bar[0]))
+    # single segments (ins and des segments of the same index)
+    n = min(len(blocks_ins),len(blocks_des))
+    out['seg_corr'] = _lag1(bar.solve_bar(x,blocks_ins[-n:],blocks_des[-n:],des_sign=des_sign)[0])
+    if len(blocks_ins) + len(blocks_des) < 3:
+        return out
+    samples = []
+    for start in range(0,nboot,CHUNK):
+        size = min(CHUNK,nboot - start)
+        h_ins = resample_weights(len(blocks_ins),size,length,rng) @ blocks_ins
+        h_des = resample_weights(len(blocks_des),size,length,rng) @ blocks_des
+        samples.append(bar.solve_bar(x,h_ins,h_des,des_sign=des_sign)[0])
+    samples = np.concatenate(samples)
+    samples = samples[~np.isnan(samples)]
+    if len(samples) < 2:
+        return out
+    err = float(samples.std(ddof=1))
+    lo, hi = np.quantile(samples,[(1 - level)/2,(1 + level)/2])
+    out.update(err=err, lo=float(lo), hi=float(hi), ineff=(err/out['err_bar'])**2 if out['err_bar'] > 0 else np.nan)
+    return out
+
+
+def solute_bootstrap(task):
+    ''' Bootstrap of a solute at its indices, from one read of its segments (each direction up to its
+        own latest file if it has fewer than the largest index)
+        task : (solute directory, solute, indices, nboot, length, level, seed)
+        Output : {index: result in kJ/mol (dF of the Python estimator and interval lo, hi around it, err) + ineff, seg_corr} '''
+    mol_dir, solute, indices, nboot, length, level, seed = task
+    imax = {stage: latest_index(mol_dir,solute,stage,max(indices)) for stage in STAGES}
+    if min(imax.values()) < 0:
+        raise FileNotFoundError(os.path.join(mol_dir,'acc_{}_{}0'.format(solute,min(imax,key=imax.get))))
+    x, blocks_ins, blocks_des, T = segment_blocks(mol_dir,solute,imax)
+    kT = bar.kT(T)
+    rng = np.random.default_rng([seed,zlib.crc32(solute.encode())])
+    out = {}
+    for i in indices:
+        b = bootstrap(x,blocks_ins[:i+1],blocks_des[:i+1],nboot=nboot,length=length,level=level,rng=rng)
+        out[i] = dict(dF=b['dF']*kT, lo=b['lo']*kT, hi=b['hi']*kT, err=b['err']*kT, ineff=b['ineff'], seg_corr=b['seg_corr'])
+    return out
+
+
+def _attempt(task):
+    try:
+        return solute_bootstrap(task), None
+    except Exception as e:
+        return None, str(e)
+
+
+def bootstrap_results(home_dir,pairs,nboot=1000,length=1,level=0.95,seed=0,jobs=1):
+    ''' Bootstrap of (solute, index) pairs, solutes spread over jobs threads
+        Output : {(solute, index): result of solute_bootstrap}, errors {solute: message} '''
+    indices = {}
+    for mol,i in pairs:
+        indices.setdefault(mol,[]).append(i)
+    tasks = [(os.path.join(home_dir,mol),mol,sorted(idx),nboot,length,level,seed) for mol,idx in indices.items()]
+    results, errors = {}, {}
+    if jobs > 1 and len(tasks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            outputs = list(pool.map(_attempt,tasks))
+    else:
+        outputs = [_attempt(task) for task in tasks]
+    for task,(out,error) in zip(tasks,outputs):
+        if error is None:
+            results.update({(task[1],i): r for i,r in out.items()})
+        else:
+            errors[task[1]] = error
+    return results, errors
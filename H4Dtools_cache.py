@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+import H4Dtools_archive as archive
+
+"""
+
+Persistent cache of h4dmc.x analysis results for 3-analysis.py
+
+    Entries are keyed on solute and index. Each entry keeps the signature of the
+    acc_{solute}_ins{i} / acc_{solute}_des{i} pair (size + mtime, or size + sha1 of the content),
+    mu0 and the analysis parameters it was computed with. An entry is only reused
+    when the whole signature still matches. Entries keep the mode of their signature
+    (content_hash), so that eviction compares them with signatures of the same mode.
+    Results with a block bootstrap (3-analysis.py -bs) depend on all segments 0 .. i : their signature
+    also holds the sha1 of the acc files of the earlier segments of each direction.
+
+"""
+
+def load_cache(file):
+    ''' Read cache from json file (empty cache if the file does not exist) '''
+    if not os.path.isfile(file):
+        return {}
+    with open(file,'r') as f:
+        return json.load(f)
+
+def save_cache(file,cache):
+    ''' Write cache to json file, replacing the old one atomically '''
+    tmp = file + '.tmp'
+    with open(tmp,'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp,file)
+
+def cache_key(solute,i):
+    return '{}/{}'.format(solute,i)
+
+def file_signature(path,content_hash=False):
+    ''' Size + mtime of a file, or size + sha1 of its content '''
+    st = os.stat(path)
+    if content_hash == False:
+        return [st.st_size, st.st_mtime_ns]
+    h = hashlib.sha1()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return [st.st_size, h.hexdigest()]
+
+def entry_signature(solute,i,mu0,params,mol_dir,content_hash=False,segments=False):
+    ''' Signature of a (solute, index) analysis : acc files, mu0 and analysis parameters
+        (segments : and content of the acc files of indices 0 .. i-1), None if one of the acc files is missing '''
+    sig = dict(mu0=mu0, params=params)
+    for kind in ['ins','des']:
+        # archived files are identified by their archive (H4Dtools_archive.py)
+        path = archive.signature_path(os.path.join(mol_dir,'acc_{}_{}{}'.format(solute,kind,i)))
+        if path is None:
+            return None
+        sig[kind] = file_signature(path,content_hash=content_hash)
+    if segments:
+        sig['segments'] = {kind: segment_signatures(solute,kind,i,mol_dir) for kind in ['ins','des']}
+    return sig
+
+def segment_signatures(solute,kind,i,mol_dir):
+    ''' Size + sha1 of acc_{solute}_{kind}{k}, k = 0 .. i-1 (up to the first missing file) '''
+    out = []
+    for k in range(i):
+        path = archive.signature_path(os.path.join(mol_dir,'acc_{}_{}{}'.format(solute,kind,k)))
+        if path is None:
+            break
+        out.append(file_signature(path,content_hash=True))
+    return out
+
+def cached_result(cache,solute,i,mol_dir):
+    ''' h4dmc.x result cached for a (solute, index) analysis whose acc files did not change since
+        (whatever its mu0 and parameters), None if absent, out of date or from the Python estimator '''
+    entry = cache.get(cache_key(solute,i))
+    if entry is None or entry['sig'].get('params',{}).get('native') == True:
+        return None
+    sig = entry_signature(solute,i,entry['sig'].get('mu0'),entry['sig'].get('params'),mol_dir,content_hash=entry['content_hash'])
+    if sig is None or any(sig[kind] != entry['sig'].get(kind) for kind in ['ins','des']):
+        return None
+    return entry['result']
+
+def lookup(cache,solute,i,sig):
+    ''' Cached result of a (solute, index) analysis, None if absent or out of date '''
+    entry = cache.get(cache_key(solute,i))
+    if sig is None or entry is None or entry['sig'] != sig:
+        return None
+    return entry['result']
+
+def store(cache,solute,i,sig,result,content_hash=False):
+    if sig is not None:
+        cache[cache_key(solute,i)] = dict(sig=sig, result=result, content_hash=content_hash)
+
+def evict(cache,home_dir):
+    ''' Remove entries whose acc files changed or disappeared, each checked in the mode it was stored with
+        Output : nb of removed entries '''
+    removed = 0
+    for key in list(cache.keys()):
+        solute, i = key.rsplit('/',1)
+        old = cache[key]['sig']
+        sig = entry_signature(solute,int(i),old['mu0'],old['params'],os.path.join(home_dir,solute),
+                              content_hash=cache[key]['content_hash'],segments='segments' in old)
+        if sig != old:
+            del cache[key]
+            removed += 1
+    return removed
+
+def invalidate(cache,solutes):
+    ''' Remove all entries of the given solutes
+        Output : nb of removed entries '''
+    removed = 0
+    for key in list(cache.keys()):
+        if key.rsplit('/',1)[0] in solutes:
+            del cache[key]
+            removed += 1
+    return removed
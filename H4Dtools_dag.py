@@ -0,0 +1,77 @@
+import os
+import re
+import H4Dtools_jobs as jobs
+
+"""
+
+Whole-campaign job graph : ini --> ins1/des1 --> ins2/des2 --> ... --> analysis submitted at once
+
+    Each node of the graph is a job script with the keys of the nodes it depends on. Nodes are submitted
+    in order, each after the successful end of its dependencies (slurm --dependency=afterok, local
+    scheduler), so that the next segment of each solute is already queued when the previous one ends,
+    and a failed run cancels the rest of its chain.
+
+    LoadLeveler has no dependencies between separate jobs : the whole graph is written as the steps
+    of one job command file (job-dag in the campaign directory), each step with
+    '# @ dependency = (step == 0)' on the steps it depends on, and the analysis step last.
+
+"""
+
+
+def node(key,job_file,cwd,deps=(),options=None):
+    ''' Node of the graph : job script job_file submitted from cwd after the nodes of keys deps '''
+    return dict(key=key, job_file=job_file, cwd=cwd, deps=[d for d in deps if d is not None], options=options)
+
+
+def submit(sched,nodes):
+    ''' Submit nodes in order (dependencies first), each after the successful end of its dependencies
+        Output : {key: job id} '''
+    ids = {}
+    for n in nodes:
+        deps = [ids[d] for d in n['deps'] if d in ids]
+        ids[n['key']] = sched.submit(n['job_file'],n['cwd'],dependencies=deps or None,options=n['options'])
+    return ids
+
+
+def step_name(key):
+    ''' LoadLeveler step of a node (solute, stage, index) : ins3.{solute}, ini.{solute}, or analysis '''
+    if len(key) == 1:
+        return key[0]
+    stage = key[1] if key[1] == 'ini' else '{}{}'.format(key[1],key[2])
+    return '{}.{}'.format(stage,re.sub(r'[^\w.]','_',key[0]))
+
+
+def write_steps(dest,nodes):
+    ''' Write LoadLeveler job command file dest running nodes as job steps,
+        each after the successful end of the steps it depends on '''
+    steps = {n['key']: step_name(n['key']) for n in nodes}
+    lines = ['#!/bin/bash']
+    for n in nodes:
+        lines += ['# @ step_name = {}'.format(steps[n['key']]), '# @ initialdir = {}'.format(n['cwd'])]
+        deps = [steps[d] for d in n['deps'] if d in steps]
+        if deps:
+            lines.append('# @ dependency = ({})'.format(' && '.join('{} == 0'.format(d) for d in deps)))
+        lines.append('# @ queue')
+    # job scripts are written for slurm : submit directory of each step
+    lines += ['', 'case ${LOADL_STEP_NAME} in']
+    lines += ['  {}) SLURM_SUBMIT_DIR={} bash {} ;;'.format(steps[n['key']],n['cwd'],os.path.basename(n['job_file'])) for n in nodes]
+    lines += ['esac', '']
+    with open(dest,'w') as f:
+        f.write('\n'.join(lines))
+    return dest
+
+
+def submit_steps(sched,nodes):
+    ''' Submit nodes as the steps of one job (job-dag in the directory of the last node, the campaign analysis)
+        Output : {key: step id {job id}.{step number}} '''
+    cwd = nodes[-1]['cwd']
+    job_id = sched.submit(write_steps(os.path.join(cwd,'job-dag'),nodes),cwd)
+    return {n['key']: '{}.{}'.format(job_id,k) for k,n in enumerate(nodes)}
+
+
+def analysis_job(template,home_dir,command):
+    ''' Job script home_dir/job-analysis running command in the campaign directory, from a job template
+        Output : job script path '''
+    job_file = os.path.join(home_dir,'job-analysis')
+    jobs.transform_template(template,job_file,'analysis',[],['cd ${SLURM_SUBMIT_DIR}'],[command])
+    return job_file
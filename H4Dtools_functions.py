@@ -1,6 +1,15 @@
 import os
-import random 
+import sys
 import json
+import time
+import atexit
+import hashlib
+import threading
+import functools
+import contextlib
+import subprocess
+import H4Dtools_state as state
+import H4Dtools_archive as archive
 
 def json2args(file):
     ''' Read arguments from json file '''
@@ -19,15 +28,113 @@ def mkdir_p(dir):
     if not os.path.exists(dir):
         os.mkdir(dir)
 
-def auto_sim_index(solute,mol_dir="%s" % os.getcwd()):
-    ''' Find largest existing _des or _s files to automatically continue simulation '''
-    i = 0
-    while os.path.isfile(os.path.join(mol_dir,'acc_' + solute + '_des%d' % i )) :
-        i += 1
-    while os.path.isfile(os.path.join(mol_dir,'acc_' + solute + '_s%d' % i )):
-        i += 1 
-    return i-1
-
+def auto_sim_index(solute,mol_dir="%s" % os.getcwd(),db=None):
+    ''' Find largest index reached by both _ins and _des files (or by _s files) to automatically continue simulation
+        (from the campaign state database db if given, otherwise from one scan of mol_dir) '''
+    if db is not None:
+        state.refresh(db,os.path.dirname(mol_dir),[solute])
+        return state.sim_index(state.indices(db,solute))
+    return state.sim_index(state.scan(mol_dir,solute)[0])
+
+def make_seed(*keys):
+    ''' Random seed of a run from its keys (solute, stage, index, replica, ...) :
+        different runs get well separated seeds, the same run always gets the same one '''
+    digest = hashlib.sha256(' '.join(str(k) for k in keys).encode()).digest()
+    return int.from_bytes(digest[:8],'big') % 2147483562 + 1
+
+def replica_suffix(replica):
+    ''' Suffix of input decks and files of replica r of a run ('' for no replica) '''
+    return '-r{}'.format(replica) if replica else ''
+
+# Instrumentation : timed phases of a run (csv, setup, copy, input, submit, wait, state, subprocess, parse ...)
+# written as json lines with --trace, summed per phase and printed at exit with --trace or --profile
+_trace = dict(file=None, script=None, lock=threading.Lock(), totals={}, start=time.perf_counter(), summary=False)
+
+def _emit(event):
+    if _trace['file'] is not None:
+        with _trace['lock']:
+            _trace['file'].write(json.dumps(event) + '\n')
+
+@contextlib.contextmanager
+def timer(phase,**info):
+    ''' Time a phase of the run : wall and CPU time of the calling thread, info added to the event '''
+    t0, c0, start = time.perf_counter(), time.thread_time(), time.time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - t0, time.thread_time() - c0
+        with _trace['lock']:
+            total = _trace['totals'].setdefault(phase,[0,0.0,0.0])
+            total[0] += 1
+            total[1] += wall
+            total[2] += cpu
+        if _trace['file'] is not None:
+            _emit(dict(event='phase', script=_trace['script'], phase=phase, start=start, wall=wall, cpu=cpu, **info))
+
+def timed(phase):
+    ''' Decorator timing each call of a function as phase '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with timer(phase,function=func.__name__):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorate
+
+def trace_summary():
+    ''' Rows (phase, calls, wall, cpu, share of the run wall time) by decreasing wall time '''
+    elapsed = time.perf_counter() - _trace['start']
+    return [(phase,n,wall,cpu,wall/elapsed if elapsed > 0 else 0.0)
+            for phase,(n,wall,cpu) in sorted(_trace['totals'].items(),key=lambda t: -t[1][1])]
+
+def _finish(profiler=None,profile_file=None):
+    elapsed = time.perf_counter() - _trace['start']
+    usage = os.times()
+    _emit(dict(event='end', script=_trace['script'], wall=elapsed, cpu=usage.user + usage.system,
+               phases={p: dict(calls=n,wall=w,cpu=c) for p,n,w,c,f in trace_summary()}))
+    if _trace['summary']:
+        print('Time per phase of {} ({:.2f} s) :'.format(_trace['script'],elapsed))
+        print('phase\t calls\t wall(s)\t cpu(s)\t share')
+        for row in trace_summary():
+            print('{}\t {}\t {:.3f}\t {:.3f}\t {:.1%}'.format(*row))
+    if profiler is not None:
+        import pstats
+        import tracemalloc
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        current, peak = tracemalloc.get_traced_memory()
+        print('Python memory : peak {:.1f} MB, top allocations :'.format(peak/1e6))
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]:
+            print('  {}'.format(stat))
+        tracemalloc.stop()
+        print('Profile saved in {} (python -m pstats {})'.format(profile_file,profile_file))
+    if _trace['file'] is not None:
+        _trace['file'].close()
+        _trace['file'] = None
+
+def instrument(args,script):
+    ''' Start instrumentation of a script run from its arguments :
+        --trace FILE : timed phases as json lines appended to FILE
+        --profile    : cProfile and tracemalloc of the Python side, saved in profile-{script}.prof
+        the time per phase is printed at exit in both cases '''
+    _trace['script'] = os.path.basename(script)
+    trace_file, profile = getattr(args,'trace',None), getattr(args,'profile',False)
+    if trace_file:
+        _trace['file'] = open(trace_file,'a')
+        _emit(dict(event='start', script=_trace['script'], argv=sys.argv[1:], time=time.time(), pid=os.getpid()))
+    profiler, profile_file = None, None
+    if profile:
+        import cProfile
+        import tracemalloc
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        profile_file = 'profile-{}.prof'.format(os.path.splitext(_trace['script'])[0])
+    _trace['summary'] = bool(trace_file or profile)
+    atexit.register(_finish,profiler,profile_file)
+
+@timed('csv')
 def from_file_to_dict(file,sep):
     ''' Create directory form a file n columns :
         1st column --> solutes --> keys
@@ -49,6 +156,7 @@ def from_file_to_dict(file,sep):
     f.close()
     return tuple(list_dict) 
 
+@timed('input')
 def create_structure_initialisation_input( args, solute='dummy', V0=0, mu0=0, mol_dir="%s" % os.getcwd() ):
 
     ''' Create initialisation input for structure
@@ -98,11 +206,11 @@ def create_structure_initialisation_input( args, solute='dummy', V0=0, mu0=0, mo
 
     #If no refence file create box
     if args.create_box == True:
-        f.write('2 \n {}\n \n'.format(random.randint(1,10000)))
+        f.write('2 \n {}\n \n'.format(make_seed(getattr(args,'seed',0),solute,'ini-str',1)))
 
     #Simulation
     f.write('8\n')
-    f.write('00\n {}\n'.format(random.randint(1,10000)))
+    f.write('00\n {}\n'.format(make_seed(getattr(args,'seed',0),solute,'ini-str',2)))
     if args.create_box == True: # equilibrate box
         f.write('10000 \n 10000 \n 0\n')
         f.write('0.3 \n 30 \n 0.5 0.5 \n 0 \n 0.2 \n 0.05 \n 0 \n 1 1 \n 0 \n')
@@ -110,8 +218,8 @@ def create_structure_initialisation_input( args, solute='dummy', V0=0, mu0=0, mo
         f.write('0\n \n')
     f.write('4\n 0\n')
     # Add solute for des + equil
-    f.write('7\n 0\n {}\n\n'.format(random.randint(1,10000)))
-    f.write('8\n {}\n'.format(random.randint(1,10000)))
+    f.write('7\n 0\n {}\n\n'.format(make_seed(getattr(args,'seed',0),solute,'ini-str',3)))
+    f.write('8\n {}\n'.format(make_seed(getattr(args,'seed',0),solute,'ini-str',4)))
     f.write('{0} \n {1} \n 0\n'.format(args.equil,args.equil))
     f.write('0.3 \n 30 \n 0.5 0.5 \n 0 \n 0.2 \n 0.05 \n 0 \n 1 1 \n 0 \n \n')
 
@@ -120,24 +228,27 @@ def create_structure_initialisation_input( args, solute='dummy', V0=0, mu0=0, mo
     f.write('{}_s0'.format(solute))
 
 
-def create_structure_input(args,solute='dummy',mol_dir="%s" % os.getcwd() ):
+@timed('input')
+def create_structure_input(args,solute='dummy',mol_dir="%s" % os.getcwd(),replica=0 ):
 
-    f = open(os.path.join(mol_dir,'input-str'),'w') 
-    if os.path.isfile(os.path.join(mol_dir,'acc_' + solute + '_s%d' % args.i)) == True:
+    suffix = replica_suffix(replica)
+    f = open(os.path.join(mol_dir,'input-str' + suffix),'w') 
+    if archive.restore_run(mol_dir,solute + '_s%d' % args.i) == True:
         f.write('53\n')
         f.write('{}\n 1 0\n \n'.format(solute + '_s%d' % args.i))
     else:
         print('No accumulation file corresponding to starting index !')
 
-    f.write('8\n {}\n'.format(random.randint(1,10000)))
+    f.write('8\n {}\n'.format(make_seed(getattr(args,'seed',0),solute,'str',args.i+1,replica)))
     n = args.nacc*args.nint_ins
     f.write('{0}\n 0\n {1}\n'.format(n,args.nint_ins))
     f.write('{0}\n {1}\n {2}\n {3}\n 0\n'.format(args.dw,args.rw,args.force_bias[0],args.force_bias[1]))
     f.write('{0}\n {1}\n'.format(args.vol_ex_prob,args.lnV))
     f.write('{0}\n 1 1\n {1}\n\n'.format(args.ds,args.ngen_vac))
-    f.write('4\n 2\n 12\n{0}_s{1}'.format(solute,args.i+1))
+    f.write('4\n 2\n 12\n{0}_s{1}{2}'.format(solute,args.i+1,suffix))
 
 
+@timed('input')
 def create_initialisation_input( args, solute='dummy', V0=0, mu0=0, mol_dir="%s" % os.getcwd() ):
 
     ''' Create initialisation input for H4D 
@@ -187,11 +298,11 @@ def create_initialisation_input( args, solute='dummy', V0=0, mu0=0, mol_dir="%s"
 
     #If no refence file create box
     if args.create_box == True:
-        f.write('2 \n {}\n \n'.format(random.randint(1,10000)))
+        f.write('2 \n {}\n \n'.format(make_seed(getattr(args,'seed',0),solute,'ini',1)))
 
     #Simulation
     f.write('8\n')
-    f.write('00\n {}\n'.format(random.randint(1,10000)))
+    f.write('00\n {}\n'.format(make_seed(getattr(args,'seed',0),solute,'ini',2)))
     if args.create_box == True: # equilibrate box
         f.write('10000 \n 10000 \n 0\n')
         f.write('0.3 \n 30 \n 0.5 0.5 \n 0 \n 0.2 \n 0.05 \n 0 \n 1 1 \n 0 \n')
@@ -204,8 +315,8 @@ def create_initialisation_input( args, solute='dummy', V0=0, mu0=0, mol_dir="%s"
     f.write('{}_ins0 \n 0 \n \n'.format(solute))
 
     # Add solute for des + equil
-    f.write('7\n 0\n {}\n\n'.format(random.randint(1,10000)))
-    f.write('8\n {}\n'.format(random.randint(1,10000)))
+    f.write('7\n 0\n {}\n\n'.format(make_seed(getattr(args,'seed',0),solute,'ini',3)))
+    f.write('8\n {}\n'.format(make_seed(getattr(args,'seed',0),solute,'ini',4)))
     f.write('{0} \n {1} \n 0\n'.format(args.equil,args.equil))
     f.write('0.3 \n 30 \n 0.5 0.5 \n 0 \n 0.2 \n 0.05 \n 0 \n 1 1 \n 0 \n \n')
 
@@ -214,51 +325,58 @@ def create_initialisation_input( args, solute='dummy', V0=0, mu0=0, mol_dir="%s"
     f.write('{}_des0'.format(solute))
 
 
-def create_ins_input(args,solute='dummy',mol_dir="%s" % os.getcwd() ):
+@timed('input')
+def create_ins_input(args,solute='dummy',mol_dir="%s" % os.getcwd(),replica=0,input_file='input-ins',chained=False ):
     
-    f = open(os.path.join(mol_dir,'input-ins'),'w')
-    if os.path.isfile(os.path.join(mol_dir,'acc_' + solute + '_ins%d' % args.i)) == True:
+    suffix = replica_suffix(replica)
+    f = open(os.path.join(mol_dir,input_file + suffix),'w')
+    # chained : starting files written by a run queued before this one
+    if chained == True or archive.restore_run(mol_dir,solute + '_ins%d' % args.i) == True:
         f.write('53\n')
         f.write('{}\n 0 0\n \n'.format(solute + '_ins%d' % args.i))
     else:
         print('No ins file corresponding to starting index !')
 
-    f.write('8\n00\n {}\n'.format(random.randint(1,10000)))
+    f.write('8\n00\n {}\n'.format(make_seed(getattr(args,'seed',0),solute,'ins',args.i+1,replica)))
     n = args.nacc*args.nint_ins
     f.write('{0}\n 0\n {1}\n'.format(n,args.nint_ins))
     f.write('{0}\n {1}\n {2}\n {3}\n 0\n'.format(args.dw,args.rw,args.force_bias[0],args.force_bias[1]))
     f.write('{0}\n {1}\n'.format(args.vol_ex_prob,args.lnV))
     f.write('{0}\n 1 1\n {1}\n\n'.format(args.ds,args.ngen_vac))
-    f.write('4\n 2\n 12\n{0}_ins{1}'.format(solute,args.i+1))
+    f.write('4\n 2\n 12\n{0}_ins{1}{2}'.format(solute,args.i+1,suffix))
 
-def create_des_input(args,solute='dummy',mol_dir="%s" % os.getcwd() ):
+@timed('input')
+def create_des_input(args,solute='dummy',mol_dir="%s" % os.getcwd(),replica=0,input_file='input-des',chained=False ):
 
-    f = open(os.path.join(mol_dir,'input-des'),'w')
-    if os.path.isfile(os.path.join(mol_dir,'acc_' + solute + '_des%d' % args.i)) == True:
+    suffix = replica_suffix(replica)
+    f = open(os.path.join(mol_dir,input_file + suffix),'w')
+    # chained : starting files written by a run queued before this one
+    if chained == True or archive.restore_run(mol_dir,solute + '_des%d' % args.i) == True:
         f.write('53\n')
         f.write('{}\n 1 0\n \n'.format(solute + '_des%d' % args.i))
     else:
         print('No des file corresponding to starting index !')
 
-    f.write('8\n {}\n'.format(random.randint(1,10000)))
+    f.write('8\n {}\n'.format(make_seed(getattr(args,'seed',0),solute,'des',args.i+1,replica)))
     n = args.nacc*args.nint_des
     f.write('{0}\n 0\n {1}\n'.format(n,args.nint_des))
     f.write('{0}\n {1}\n {2}\n {3}\n 0\n'.format(args.dw,args.rw,args.force_bias[0],args.force_bias[1]))
     f.write('{0}\n {1}\n'.format(args.vol_ex_prob,args.lnV))
     f.write('{0}\n {1} {2}\n 0\n\n'.format(args.ds,args.prob_wat_sol[0],args.prob_wat_sol[1]))
-    f.write('4\n 2\n 12\n{0}_des{1}'.format(solute,args.i+1))
+    f.write('4\n 2\n 12\n{0}_des{1}{2}'.format(solute,args.i+1,suffix))
 
-def create_analysis_input(args,solute='dummy',mu0=0,mol_dir="%s" % os.getcwd() ):
+@timed('input')
+def create_analysis_input(args,solute='dummy',mu0=0,mol_dir="%s" % os.getcwd(),input_file='input-ana' ):
 
-    f = open(os.path.join(mol_dir,'input-ana'),'w')
-    if os.path.isfile(os.path.join(mol_dir,'acc_' + solute + '_ins%d' % args.i)) == True:
+    f = open(os.path.join(mol_dir,input_file),'w')
+    if archive.restore_run(mol_dir,solute + '_ins%d' % args.i) == True:
         f.write('53\n')
         f.write('{}\n 0 0\n \n'.format(solute + '_ins%d' % args.i))
     else:
         print('No ins file corresponding to starting index : {} !'.format(args.i))
     f.write('8\n00\n 90\n 0\n 4\n 0\n')
     
-    if os.path.isfile(os.path.join(mol_dir,'acc_' + solute + '_des%d' % args.i)) == True:
+    if archive.restore_run(mol_dir,solute + '_des%d' % args.i) == True:
         f.write('53\n')
         f.write('{}\n 1 0\n \n'.format(solute + '_des%d' % args.i))
     else:
@@ -270,6 +388,36 @@ def create_analysis_input(args,solute='dummy',mu0=0,mol_dir="%s" % os.getcwd() )
         f.write('pinsdes_{0}_{1}'.format(solute,args.i))
     
     f.write('1\n 6\n 1\n -50\n 1\n -400 400\n 6\n {}\n'.format(mu0))
+    f.close()
+
+@timed('subprocess')
+def run_h4dmc(mol_dir,input_file,output_file=None):
+    ''' Run h4dmc.x in mol_dir reading input_file, stdout is captured through a pipe
+        Output : (exit status, stdout, stderr) '''
+
+    with open(os.path.join(mol_dir,input_file),'r') as fin:
+        proc = subprocess.run(['./h4dmc.x'],stdin=fin,stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+                              cwd=mol_dir,universal_newlines=True)
+    if output_file is not None:
+        with open(os.path.join(mol_dir,output_file),'w') as fout:
+            fout.write(proc.stdout)
+    return proc.returncode, proc.stdout, proc.stderr
+
+@timed('parse')
+def read_hfe(lines):
+    ''' Collect nb of accumulations, HFE (without mu0) and its error from h4dmc.x analysis output '''
+
+    nacc, hfe, err = None, None, None
+    for index,line in enumerate(lines):
+        if 'Nombre d\'accumulations' in line :
+            nacc = line.split()[-1]
+        if 'BAR' in line :
+            cols = lines[index+9].split()
+            hfe = float(cols[1])
+            err = cols[2]
+    if hfe is None:
+        raise ValueError('no BAR result in analysis output')
+    return nacc, hfe, err
 
 if __name__ == "__main__":
     mkdir_p()
@@ -0,0 +1,187 @@
+import os
+import re
+
+"""
+
+Job scripts for h4dmc.x runs
+
+    Stages and their files :
+        ini : input-ini --> out-ini
+        ins : input-ins --> out-ins-{index}
+        des : input-des --> out-des-{index}
+        str : input-str --> out-str-{index}
+    Replica k of a run (stage X-r{k}) : input-X-r{k} --> out-X-r{k}-{index}
+    Runs queued ahead of time (2-production.py -dag) : input-X.{index} --> out-X-{index}, job script job-X.{index}
+
+    Job array mode : instead of one job per solute and stage, a manifest (task id, solute directory,
+    stage, index) and a single array job script are written in the campaign directory. Each task
+    of the array reads its row of the manifest and runs h4dmc.x in its solute directory.
+
+    Staging of the solute directory on the node (SLURM_RUN_DIR) :
+        full    : rsync of the whole solute directory, as in the job templates
+        minimal : only the files read by the run (h4dmc.x, input deck, params-{stage}.json, acc_/r_ files
+                  loaded by the deck and .in/.top files it names), and after a successful run only the files
+                  it wrote are copied back (each through a temporary file renamed in place, acc_ files last)
+        Nothing is copied when the run directory is the solute directory (-j local), array and pack
+        tasks then run in the solute directory instead of a directory per run.
+
+"""
+
+STAGING = ['full','minimal']
+STAGES = dict(ini=('input-ini','out-ini'), ins=('input-ins','out-ins-{index}'),
+              des=('input-des','out-des-{index}'), str=('input-str','out-str-{index}'))
+
+_job_name = re.compile(r'^#SBATCH\s+--job-name=')
+_rsync = re.compile(r'^\s*rsync\s.*\$\{?SLURM_SUBMIT_DIR\}?/?\s+\.\s*$')
+_run = re.compile(r'^\s*\./h4dmc\.x\s*<')
+_run_files = re.compile(r'^(\s*)\./h4dmc\.x\s*<\s*(\S+)\s*>\s*(\S+)\s*$')
+
+
+def read_template(file):
+    with open(file,'r') as f:
+        return f.read().split('\n')
+
+
+def write_manifest(file,rows):
+    ''' Write manifest of array tasks, rows are (solute directory, stage, index)
+        Output : nb of tasks '''
+    with open(file,'w') as f:
+        f.write('task\tdir\tstage\tindex\n')
+        for task,(mol_dir,stage,index) in enumerate(rows,start=1):
+            f.write('{}\t{}\t{}\t{}\n'.format(task,mol_dir,stage,index))
+    return len(rows)
+
+
+def read_manifest(file):
+    ''' Rows (task, solute directory, stage, index) of a manifest '''
+    with open(file,'r') as f:
+        lines = f.read().split('\n')[1:]
+    return [(int(c[0]),c[1],c[2],int(c[3])) for c in (l.split('\t') for l in lines if l)]
+
+
+def run_line(input_file,log_file,wrapper=None):
+    ''' Shell line running h4dmc.x, through wrapper (ex. telemetry) if given '''
+    if wrapper:
+        return '{} {} {}'.format(wrapper,input_file,log_file)
+    return './h4dmc.x < {} > {}'.format(input_file,log_file)
+
+
+def staging_lines(src,name):
+    ''' Shell lines copying from src to the current directory the files read by run name '''
+    loads = 'awk \'p {print "acc_"$1 ; print "r_"$1 ; p=0} $1=="53" {p=1} $1 ~ /\\.(in|top)$/ {print $1}\' ' + src + '/input-' + name
+    return ['# Minimal staging : h4dmc.x, input deck and files loaded by the deck',
+            'if [ "$(pwd -P)" != "$(cd ' + src + ' && pwd -P)" ] ; then',
+            '  for F in h4dmc.x input-' + name + ' params-' + name + '.json $(' + loads + ') ; do',
+            '    if [ -e ' + src + '/${F} ] ; then cp -p ' + src + '/${F} . ; fi',
+            '  done',
+            'fi',
+            'touch .staged']
+
+
+def copy_back_lines(src):
+    ''' Shell lines copying files written by the run back to src after a successful run
+        (keeping the exit status of the run) '''
+    return ['STATUS=$?',
+            'if [ ${STATUS} -eq 0 ] && [ "$(pwd -P)" != "$(cd ' + src + ' && pwd -P)" ] ; then',
+            '  for F in $(find . -maxdepth 1 -type f -newer .staged ! -name \'acc_*\' -printf \'%f\\n\') $(find . -maxdepth 1 -type f -newer .staged -name \'acc_*\' -printf \'%f\\n\') ; do',
+            '    cp -p ${F} ' + src + '/.${F}.part && mv -f ' + src + '/.${F}.part ' + src + '/${F}',
+            '  done',
+            'fi',
+            '( exit ${STATUS} )']
+
+
+def task_lines(src_dir,mol,stage,index,wrapper=None,staging='full'):
+    ''' Shell lines staging solute directory mol from src_dir, and running h4dmc.x for stage/index
+        (arguments may be shell variables)
+        Output : staging lines, run lines '''
+    src = '{}/{}'.format(src_dir,mol)
+    run = ['if [ "{0}" == "ini" ] ; then LOG=out-ini ; else LOG=out-{0}-{1} ; fi'.format(stage,index),
+           run_line('input-{}'.format(stage),'${LOG}',wrapper)]
+    if staging == 'minimal':
+        # one directory per run : runs of a solute may share the node (packs),
+        # the solute directory itself when the run directory is the submit directory (-j local)
+        return ['if [ "$(pwd -P)" == "$(cd {} && pwd -P)" ] ; then cd {} ; else mkdir -p {}/{} ; cd {}/{} ; fi'.format(src_dir,mol,mol,stage,mol,stage)] \
+               + staging_lines(src,stage), run + copy_back_lines(src)
+    return ['mkdir -p {}'.format(mol), 'rsync -av --update {}/ {}/'.format(src,mol), 'cd {}'.format(mol)], run
+
+
+def transform_template(template,dest,name,directives,stage_lines,run_lines):
+    ''' Write job script dest from a job template (input-files/job-*) :
+        job name replaced by name and followed by extra #SBATCH directives,
+        rsync of the submit directory replaced by stage_lines, h4dmc.x run replaced by run_lines '''
+
+    out, found = [], set()
+    for line in read_template(template):
+        if _job_name.match(line):
+            out.append('#SBATCH --job-name={}'.format(name))
+            out.extend('#SBATCH {}'.format(d) for d in directives)
+            found.add('name')
+        elif _rsync.match(line):
+            out.extend(stage_lines)
+            found.add('rsync')
+        elif _run.match(line):
+            out.extend(run_lines)
+            found.add('run')
+        else:
+            out.append(line)
+    missing = {'name','rsync','run'} - found
+    if missing:
+        raise ValueError('{} : cannot find {} lines in job template'.format(template,', '.join(sorted(missing))))
+    with open(dest,'w') as f:
+        f.write('\n'.join(out))
+
+
+def write_array_script(template,dest,manifest,ntasks,throttle=0,name='array',wrapper=None,staging='full'):
+    ''' Write slurm array job script from a job template
+        Each task reads its (solute directory, stage, index) row of the manifest '''
+
+    array = '1-{}'.format(ntasks) + ('%{}'.format(throttle) if throttle else '')
+    task_stage, task_run = task_lines('${SLURM_SUBMIT_DIR}','${MOL}','${STAGE}','${INDEX}',wrapper,staging)
+    stage_lines = ['# Task of the job array : solute directory, stage and index from the manifest',
+                   'read TASK MOL STAGE INDEX < <(awk -F"\\t" -v t=${{SLURM_ARRAY_TASK_ID}} \'$1==t\' {})'.format(manifest)] + task_stage
+    transform_template(template,dest,name,['--array={}'.format(array)],stage_lines,task_run)
+
+
+def write_array(home_dir,template,rows,stage,throttle=0,wrapper=None,staging='full'):
+    ''' Write manifest array-{stage}.tsv and job script job-array-{stage} in home_dir
+        Output : job script path, nb of tasks '''
+    manifest = os.path.join(home_dir,'array-{}.tsv'.format(stage))
+    job_file = os.path.join(home_dir,'job-array-{}'.format(stage))
+    ntasks = write_manifest(manifest,rows)
+    write_array_script(template,job_file,manifest,ntasks,throttle=throttle,name=stage,wrapper=wrapper,staging=staging)
+    return job_file, ntasks
+
+
+def _replica_files(input_file,log_file,suffix):
+    ''' Input deck and log file of a replica : input-X{suffix}, out-X{suffix}-{index} '''
+    return input_file + suffix, re.sub(r'^(out-[a-z]+)',r'\g<1>' + suffix,log_file)
+
+
+def write_job_script(template,mol_dir,index=None,wrapper=None,suffix='',staging='full',per_index=False):
+    ''' Copy job template to mol_dir, with YY replaced by the index of the produced files
+        (and h4dmc.x run through wrapper if given, on the files of replica suffix -r{k} if given,
+        staging only the files of the run with staging minimal, and with per_index on the input deck
+        input-X.{index} as job-X.{index}, for runs of several indices queued at the same time)
+        Output : job script path '''
+    lines = read_template(template)
+    if index is not None:
+        lines = [l.replace('YY',str(index)) for l in lines]
+    if per_index:
+        lines = [_run_files.sub(lambda m: '{}./h4dmc.x < {}.{} > {}'.format(m.group(1),m.group(2),index,m.group(3)),l) for l in lines]
+    if staging == 'minimal':
+        out = []
+        runs = [m.group(2) for m in map(_run_files.match,lines) if m]
+        for line in lines:
+            if _rsync.match(line) and runs:
+                out.extend(staging_lines('${SLURM_SUBMIT_DIR}',runs[0][len('input-'):] + suffix))
+            elif _run_files.match(line):
+                out.extend([line] + copy_back_lines('${SLURM_SUBMIT_DIR}'))
+            else:
+                out.append(line)
+        lines = out
+    if wrapper or suffix:
+        lines = [_run_files.sub(lambda m: m.group(1) + run_line(*_replica_files(m.group(2),m.group(3),suffix),wrapper),l) for l in lines]
+    job_file = os.path.join(mol_dir,os.path.basename(template) + suffix + ('.{}'.format(index) if per_index else ''))
+    with open(job_file,'w') as f:
+        f.write('\n'.join(lines))
+    return job_file
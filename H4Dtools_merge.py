@@ -0,0 +1,201 @@
+import os
+import re
+import shutil
+import argparse
+import numpy as np
+import H4Dtools_acc as acc
+
+"""
+
+Merge of acc_ files accumulated independently (segments or replicas run at the same time)
+
+    Files are combined block by block (blocks as read by H4Dtools_acc) and written back as text
+    that h4dmc.x reads (53 / load) and 3-analysis.py analyses :
+        accumulated blocks (more than SMALL values : iacc histograms, en angles, en dH and intra
+        flexible distributions) are added ; their first column is the r / angle grid, kept as is
+        accumulation counters niter and nacc of the parametres section are added
+        other blocks (parameters, solute description, file names) are copied from the last file
+    With mean=True, accumulated blocks are averaged with nacc weights instead (files holding
+    normalised distributions). Blocks normalised in all files (each distribution summing to at most 1,
+    as H4Dtools_bar.counts reads them) are always averaged.
+    The merged file is written next to output and only renamed to it once it is read back with the
+    sections and blocks of the inputs and the combined niter / nacc counters.
+    Replicas started from the same file base all contain its statistics : with base, it is
+    counted once (merged = base + sum of (file - base)).
+    The configuration file r_ of the last file is copied next to the merged acc_ file.
+    Replicas of a run (2-production.py --replicas) acc_{solute}_{stage}{i}-r{k} all start from
+    acc_{solute}_{stage}{i-1} and are merged into acc_{solute}_{stage}{i} by merge_replicas.
+
+"""
+
+SMALL = 16
+COUNTERS = ['niter', 'nacc']
+
+
+def _values(line):
+    return [float(acc._fortran_exp.sub(r'\1E\2',t)) for t in line.split()]
+
+
+def _format(values,template):
+    ''' Line of values, integers where the template line has integers (read as such by h4dmc.x) '''
+    tokens = template.split()
+    return ' ' + '  '.join(str(int(round(v))) if t.lstrip('+-').isdigit() else '{:.16E}'.format(v) for v,t in zip(values,tokens))
+
+
+def read_blocks(file):
+    ''' Lines and blocks (section, block number, line numbers, nb of columns, strings) of an acc file '''
+    with open(file,'r') as f:
+        lines = f.read().split('\n')
+    return lines, list(acc.iter_blocks(lines))
+
+
+def combine(values,weights,base=None,base_weight=0,mean=False):
+    ''' Sum (or weighted mean) of values (K x ...) counting base once '''
+    K = len(values)
+    if mean:
+        total = np.tensordot(weights,values,axes=1)
+        norm = weights.sum()
+        if base is not None:
+            total = total - (K-1)*base_weight*base
+            norm = norm - (K-1)*base_weight
+        return total / norm if norm > 0 else values[-1]
+    total = values.sum(axis=0)
+    if base is not None:
+        total = total - (K-1)*base
+    return total
+
+
+def normalised(values,grid=False):
+    ''' True if the block values (K x rows x cols) hold normalised distributions in all files :
+        the line for single line blocks, each column (grid excluded) otherwise '''
+    v = values[:,:,1:] if grid else values
+    sums = v.sum(axis=2) if v.shape[1] == 1 else v.sum(axis=1)
+    return bool(np.all(sums <= 1 + 1e-6) and np.any(sums > 0))
+
+
+def check_merged(file,structure,counters):
+    ''' Check that a merged file is read back with the blocks structure and the counters {name: value} '''
+    lines, blocks = read_blocks(file)
+    if [(b[0],b[1],len(b[2]),b[3],b[4]) for b in blocks] != structure:
+        raise ValueError('{} : merged file is not read back with the sections of the inputs'.format(file))
+    head = acc.header(acc.parse_acc(file))
+    for name,value in counters.items():
+        if not np.isclose(head.get(name,np.nan),value):
+            raise ValueError('{} : merged {} is {}, {} expected'.format(file,name,head.get(name),value))
+
+
+def merge(files,output,base=None,mean=False):
+    ''' Merge acc files into output (and copy the r_ file of the last one)
+        Output : nb of accumulations of the merged file '''
+
+    parsed = [read_blocks(f) for f in files]
+    base_parsed = read_blocks(base) if base else None
+    structure = [(b[0],b[1],len(b[2]),b[3],b[4]) for b in parsed[0][1]]
+    for file,(lines,blocks) in zip(files + ([base] if base else []),parsed + ([base_parsed] if base else [])):
+        if [(b[0],b[1],len(b[2]),b[3],b[4]) for b in blocks] != structure:
+            raise ValueError('{} : sections differ from {}'.format(file,files[0]))
+
+    # accumulation counters : weights of the mean and summed values of the parametres section
+    heads = [acc.header(acc.parse_acc(f)) for f in files]
+    base_head = acc.header(acc.parse_acc(base)) if base else None
+    weights = np.array([h['nacc'] for h in heads])
+    base_weight = base_head['nacc'] if base else 0
+
+    out = list(parsed[-1][0])
+    for k,(section,nblock,rows,ncols,strings) in enumerate(parsed[0][1]):
+        if strings:
+            continue
+        # K x rows x cols values of the block
+        values = np.array([[_values(lines[n]) for n in blocks[k][2]] for lines,blocks in parsed])
+        base_values = np.array([_values(base_parsed[0][n]) for n in base_parsed[1][k][2]]) if base else None
+        if section == 'parametres':
+            merged = values[-1].copy()
+            flat = merged.ravel()
+            offset = sum(len(_values(parsed[0][0][n])) for b in parsed[0][1][:k] if b[0] == 'parametres' and not b[4] for n in b[2])
+            for name in COUNTERS:
+                pos = acc.HEADER[name] - offset
+                if 0 <= pos < flat.size:
+                    flat[pos] = combine(values.reshape(len(files),-1)[:,pos],None,
+                                        base_values.ravel()[pos] if base else None)
+        elif values[0].size > SMALL:
+            grid = values.shape[2] > 1 and len(rows) > 1
+            merged = combine(values,weights,base_values,base_weight,mean=mean or normalised(values,grid))
+            if grid:
+                # grid column
+                merged[:,0] = values[-1][:,0]
+        else:
+            continue
+        for n,row,last in zip(rows,merged,values[-1]):
+            if not np.array_equal(row,last):
+                out[n] = _format(row,out[n])
+
+    counters = {name: combine(np.array([h[name] for h in heads]),None,base_head[name] if base else None)
+                for name in COUNTERS if all(name in h for h in heads + ([base_head] if base else []))}
+    tmp = output + '.tmp'
+    with open(tmp,'w') as f:
+        f.write('\n'.join(out))
+    try:
+        check_merged(tmp,structure,counters)
+    except ValueError:
+        os.remove(tmp)
+        raise
+    os.replace(tmp,output)
+    r_last, r_out = [os.path.join(os.path.dirname(p),'r_' + os.path.basename(p)[4:]) for p in [files[-1],output]]
+    if os.path.isfile(r_last) and os.path.basename(files[-1]).startswith('acc_') and os.path.basename(output).startswith('acc_'):
+        shutil.copyfile(r_last,r_out)
+    return weights.sum() - (len(files)-1)*base_weight
+
+
+def replica_files(mol_dir,solute,stage,index):
+    ''' acc_ files of the replicas of run (solute, stage, index), by replica number '''
+    pattern = re.compile(r'^acc_{}_{}{}-r(\d+)$'.format(re.escape(solute),stage,index))
+    found = [(int(m.group(1)),m.group(0)) for m in map(pattern.match,os.listdir(mol_dir)) if m]
+    return [os.path.join(mol_dir,name) for k,name in sorted(found)]
+
+
+def incomplete_replicas(mol_dir,solute,stage,index,replicas,runs,name=None):
+    ''' Missing replicas of run (solute, stage, index) that will not come : finished without their acc_ file
+        (failed, cancelled) or never submitted while other replicas of the set are there
+        runs : {run name: (state, exit)} of the index (H4Dtools_state.runs), name : run name of stage (default stage)
+        Output : {replica: state}, empty once merged, for sets not started and while missing replicas are queued '''
+    if os.path.isfile(os.path.join(mol_dir,'acc_{}_{}{}'.format(solute,stage,index))):
+        return {}
+    name = name or stage
+    present = {int(f.rsplit('-r',1)[1]) for f in replica_files(mol_dir,solute,stage,index)}
+    started = len(present) > 0 or any(run.startswith(name + '-r') for run in runs)
+    out = {}
+    for k in range(1,replicas+1):
+        state, status = runs.get('{}-r{}'.format(name,k),(None,None))
+        if k in present or state in ('PENDING','RUNNING') or not started:
+            continue
+        if state is None:
+            out[k] = 'not submitted'
+        else:
+            out[k] = state + (' (exit {})'.format(status) if status not in (None,0) else '') + (' without output' if state == 'COMPLETED' else '')
+    return out
+
+
+def merge_replicas(mol_dir,solute,stage,index,replicas):
+    ''' Merge the replicas -r1 .. -r{replicas} of run (solute, stage, index) into acc_{solute}_{stage}{index}
+        when all of them are there and the merged file is not
+        Output : True if merged '''
+    output = os.path.join(mol_dir,'acc_{}_{}{}'.format(solute,stage,index))
+    files = replica_files(mol_dir,solute,stage,index)
+    if os.path.isfile(output) or len(files) < replicas:
+        return False
+    base = os.path.join(mol_dir,'acc_{}_{}{}'.format(solute,stage,index-1))
+    merge(files,output,base=base if os.path.isfile(base) else None)
+    return True
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Merge acc_ files accumulated independently")
+    parser.add_argument('files', nargs='+', help="acc_ files to merge")
+    parser.add_argument('-o','--output', required=True, help="merged acc_ file (the r_ file of the last input is copied next to it)" )
+    parser.add_argument('--base', help="common starting acc_ file of the inputs, counted once (default: %(default)s)" )
+    parser.add_argument('--mean', action='store_true', help="nacc weighted mean instead of sum of accumulated blocks (default: %(default)s)" )
+    args = parser.parse_args()
+
+    nacc = merge(args.files,args.output,base=args.base,mean=args.mean)
+    print('{} files merged into {} : nacc {:g}'.format(len(args.files),args.output,nacc))
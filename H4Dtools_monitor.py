@@ -0,0 +1,367 @@
+import os
+import re
+import sys
+import time
+import ctypes
+import ctypes.util
+import struct
+import asyncio
+import argparse
+import collections
+import H4Dtools_state as state
+
+"""
+
+Live progress of running ins/des (and str) jobs from their h4dmc.x logs (out-{stage}-{index})
+
+    Each insertion / destruction attempt of h4dmc.x writes a line 'deltaH, deltaU= ...' (or 'Insertion de
+    solute interrompue ...') in its log : the number of such lines is the number of accumulations done,
+    the target being NCYC / NACC of the input deck of the run (input-{stage}, or input-{stage}.{index}).
+    The latest log of each run of each solute is followed from where the last read stopped (logs are
+    never read twice), woken up by inotify (Linux, through libc) or, where it is not available or does
+    not see the writes (network filesystems synced from compute nodes : --poll), by polling : solute
+    directories are listed again only when their mtime changes, and only sizes of the followed logs are
+    checked, a batch of directories at a time.
+    Every few seconds it prints per run the accumulations done, the throughput (accumulations/s over the
+    last --window seconds), the ETA, and runs whose log has not grown for --stall seconds, with
+    campaign-wide totals.
+
+    python H4Dtools_monitor.py -s solutes.csv
+    python H4Dtools_monitor.py --poll -n 30 --stall 1800
+    python H4Dtools_monitor.py --once
+
+"""
+
+MARKER = r'deltaH, deltaU=|Insertion de solute interrompue'
+LOG = re.compile(r'^out-((?:ins|des|str)(?:-r\d+)?)-(\d+)$')
+
+# inotify (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_FLAGS = IN_MODIFY | IN_MOVED_TO | IN_CREATE
+_EVENT = struct.Struct('iIII')
+
+
+def deck_run(deck):
+    ''' Nb of accumulations (NCYC / NACC of its Monte-Carlo block) and name of the file saved by a production
+        input deck (None if unknown) '''
+    try:
+        with open(deck,'r') as f:
+            lines = [l.strip() for l in f]
+    except OSError:
+        return None, None
+    saved = lines[lines.index('12')+1] if '12' in lines[:-1] else None
+    if '8' not in lines:
+        return None, saved
+    k = lines.index('8') + 1
+    if k < len(lines) and lines[k] == '00':
+        k += 1
+    try:
+        ncyc, nint = int(lines[k+1]), int(lines[k+3])
+    except (IndexError,ValueError):
+        return None, saved
+    return (ncyc // nint if nint > 0 else None), saved
+
+
+class LogTail:
+    ''' Accumulations counted in a growing h4dmc.x log, read from where the last read stopped '''
+
+    def __init__(self,path,marker,target=None):
+        self.path, self.marker, self.target = path, marker, target
+        self.offset, self.partial, self.count = 0, b'', 0
+        self.grown = None
+        self.finished = False
+        self.history = collections.deque()
+
+    def read(self,now):
+        ''' Read what was appended since the last call
+            Output : nb of new accumulations '''
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            return 0
+        if size < self.offset:
+            # log rewritten (run restarted)
+            self.offset, self.partial, self.count = 0, b'', 0
+            self.history.clear()
+        if size == self.offset:
+            return 0
+        with open(self.path,'rb') as f:
+            f.seek(self.offset)
+            data = self.partial + f.read(size - self.offset)
+        self.offset = size
+        cut = data.rfind(b'\n') + 1
+        new = len(self.marker.findall(data,0,cut))
+        self.partial = data[cut:]
+        if new:
+            self.count += new
+            self.grown = now
+            self.history.append((now,self.count))
+        return new
+
+    def rate(self,now,window):
+        ''' Accumulations per second over the last window seconds (None before two points) '''
+        while len(self.history) > 1 and self.history[1][0] < now - window:
+            self.history.popleft()
+        if len(self.history) == 0 or (len(self.history) == 1 and self.history[0][0] >= now - window):
+            return None
+        t0, c0 = self.history[0]
+        return (self.count - c0) / max(now - t0,1e-9)
+
+    def done(self):
+        return self.finished or (self.target is not None and self.count >= self.target)
+
+
+class Inotify:
+    ''' inotify instance on directories (Linux, through libc with ctypes) '''
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),'inotify_init1 failed')
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+        self.dirs = {}
+
+    def watch(self,path):
+        wd = self._add_watch(self.fd,os.fsencode(path),IN_FLAGS)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),'inotify_add_watch failed on {}'.format(path))
+        self.dirs[wd] = path
+
+    def events(self):
+        ''' Paths changed since the last call, None if events were lost (queue overflow) '''
+        paths, lost = set(), False
+        while True:
+            try:
+                buf = os.read(self.fd,65536)
+            except BlockingIOError:
+                break
+            k = 0
+            while k < len(buf):
+                wd, mask, cookie, length = _EVENT.unpack_from(buf,k)
+                name = buf[k+_EVENT.size:k+_EVENT.size+length].rstrip(b'\0')
+                k += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    lost = True
+                elif wd in self.dirs and name:
+                    paths.add(os.path.join(self.dirs[wd],os.fsdecode(name)))
+        return None if lost else paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Monitor:
+    ''' Latest log of each run (solute, stage) of a campaign '''
+
+    def __init__(self,home_dir,solutes,marker=MARKER,window=300,stall=900):
+        self.home_dir, self.solutes = home_dir, solutes
+        self.marker = re.compile(marker.encode())
+        self.window, self.stall = window, stall
+        self.tails = {}
+        self.mtimes = {}
+
+    def discover(self,solute,now):
+        ''' List solute directory (when it changed) and follow the latest log of each run '''
+        mol_dir = os.path.join(self.home_dir,solute)
+        try:
+            mtime = os.stat(mol_dir).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if self.mtimes.get(solute) == mtime:
+            return
+        self.mtimes[solute] = mtime
+        latest, names = {}, set()
+        with os.scandir(mol_dir) as entries:
+            for entry in entries:
+                names.add(entry.name)
+                match = LOG.match(entry.name)
+                if match and int(match.group(2)) >= latest.get(match.group(1),(-1,))[0]:
+                    latest[match.group(1)] = (int(match.group(2)),entry.path)
+        for name,(index,path) in latest.items():
+            stage = name.split('-r')[0]
+            suffix = name[len(stage):]
+            # file saved by the run (or its merge with the other replicas)
+            acc = '{}_{}{}'.format(solute,'s' if stage == 'str' else stage,index)
+            if (solute,name) not in self.tails or self.tails[(solute,name)][0] != index:
+                # deck of the run queued ahead of time (2-production.py -dag), or of the latest run
+                deck = os.path.join(mol_dir,'input-{}.{}'.format(name,index))
+                target, saved = deck_run(deck if os.path.isfile(deck) else os.path.join(mol_dir,'input-' + name))
+                tail = LogTail(path,self.marker,target if saved == acc + suffix else None)
+                self.tails[(solute,name)] = (index,tail)
+                tail.read(now)
+            tail = self.tails[(solute,name)][1]
+            tail.finished = 'acc_' + acc + suffix in names or 'acc_' + acc in names
+
+    def scan(self,now,solutes=None):
+        for solute in self.solutes if solutes is None else solutes:
+            self.discover(solute,now)
+
+    def read(self,now):
+        ''' Read followed logs not finished yet '''
+        for index,tail in self.tails.values():
+            if not tail.done():
+                tail.read(now)
+
+    def changed(self,paths,now):
+        ''' Handle changed paths (inotify) : new logs and appended lines '''
+        logs = {tail.path: tail for index,tail in self.tails.values()}
+        for path in paths:
+            if path in logs:
+                logs[path].read(now)
+            elif LOG.match(os.path.basename(path)):
+                self.discover(os.path.basename(os.path.dirname(path)),now)
+
+    def rows(self,now):
+        ''' (solute, run, index, count, target, rate, eta, status) of followed runs '''
+        out = []
+        for (solute,name),(index,tail) in sorted(self.tails.items()):
+            rate = tail.rate(now,self.window)
+            eta = None
+            if tail.done():
+                status = 'done'
+            elif tail.grown is not None and now - tail.grown > self.stall:
+                status = 'stalled'
+            elif tail.count == 0:
+                status = 'waiting'
+            else:
+                status = 'running'
+            if status == 'running' and rate and tail.target is not None:
+                eta = (tail.target - tail.count) / rate
+            out.append((solute,name,index,tail.count,tail.target,rate,eta,status))
+        return out
+
+
+def hms(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600,seconds % 3600 // 60,seconds % 60)
+
+
+def report(rows,show_all=False):
+    ''' Progress table and campaign totals '''
+    lines = ['solute\t run\t index\t acc\t target\t acc/s\t ETA\t status']
+    for solute,name,index,count,target,rate,eta,status in rows:
+        if status == 'done' and show_all == False:
+            continue
+        lines.append('{}\t {}\t {}\t {}\t {}\t {}\t {}\t {}'.format(solute,name,index,count,'-' if target is None else target,
+                                                                   '-' if rate is None else '{:.3f}'.format(rate),hms(eta),status))
+    status = collections.Counter(r[7] for r in rows)
+    running = [r for r in rows if r[7] == 'running']
+    total_rate = sum(r[5] or 0 for r in running)
+    # runs are independent jobs : the campaign ends with the slowest one
+    etas = [r[6] for r in running]
+    eta = max(etas) if etas and None not in etas else None
+    lines.append('{} runs : {} running, {} waiting, {} stalled, {} done ; {:.3f} acc/s ; {} / {} accumulations ; ETA {}'.format(
+                 len(rows),status['running'],status['waiting'],status['stalled'],status['done'],total_rate,
+                 sum(r[3] for r in rows),sum(r[3] if r[4] is None else r[4] for r in rows),hms(eta)))
+    stalled = [r for r in rows if r[7] == 'stalled']
+    if stalled:
+        lines.append('Stalled : ' + ', '.join('{}/out-{}-{}'.format(r[0],r[1],r[2]) for r in stalled))
+    return '\n'.join(lines)
+
+
+async def _poll(monitor,interval,batch):
+    ''' Check directories and followed logs every interval seconds, batch directories at a time '''
+    while True:
+        for k in range(0,len(monitor.solutes),batch):
+            monitor.scan(time.monotonic(),monitor.solutes[k:k+batch])
+            await asyncio.sleep(0)
+        monitor.read(time.monotonic())
+        await asyncio.sleep(interval)
+
+
+async def _notify(monitor,notifier,interval):
+    ''' Handle inotify events, gathered for interval seconds between reads '''
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    loop.add_reader(notifier.fd,ready.set)
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            await asyncio.sleep(interval)
+            paths = notifier.events()
+            now = time.monotonic()
+            if paths is None:
+                monitor.mtimes.clear()
+                monitor.scan(now)
+                monitor.read(now)
+            else:
+                monitor.changed(paths,now)
+    finally:
+        loop.remove_reader(notifier.fd)
+
+
+async def _report(monitor,interval,show_all,clear):
+    while True:
+        await asyncio.sleep(interval)
+        # solute directories created after the start
+        for solute in monitor.solutes:
+            if solute not in monitor.mtimes:
+                monitor.discover(solute,time.monotonic())
+        if clear:
+            sys.stdout.write('\033[H\033[J')
+        print(time.strftime('%Y-%m-%d %H:%M:%S') + '\n' + report(monitor.rows(time.monotonic()),show_all),flush=True)
+
+
+async def watch(monitor,interval=10,poll=False,poll_interval=5,batch=200,show_all=False):
+    ''' Follow the campaign until interrupted '''
+    notifier = None
+    if poll == False:
+        try:
+            notifier = Inotify()
+            for solute in monitor.solutes:
+                mol_dir = os.path.join(monitor.home_dir,solute)
+                if os.path.isdir(mol_dir):
+                    notifier.watch(mol_dir)
+        except (OSError,AttributeError) as e:
+            print('inotify not available ({}) : polling every {} s'.format(e,poll_interval))
+            if notifier is not None:
+                notifier.close()
+            notifier = None
+    monitor.scan(time.monotonic())
+    tasks = [_report(monitor,interval,show_all,sys.stdout.isatty())]
+    tasks.append(_poll(monitor,poll_interval,batch) if notifier is None else _notify(monitor,notifier,min(1.0,poll_interval)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if notifier is not None:
+            notifier.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Live progress of the running ins/des jobs of a campaign")
+    parser.add_argument('-s','--solutes', help="File containing solute's names (default: solutes in campaign-state.db)" )
+    parser.add_argument('-n','--interval', type=float, default=10, help="seconds between reports (default: %(default)s)" )
+    parser.add_argument('-w','--window', type=float, default=300, help="seconds over which throughput is measured (default: %(default)s)" )
+    parser.add_argument('--stall', type=float, default=900, help="seconds without new accumulations before a run is reported stalled (default: %(default)s)" )
+    parser.add_argument('--poll', action='store_true', help="poll instead of inotify, for logs written on other machines (default: %(default)s)" )
+    parser.add_argument('--poll_interval', type=float, default=5, help="seconds between polls (default: %(default)s)" )
+    parser.add_argument('--batch', type=int, default=200, help="solute directories checked per step of a poll (default: %(default)s)" )
+    parser.add_argument('-m','--marker', default=MARKER, help="regular expression of the log lines counted as accumulations (default: %(default)s)" )
+    parser.add_argument('-a','--all', action='store_true', help="also list finished runs (default: %(default)s)" )
+    parser.add_argument('--once', action='store_true', help="print accumulations done and exit (default: %(default)s)" )
+    args = parser.parse_args()
+
+    home_dir = os.getcwd()
+    if args.solutes:
+        solutes = state.read_solutes(args.solutes)
+    else:
+        solutes = [r[0] for r in state.connect(home_dir).execute('SELECT solute FROM solutes ORDER BY solute')]
+    monitor = Monitor(home_dir,solutes,marker=args.marker,window=args.window,stall=args.stall)
+
+    if args.once == True :
+        monitor.scan(time.monotonic())
+        print(report(monitor.rows(time.monotonic()),show_all=True))
+    else :
+        try:
+            asyncio.run(watch(monitor,args.interval,args.poll,args.poll_interval,args.batch,args.all))
+        except KeyboardInterrupt:
+            pass
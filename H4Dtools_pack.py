@@ -0,0 +1,98 @@
+import os
+import math
+import heapq
+import H4Dtools_jobs as jobs
+
+"""
+
+Packing of many short h4dmc.x runs into multi-core jobs
+
+    Each run (solute directory, stage, index) gets a cost estimate from the solute size,
+    its flexibility and the run parameters. Runs are distributed over njobs jobs of ncores cores
+    by longest-processing-time-first (LPT) : runs sorted by decreasing cost, each one given to the
+    least loaded core. Inside a job, a worker loop (xargs -P ncores) starts the runs of the pack
+    longest first, so that the cores finish at about the same time.
+
+"""
+
+def solute_sites(mol_dir,solute):
+    ''' Nb of sites of the solute (2nd line of {solute}.in) '''
+    with open(os.path.join(mol_dir,solute + '.in'),'r') as f:
+        f.readline()
+        return int(f.readline().split()[0])
+
+
+def water_molecules(mol_dir,solute,default=100):
+    ''' Nb of water molecules from the parametres section of acc_{solute}_ins0 '''
+    path = os.path.join(mol_dir,'acc_{}_ins0'.format(solute))
+    if not os.path.isfile(path):
+        return default
+    with open(path,'r') as f:
+        f.readline()
+        return int(f.readline().split()[0])
+
+
+def estimate_cost(args,mol_dir,solute,stage):
+    ''' Relative cost of a run : nb of MC moves x nb of interacting sites
+        (flexible solutes, with a .top file, also generate conformers in vacuum) '''
+    nsites = solute_sites(mol_dir,solute)
+    nwat = args.N if 'N' in vars(args) else water_molecules(mol_dir,solute)
+    sites = 3*nwat + nsites
+    flexible = os.path.isfile(os.path.join(mol_dir,solute + '.top'))
+    if stage == 'ini':
+        return args.equil * sites
+    if stage == 'des':
+        return args.nacc * args.nint_des * sites
+    cost = args.nacc * args.nint_ins * sites
+    if flexible:
+        cost += args.nacc * args.ngen_vac * nsites**2
+    return cost
+
+
+def lpt(costs,ncores,njobs=None):
+    ''' Longest-processing-time-first distribution of tasks over njobs x ncores cores
+        (njobs default : enough jobs for the mean load per core to reach the longest task)
+        Output : list of task indices per job, each in decreasing cost order '''
+    if not costs:
+        return []
+    if njobs is None:
+        njobs = max(1,math.ceil(sum(costs) / (ncores * max(costs))))
+    cores = [(0,c) for c in range(njobs*ncores)]
+    groups = [[] for j in range(njobs)]
+    for t in sorted(range(len(costs)),key=lambda t: -costs[t]):
+        load, c = heapq.heappop(cores)
+        groups[c//ncores].append(t)
+        heapq.heappush(cores,(load + costs[t],c))
+    return [g for g in groups if g]
+
+
+def write_pack_script(template,dest,manifest,ncores,name='pack',wrapper=None,staging='full'):
+    ''' Write job script running the tasks of manifest, ncores at the same time '''
+    task = sum(jobs.task_lines('${SLURM_SUBMIT_DIR}','$1','$2','$3',wrapper,staging),[])
+    stage_lines = ['# Worker loop : tasks of the pack (solute directory, stage, index) run {} at the same time'.format(ncores),
+                   'run_task() {',
+                   '  cd ${SLURM_RUN_DIR}'] + ['  ' + l for l in task] + ['}',
+                   'export -f run_task']
+    run_lines = ['tail -n +2 {} | cut -f2-4 | xargs -P {} -L 1 bash -c \'run_task "$@"\' _'.format(manifest,ncores)]
+    jobs.transform_template(template,dest,name,['--cpus-per-task={}'.format(ncores)],stage_lines,run_lines)
+
+
+def makespan(costs,ncores):
+    ''' Estimated cost per core of a pack : mean load per core, at least its longest task '''
+    return max(sum(costs)/ncores,max(costs))
+
+
+def write_packs(home_dir,template,rows,costs,stage,ncores,njobs=None,wrapper=None,staging='full'):
+    ''' Distribute rows (solute directory, stage, index) with their costs into pack-{stage}-{n}.tsv
+        manifests and job-pack-{stage}-{n} job scripts
+        Output : list of (job script path, manifest path, estimated cost per core) '''
+    job_files = []
+    for n,group in enumerate(lpt(costs,ncores,njobs=njobs),start=1):
+        manifest = os.path.join(home_dir,'pack-{}-{}.tsv'.format(stage,n))
+        job_file = os.path.join(home_dir,'job-pack-{}-{}'.format(stage,n))
+        jobs.write_manifest(manifest,[rows[t] for t in group])
+        write_pack_script(template,job_file,manifest,ncores,name='{}-{}'.format(stage,n),wrapper=wrapper,staging=staging)
+        load = makespan([costs[t] for t in group],ncores)
+        job_files.append((job_file,manifest,load))
+        print('{} : {} runs, load per core {:.3g}'.format(os.path.basename(job_file),len(group),load))
+    return job_files
@@ -0,0 +1,129 @@
+import os
+import json
+import math
+import argparse
+import H4Dtools_adaptive as adaptive
+
+"""
+
+Pilot runs tuning ins/des speed v, time step dt and maximum altitude wmax per solute (0-pilot.py)
+
+    For a small grid of (v, dt, wmax), each solute (or one solute per class) is initialised with a short
+    equilibration and accumulates one short ins and des segment (pilot/{configuration}/{solute}).
+    As the BAR error (Python estimator, pilots are not analysed by h4dmc.x) decreases as 1/sqrt(CPU time),
+    err**2 x CPU time of the ins/des runs (telemetry) is the CPU time needed to reach an error of 1 kT :
+    the configuration with the smallest one is the most efficient. The best settings per solute are
+    written in a table (pilot-params.tsv) read by 1-initilisation.py -pt, which uses them in the
+    input-ini of each solute ; ins0/des0 files keep them for all production runs.
+
+"""
+
+TABLE = 'pilot-params.tsv'
+TUNED = ['v','dt','wmax']
+COLUMNS = ['solute','class'] + TUNED + ['err','cpu','cost']
+
+
+def spec(v,dt,wmax):
+    ''' Sweep spec of the pilot grid '''
+    return dict(grid=dict(v=list(v),dt=list(dt),wmax=list(wmax)), points=[{}], boxes={})
+
+
+def read_classes(file,solutes):
+    ''' Class of each solute from a file (solute \\t class), each solute its own class without file '''
+    classes = {mol: mol for mol in solutes}
+    if file:
+        with open(file,'r') as f:
+            for line in f:
+                cols = line.rstrip('\n').split('\t')
+                if len(cols) > 1 and cols[0] in classes:
+                    classes[cols[0]] = cols[1]
+    return classes
+
+
+def representatives(classes):
+    ''' First solute of each class {class: solute} '''
+    reps = {}
+    for mol,c in classes.items():
+        reps.setdefault(c,mol)
+    return reps
+
+
+def cpu_seconds(mol_dir,index=1):
+    ''' CPU time (s) of the ins and des runs of index from their telemetry (nan if missing) '''
+    total = 0.0
+    for stage in adaptive.STAGES:
+        path = os.path.join(mol_dir,'metrics-{}-{}.json'.format(stage,index))
+        if not os.path.isfile(path):
+            return math.nan
+        with open(path,'r') as f:
+            record = json.load(f)
+        total += record['cpu_user'] + record['cpu_sys']
+    return total
+
+
+def cost(err,cpu):
+    ''' CPU time to reach an error of 1 kT (nan if unknown) '''
+    if math.isnan(cpu) or math.isnan(err):
+        return math.nan
+    return err**2 * cpu
+
+
+def results(camps,solutes,index=1):
+    ''' BAR error, CPU time and cost of the pilot runs of solutes in each configuration
+        camps : [(configuration directory, arguments, configuration)]
+        Output : list of dict(solute, v, dt, wmax, err, cpu, cost) '''
+    rows = []
+    for camp_dir,camp_args,config in camps:
+        # pilots are not analysed by h4dmc.x (no HFE_cache.json) : Python estimator on their ins/des files
+        errors = adaptive.latest_errors(camp_dir,{mol: dict(ins=index, des=index) for mol in solutes},native=True)
+        for mol in solutes:
+            cpu = cpu_seconds(os.path.join(camp_dir,mol),index)
+            err = errors[mol]['err']
+            row = {k: getattr(camp_args,k) for k in TUNED}
+            row.update(solute=mol, err=err, cpu=cpu, cost=cost(err,cpu))
+            rows.append(row)
+    return rows
+
+
+def best(rows):
+    ''' Most efficient configuration of each solute {solute: row} (solutes without results left out) '''
+    out = {}
+    for row in rows:
+        if math.isnan(row['cost']):
+            continue
+        if row['solute'] not in out or row['cost'] < out[row['solute']]['cost']:
+            out[row['solute']] = row
+    return out
+
+
+def write_table(file,tuned,classes):
+    ''' Write best settings of all solutes, those of the representative of their class
+        Output : nb of solutes in the table '''
+    reps = representatives(classes)
+    n = 0
+    with open(file,'w') as f:
+        f.write('\t'.join(COLUMNS) + '\n')
+        for mol,c in classes.items():
+            row = tuned.get(reps[c])
+            if row is None:
+                continue
+            f.write('\t'.join(str(v) for v in [mol,c] + [row[k] for k in COLUMNS[2:]]) + '\n')
+            n += 1
+    return n
+
+
+def read_table(file):
+    ''' Tuned parameters {solute: dict(v, dt, wmax)} of a pilot table '''
+    with open(file,'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        rows = [dict(zip(header,line.rstrip('\n').split('\t'))) for line in f if line.strip()]
+    return {row['solute']: {k: float(row[k]) for k in TUNED} for row in rows}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Print a pilot parameter table")
+    parser.add_argument('table', nargs='?', default=TABLE, help="pilot table (default: %(default)s)" )
+    args = parser.parse_args()
+    for mol,params in read_table(args.table).items():
+        print('{}\t v {v:g}\t dt {dt:g}\t wmax {wmax:g}'.format(mol,**params))
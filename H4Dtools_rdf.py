@@ -0,0 +1,82 @@
+import numpy as np
+import H4Dtools_acc as acc
+
+"""
+
+Radial distribution functions g(r) from the pair histograms of acc_ files
+
+    iacc OO, OH, HH : water-water histograms, columns r, OO, OH, HH
+    iacc solute-O   : solute site - water O histograms, columns r, one per solute site
+    iacc solute-H   : solute site - water H histograms, columns r, one per solute site
+
+    Histograms have nr bins of width dr (parametres section), bin k covering ((k-1) dr, k dr].
+    g(r) is the histogram divided by the volume of its spherical shell, normalised to 1 at long
+    range (mean over the last tail fraction of the bins), so that it does not depend on the units
+    in which h4dmc.x accumulates the histograms.
+
+    Histograms of many files are stacked (solute site columns padded with nan) and normalised in
+    one NumPy operation.
+
+"""
+
+WATER = ['OO', 'OH', 'HH']
+
+
+def read_histograms(file):
+    ''' Pair histograms of an acc file
+        Output : dict(nr, dr, water (3 x nr), solute_O (nsites x nr), solute_H (nsites x nr)) '''
+    data = acc.read_acc(file)
+    head = acc.header(data)
+    nr, dr = int(head['nr']), float(head['dr'])
+    out = dict(nr=nr, dr=dr)
+    out['water'] = np.asarray(acc.table(data,'iacc OO, OH, HH'))[:nr,1:4].T
+    for name,title in [('solute_O','iacc solute-O'),('solute_H','iacc solute-H')]:
+        out[name] = np.atleast_2d(np.asarray(acc.table(data,title)))[:nr,1:].T
+    return out
+
+
+def shell_volumes(nr,dr):
+    ''' Volumes of the spherical shells ((k-1) dr, k dr], k = 1 .. nr '''
+    edges = dr * np.arange(nr+1)
+    return 4*np.pi/3 * np.diff(edges**3)
+
+
+def stack(histograms):
+    ''' Stack histograms of M files (same nr and dr), solute sites padded with nan
+        Output : r (nr), water (M x 3 x nr), solute_O and solute_H (M x S x nr), nsites (M) '''
+    nr, dr = histograms[0]['nr'], histograms[0]['dr']
+    for h in histograms:
+        if h['nr'] != nr or not np.isclose(h['dr'],dr):
+            raise ValueError('histograms with different grids : nr {} dr {} and nr {} dr {}'.format(nr,dr,h['nr'],h['dr']))
+    nsites = np.array([h['solute_O'].shape[0] for h in histograms])
+    water = np.stack([h['water'] for h in histograms])
+    solute = {}
+    for name in ['solute_O','solute_H']:
+        solute[name] = np.full((len(histograms),nsites.max(),nr),np.nan)
+        for m,h in enumerate(histograms):
+            solute[name][m,:h[name].shape[0]] = h[name]
+    return dr*np.arange(1,nr+1), water, solute['solute_O'], solute['solute_H'], nsites
+
+
+def normalise(h,dr,tail=0.1):
+    ''' g(r) of histograms h (... x nr) : divided by shell volumes and by their long range mean
+        (nan for empty histograms) '''
+    nr = h.shape[-1]
+    g = h / shell_volumes(nr,dr)
+    k = max(1,int(round(tail*nr)))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mean = g[...,-k:].mean(axis=-1,keepdims=True)
+        return np.where(mean > 0, g / mean, np.nan)
+
+
+def rdf_files(files,tail=0.1):
+    ''' g(r) of a list of acc files, computed in one batch
+        Output : dict(r, nsites, g_OO, g_OH, g_HH (M x nr), g_solute_O, g_solute_H (M x S x nr)) '''
+    histograms = [read_histograms(f) for f in files]
+    r, water, solute_O, solute_H, nsites = stack(histograms)
+    dr = histograms[0]['dr']
+    g_water = normalise(water,dr,tail)
+    out = dict(r=r, nsites=nsites, g_solute_O=normalise(solute_O,dr,tail), g_solute_H=normalise(solute_H,dr,tail))
+    out.update({'g_' + pair: g_water[:,k] for k,pair in enumerate(WATER)})
+    return out
+
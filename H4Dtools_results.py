@@ -0,0 +1,147 @@
+import os
+import math
+import sqlite3
+import argparse
+
+"""
+
+Store of HFE results (SQLite, HFE-results.db) : one row per (configuration, solute, index)
+
+    results : HFE, error and nb of accumulations of the analysis of a solute at an index, with the
+              reference HFE (mu0) and volume (V0) of the solutes file, for a configuration (campaign
+              directory, ex. the configurations of a sweep sharing one store with -rdb ../HFE-results.db),
+              and with 3-analysis.py -bs the block bootstrap confidence interval (ci_lo, ci_hi), error,
+              statistical inefficiency and correlation of consecutive segments (H4Dtools_bootstrap.py)
+
+    3-analysis.py appends (or replaces) the rows of each analysis, so that results of all indices and
+    configurations are kept without re-reading HFE-*.csv / HFE_evol.csv files. Rows are indexed by
+    (configuration, solute, index), by (solute, index) and by index, and aggregates are done by SQLite :
+        accuracy : nb of solutes, MAE, RMSE and mean signed error (bias) against mu0 per configuration and index
+        worst    : solutes with the largest errors (or confidence intervals) at their latest (or a given) index
+        history  : HFE and error of a solute at each index (convergence)
+
+    python H4Dtools_results.py accuracy
+    python H4Dtools_results.py worst -n 20 -c T298.15_wTIP3P
+    python H4Dtools_results.py history mobley_1017962
+
+"""
+
+DATABASE = 'HFE-results.db'
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS results (config TEXT, solute TEXT, idx INTEGER, hfe REAL, err REAL, nacc INTEGER,
+                                    mu0 REAL, V0 REAL, ci_lo REAL, ci_hi REAL, err_boot REAL, ineff REAL, seg_corr REAL,
+                                    PRIMARY KEY (config, solute, idx));
+CREATE INDEX IF NOT EXISTS results_solute ON results (solute, idx);
+CREATE INDEX IF NOT EXISTS results_idx ON results (idx, config);
+'''
+BOOTSTRAP = ['ci_lo','ci_hi','err_boot','ineff','seg_corr']
+
+
+def connect(path=DATABASE):
+    ''' Open (and create) a results store '''
+    db = sqlite3.connect(path,timeout=60)
+    db.executescript(_schema)
+    return db
+
+
+def config_name(home_dir,path=DATABASE):
+    ''' Configuration of a campaign directory : its path relative to the store (its name if the store is in it) '''
+    name = os.path.relpath(os.path.abspath(home_dir),os.path.dirname(os.path.abspath(path)))
+    return os.path.basename(os.path.abspath(home_dir)) if name == '.' else name
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError,ValueError):
+        return None
+
+
+def append(db,config,results,V0=None,mu0=None):
+    ''' Save analysis results dict(mol, i, hfe, err, nacc, and optionally ci_lo, ci_hi, err_boot, ineff, seg_corr)
+        of a configuration, with the V0 and mu0 {solute: value} of the solutes file
+        Output : nb of saved rows '''
+    rows = []
+    for r in results:
+        nacc = _float(r.get('nacc'))
+        rows.append((config,r['mol'],r['i'],_float(r['hfe']),_float(r['err']),None if nacc is None else int(nacc),
+                     (mu0 or {}).get(r['mol']),(V0 or {}).get(r['mol'])) + tuple(_float(r.get(c)) for c in BOOTSTRAP))
+    with db:
+        db.executemany('INSERT OR REPLACE INTO results (config, solute, idx, hfe, err, nacc, mu0, V0, {}) VALUES ({})'.format(
+                       ', '.join(BOOTSTRAP),','.join('?'*(8 + len(BOOTSTRAP)))),rows)
+    return len(rows)
+
+
+def _where(config=None,index=None,alias=''):
+    clauses, values = [], []
+    if config is not None:
+        clauses.append(alias + 'config = ?')
+        values.append(config)
+    if index is not None:
+        clauses.append(alias + 'idx = ?')
+        values.append(index)
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), values
+
+
+def accuracy(db,config=None,index=None):
+    ''' Rows (config, index, nb of solutes, MAE, RMSE, mean signed error (bias)) of HFE against mu0 '''
+    where, values = _where(config,index)
+    where += (' AND' if where else ' WHERE') + ' hfe IS NOT NULL AND mu0 IS NOT NULL'
+    rows = db.execute('''SELECT config, idx, COUNT(*), AVG(ABS(hfe - mu0)), AVG((hfe - mu0)*(hfe - mu0)), AVG(hfe - mu0)
+                         FROM results{} GROUP BY config, idx ORDER BY config, idx'''.format(where),values).fetchall()
+    return [(c,i,n,mae,math.sqrt(msq),bias) for c,i,n,mae,msq,bias in rows]
+
+
+def worst(db,config=None,index=None,n=10,by='err'):
+    ''' Rows (config, solute, index, hfe, err, nacc, mu0, ci_lo, ci_hi) of the n largest errors (by err)
+        or bootstrap confidence intervals (by ci), at the latest index of each solute if index is not given '''
+    where, values = _where(config,index,'r.')
+    if index is None:
+        where += (' AND' if where else ' WHERE') + ' r.idx = (SELECT MAX(idx) FROM results l WHERE l.config = r.config AND l.solute = r.solute)'
+    order = 'r.ci_hi - r.ci_lo' if by == 'ci' else 'r.err'
+    return db.execute('''SELECT r.config, r.solute, r.idx, r.hfe, r.err, r.nacc, r.mu0, r.ci_lo, r.ci_hi FROM results r{}
+                         ORDER BY {} DESC LIMIT ?'''.format(where,order),values + [n]).fetchall()
+
+
+def history(db,solute,config=None):
+    ''' Rows (config, index, hfe, err, nacc, mu0, ci_lo, ci_hi, ineff, seg_corr) of a solute '''
+    where, values = _where(config)
+    where += (' AND' if where else ' WHERE') + ' solute = ?'
+    return db.execute('SELECT config, idx, hfe, err, nacc, mu0, ci_lo, ci_hi, ineff, seg_corr FROM results{} ORDER BY config, idx'.format(where),
+                      values + [solute]).fetchall()
+
+
+def _fmt(value):
+    return 'nan' if value is None else '{:.4f}'.format(value)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Queries of the HFE results store")
+    parser.add_argument('command', choices=['accuracy','worst','history'], help="MAE/RMSE against mu0 per configuration and index, solutes with the largest errors, or HFEs of a solute per index")
+    parser.add_argument('solute', nargs='?', help="solute of history")
+    parser.add_argument('-c','--config', help="configuration (default: all)" )
+    parser.add_argument('-i', type=int, help="index (default: all, latest index of each solute for worst)" )
+    parser.add_argument('-n', type=int, default=10, help="nb of solutes printed by worst (default: %(default)s)" )
+    parser.add_argument('--by', choices=['err','ci'], default='err', help="worst by error or by width of the bootstrap confidence interval (default: %(default)s)" )
+    parser.add_argument('-rdb','--results_db', default=DATABASE, help="results store (default: %(default)s)" )
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.results_db):
+        parser.error('{} does not exist (written by 3-analysis.py)'.format(args.results_db))
+    db = connect(args.results_db)
+    if args.command == 'accuracy':
+        print('config\tindex\tn\tMAE\tRMSE\tbias')
+        for c,i,n,mae,rmse,bias in accuracy(db,args.config,args.i):
+            print('{}\t{}\t{}\t{:.4f}\t{:.4f}\t{:.4f}'.format(c,i,n,mae,rmse,bias))
+    elif args.command == 'worst':
+        print('config\tsolute\tindex\tHFE\terr\tnacc\tmu0\tci_lo\tci_hi')
+        for c,mol,i,hfe,err,nacc,mu0,lo,hi in worst(db,args.config,args.i,args.n,args.by):
+            print('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(c,mol,i,_fmt(hfe),_fmt(err),nacc,_fmt(mu0),_fmt(lo),_fmt(hi)))
+    else:
+        if args.solute is None:
+            parser.error('history needs a solute')
+        print('config\tindex\tHFE\terr\tnacc\tmu0\tci_lo\tci_hi\tineff\tseg_corr')
+        for c,i,hfe,err,nacc,mu0,lo,hi,ineff,corr in history(db,args.solute,args.config):
+            print('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(c,i,_fmt(hfe),_fmt(err),nacc,_fmt(mu0),_fmt(lo),_fmt(hi),_fmt(ineff),_fmt(corr)))
@@ -0,0 +1,261 @@
+import os
+import re
+import time
+import subprocess
+import threading
+import itertools
+import concurrent.futures
+
+"""
+
+Job scheduler backends : submission, status, cancellation, dependencies and job arrays
+
+    slurm       : sbatch / squeue / sacct / scancel
+    loadleveler : llsubmit / llq / llcancel (no dependencies between separate jobs, no arrays)
+    local       : runs job scripts with bash on a bounded pool of processes on the current machine,
+                  with SLURM_SUBMIT_DIR / SLURM_RUN_DIR / SLURM_ARRAY_TASK_ID set as on a cluster
+
+    get_scheduler(name) returns the backend used by the scripts for their -j option.
+
+"""
+
+PENDING, RUNNING, COMPLETED, FAILED, CANCELLED, UNKNOWN = 'PENDING', 'RUNNING', 'COMPLETED', 'FAILED', 'CANCELLED', 'UNKNOWN'
+
+
+class Scheduler:
+    ''' Interface of job scheduler backends '''
+
+    name = None
+    supports_array = False
+    supports_dependencies = False
+
+    def submit(self,job_file,cwd,dependencies=None,array=None,options=None):
+        ''' Submit job_file from directory cwd, after successful end of jobs in dependencies
+            array = (ntasks, throttle) for job arrays, options = extra scheduler options
+            Output : job id '''
+        raise NotImplementedError
+
+    def status(self,job_ids):
+        ''' Output : {job id: state}, with the tasks {job id}_{task} of job arrays that have their own state '''
+        raise NotImplementedError
+
+    def cancel(self,job_ids):
+        raise NotImplementedError
+
+    def wait(self):
+        ''' Wait for submitted jobs when they run on this machine '''
+        pass
+
+
+def _run(cmd,cwd=None):
+    proc = subprocess.run(cmd,cwd=cwd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError('{} failed : {}'.format(' '.join(cmd),proc.stderr.strip()))
+    return proc.stdout
+
+
+class SlurmScheduler(Scheduler):
+
+    name = 'slurm'
+    supports_array = True
+    supports_dependencies = True
+    states = dict(PENDING=PENDING, CONFIGURING=PENDING, RUNNING=RUNNING, COMPLETING=RUNNING, COMPLETED=COMPLETED,
+                  FAILED=FAILED, TIMEOUT=FAILED, OUT_OF_MEMORY=FAILED, NODE_FAIL=FAILED, CANCELLED=CANCELLED)
+
+    def submit(self,job_file,cwd,dependencies=None,array=None,options=None):
+        cmd = ['sbatch','--parsable']
+        if dependencies:
+            cmd.append('--dependency=afterok:' + ':'.join(str(j) for j in dependencies))
+        if array:
+            ntasks, throttle = array
+            cmd.append('--array=1-{}'.format(ntasks) + ('%{}'.format(throttle) if throttle else ''))
+        cmd += list(options or []) + [job_file]
+        return _run(cmd,cwd=cwd).strip().split(';')[0]
+
+    def status(self,job_ids):
+        states = {str(j): UNKNOWN for j in job_ids}
+        if not job_ids:
+            return states
+        ids = ','.join(str(j) for j in job_ids)
+        for line in _run(['sacct','-n','-X','-P','-o','JobID,State','-j',ids]).splitlines():
+            job, state = line.split('|')[:2]
+            state = self.states.get(state.split()[0],UNKNOWN)
+            base, sep, task = job.partition('_')
+            if sep == '' or task.isdigit():
+                # job, or array task with its own row
+                states[job] = state
+            elif base in states:
+                # tasks not started yet (123_[4-10%2]) : state of the array
+                states[base] = state
+        return states
+
+    def cancel(self,job_ids):
+        if job_ids:
+            _run(['scancel'] + [str(j) for j in job_ids])
+
+
+class LoadLevelerScheduler(Scheduler):
+
+    name = 'loadleveler'
+    states = dict(I=PENDING, H=PENDING, ST=RUNNING, R=RUNNING, C=COMPLETED, RM=CANCELLED, CA=CANCELLED, NR=FAILED, V=FAILED)
+
+    def submit(self,job_file,cwd,dependencies=None,array=None,options=None):
+        if dependencies or array:
+            raise NotImplementedError('loadleveler : no dependencies between separate jobs nor job arrays')
+        out = _run(['llsubmit'] + list(options or []) + [job_file],cwd=cwd)
+        match = re.search(r'job "([^"]+)"',out)
+        return match.group(1) if match else out.strip()
+
+    def status(self,job_ids):
+        states = {str(j): UNKNOWN for j in job_ids}
+        for job in states:
+            proc = subprocess.run(['llq','-f','%st',job],stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+            lines = [l.split() for l in proc.stdout.splitlines()[2:] if l.strip()]
+            if lines and lines[0]:
+                states[job] = self.states.get(lines[0][0],UNKNOWN)
+        return states
+
+    def cancel(self,job_ids):
+        if job_ids:
+            _run(['llcancel'] + [str(j) for j in job_ids])
+
+
+# Commands of cluster job scripts that do not exist on a workstation
+_local_env = '''module() { :; }
+source() { if [ -f "$1" ] ; then builtin source "$@" ; fi ; }
+if ! command -v rsync > /dev/null ; then rsync() { :; } ; fi
+'''
+
+
+# Job numbers of the local schedulers of this process
+_local_ids = itertools.count(1)
+
+
+class LocalScheduler(Scheduler):
+    ''' Runs job scripts on the current machine, at most ncores at the same time
+        Job ids are {pid}-{n}, unique across the runs of the scripts (outputs local-{id}.out, runs table) '''
+
+    name = 'local'
+    supports_array = True
+    supports_dependencies = True
+
+    def __init__(self,ncores=None):
+        self.ncores = ncores or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.ncores)
+        self.lock = threading.RLock()
+        self.jobs = {}
+        self.waiting = []
+        self.env_file = None
+
+    def _env(self,cwd,task=None):
+        if self.env_file is None:
+            self.env_file = os.path.join(os.getcwd(),'.h4d-local-env.sh')
+            with open(self.env_file,'w') as f:
+                f.write(_local_env)
+        env = dict(os.environ, SLURM_SUBMIT_DIR=cwd, SLURM_RUN_DIR=cwd, BASH_ENV=self.env_file)
+        if task is not None:
+            env['SLURM_ARRAY_TASK_ID'] = str(task)
+        return env
+
+    def _execute(self,job,task):
+        proc = subprocess.run(['bash',job['file']],cwd=job['cwd'],env=self._env(job['cwd'],task),
+                              stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+        with open(os.path.join(job['cwd'],'local-{}{}.out'.format(job['id'],'' if task is None else '_{}'.format(task))),'w') as f:
+            f.write(proc.stdout)
+        return proc.returncode
+
+    def _start(self,job):
+        tasks = [None] if job['array'] is None else range(1,job['array'][0]+1)
+        job['state'] = RUNNING
+        job['futures'] = [self.pool.submit(self._execute,job,t) for t in tasks]
+        for fut in job['futures']:
+            fut.add_done_callback(lambda fut, job=job: self._done(job))
+
+    def _done(self,job):
+        with self.lock:
+            if job['state'] != RUNNING or not all(f.done() for f in job['futures']):
+                return
+            ok = all(f.exception() is None and f.result() == 0 for f in job['futures'])
+            job['state'] = COMPLETED if ok else FAILED
+            self._release()
+
+    def _release(self):
+        ''' Start waiting jobs whose dependencies are done (cancel them if one failed) '''
+        for job in list(self.waiting):
+            # already started or cancelled by a nested release (a job ending before its callback is set)
+            if job not in self.waiting or job['state'] != PENDING:
+                continue
+            # dependencies unknown to this scheduler are considered done
+            deps = [self.jobs[d]['state'] if d in self.jobs else COMPLETED for d in job['deps']]
+            if any(s in (FAILED,CANCELLED) for s in deps):
+                self.waiting.remove(job)
+                job['state'] = CANCELLED
+            elif all(s == COMPLETED for s in deps):
+                self.waiting.remove(job)
+                self._start(job)
+
+    def submit(self,job_file,cwd,dependencies=None,array=None,options=None):
+        with self.lock:
+            job = dict(id='{}-{}'.format(os.getpid(),next(_local_ids)), file=os.path.abspath(os.path.join(cwd,job_file)), cwd=os.path.abspath(cwd),
+                       deps=[str(d) for d in dependencies or []], array=array, state=PENDING, futures=[])
+            self.jobs[job['id']] = job
+            self.waiting.append(job)
+            self._release()
+        return job['id']
+
+    def _task_state(self,job,fut):
+        if job['state'] in (PENDING,CANCELLED) or not fut.done():
+            return job['state']
+        if fut.cancelled():
+            return CANCELLED
+        return COMPLETED if fut.exception() is None and fut.result() == 0 else FAILED
+
+    def status(self,job_ids):
+        states = {}
+        with self.lock:
+            for j in job_ids:
+                job = self.jobs.get(str(j))
+                states[str(j)] = job['state'] if job else UNKNOWN
+                if job and job['array'] is not None:
+                    states.update({'{}_{}'.format(j,t): self._task_state(job,fut) for t,fut in enumerate(job['futures'],start=1)})
+        return states
+
+    def cancel(self,job_ids):
+        with self.lock:
+            for j in job_ids:
+                job = self.jobs.get(str(j))
+                if job is None:
+                    continue
+                for fut in job['futures']:
+                    fut.cancel()
+                if job in self.waiting:
+                    self.waiting.remove(job)
+                if job['state'] in (PENDING,RUNNING):
+                    job['state'] = CANCELLED
+            self._release()
+
+    def wait(self):
+        ''' Block until all submitted jobs are finished or cancelled '''
+        while True:
+            with self.lock:
+                futures = [f for job in self.jobs.values() for f in job['futures'] if not f.done()]
+                waiting = [job for job in self.waiting if job['state'] == PENDING]
+            if futures:
+                concurrent.futures.wait(futures)
+            elif waiting:
+                # dependencies are done but their callbacks have not released these jobs yet
+                time.sleep(0.05)
+            else:
+                return
+
+
+SCHEDULERS = dict(slurm=SlurmScheduler, loadleveler=LoadLevelerScheduler, local=LocalScheduler)
+
+
+def get_scheduler(name,ncores=None):
+    ''' Scheduler backend from its name (slurm, loadleveler or local) '''
+    if name not in SCHEDULERS:
+        raise ValueError('Unknown job handeling system {} : {}'.format(name,', '.join(SCHEDULERS)))
+    if name == 'local':
+        return LocalScheduler(ncores=ncores)
+    return SCHEDULERS[name]()
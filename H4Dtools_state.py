@@ -0,0 +1,229 @@
+import os
+import re
+import json
+import sqlite3
+import argparse
+import H4Dtools_scheduler as scheduler
+
+"""
+
+Campaign state database (SQLite, campaign-state.db in the campaign directory)
+
+    solutes : per solute, its stage (none, ini, prod, str), latest ins/des/s index (-1 if none),
+              total size of its acc_/r_ files, mtime of its directory and latest mtime of its latest
+              acc_ files at the last scan
+    files   : acc_{solute}_{ins|des|s}{i} and r_ files with their size
+    runs    : per (solute, stage, index) run, job id, state and exit status of h4dmc.x
+              (replicas of a run as stage-r{k})
+
+    A solute directory is read in a single os.scandir pass, and only again when its mtime has changed
+    (files created, renamed or removed, as when a job copies its outputs back) or when one of its latest
+    acc_ files changed size or mtime (rewritten in place, which leaves the directory mtime unchanged,
+    as with rsync --inplace or a merge into an existing file). Exit status comes from
+    the telemetry files metrics-{stage}-{index}.json when present, otherwise from the job scheduler.
+    Latest indices are the end of the contiguous chain of files from index 0, as auto_sim_index did.
+    Files archived by H4Dtools_archive.py ({name}.xz / .zst) count as present.
+
+"""
+
+DATABASE = 'campaign-state.db'
+KINDS = ['ins','des','s']
+FINAL = ['COMPLETED','FAILED','CANCELLED']
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS solutes (solute TEXT PRIMARY KEY, stage TEXT, ins INTEGER, des INTEGER, s INTEGER,
+                                    size INTEGER, mtime_ns INTEGER, latest_ns INTEGER);
+CREATE TABLE IF NOT EXISTS files (solute TEXT, name TEXT, kind TEXT, idx INTEGER, size INTEGER,
+                                  PRIMARY KEY (solute, name));
+CREATE TABLE IF NOT EXISTS runs (solute TEXT, stage TEXT, idx INTEGER, job_id TEXT, state TEXT, exit INTEGER,
+                                 PRIMARY KEY (solute, stage, idx));
+'''
+
+
+def connect(home_dir,database=DATABASE):
+    ''' Open (and create) the campaign state database of home_dir '''
+    db = sqlite3.connect(os.path.join(home_dir,database),timeout=60)
+    db.executescript(_schema)
+    return db
+
+
+def _pattern(solute):
+    return re.compile(r'^(acc|r)_{}_(ins|des|s)(\d+)(?:\.xz|\.zst)?$'.format(re.escape(solute)))
+
+
+def chain_end(indices):
+    ''' Last index of the contiguous chain 0, 1, 2 ... in indices (-1 if index 0 is missing) '''
+    i = 0
+    while i in indices:
+        i += 1
+    return i - 1
+
+
+def scan(mol_dir,solute):
+    ''' Read solute directory in one pass
+        Output : dict(ins, des, s) latest indices, list of (name, kind, index, size) files, {(stage, index): exit} '''
+    pattern = _pattern(solute)
+    found = {kind: set() for kind in KINDS}
+    files, exits = [], {}
+    with os.scandir(mol_dir) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match:
+                kind, i = match.group(2), int(match.group(3))
+                files.append((entry.name,kind,i,entry.stat().st_size))
+                if match.group(1) == 'acc':
+                    found[kind].add(i)
+            elif entry.name.startswith('metrics-') and entry.name.endswith('.json'):
+                with open(entry.path,'r') as f:
+                    record = json.load(f)
+                stage = record['stage'] + ('-r{}'.format(record['replica']) if record.get('replica') else '')
+                exits[(stage,record['index'])] = record['exit']
+    return {kind: chain_end(found[kind]) for kind in KINDS}, files, exits
+
+
+def latest_files(mol_dir,solute,index):
+    ''' Size and mtime of the latest acc_ file of each kind : {name: (size, mtime_ns)} (missing files : None) '''
+    out = {}
+    for kind in KINDS:
+        if index[kind] < 0:
+            continue
+        name = 'acc_{}_{}{}'.format(solute,kind,index[kind])
+        try:
+            st = os.stat(os.path.join(mol_dir,name))
+            out[name] = (st.st_size,st.st_mtime_ns)
+        except FileNotFoundError:
+            out[name] = None
+    return out
+
+
+def _changed_in_place(db,mol_dir,solute,index,latest_ns):
+    ''' True if a latest acc_ file changed size or mtime since the last scan '''
+    latest = latest_files(mol_dir,solute,index)
+    sizes = dict(db.execute('SELECT name, size FROM files WHERE solute = ? AND name IN ({})'.format(','.join('?'*len(latest))),
+                            [solute] + list(latest)))
+    if any(st is not None and sizes.get(name) != st[0] for name,st in latest.items()):
+        return True
+    return max([st[1] for st in latest.values() if st is not None],default=None) != latest_ns
+
+
+def solute_stage(index):
+    ''' Last stage reached by a solute from its latest indices '''
+    if index['s'] > 0:
+        return 'str'
+    if index['ins'] > 0 or index['des'] > 0:
+        return 'prod'
+    if index['ins'] == 0 or index['des'] == 0 or index['s'] == 0:
+        return 'ini'
+    return 'none'
+
+
+def refresh(db,home_dir,solutes,force=False):
+    ''' Update solutes whose directory changed since the last scan (all of them if force)
+        Output : nb of scanned directories '''
+    known = {row[0]: row[1:] for row in db.execute('SELECT solute, mtime_ns, ins, des, s, latest_ns FROM solutes')}
+    scanned = 0
+    with db:
+        for solute in solutes:
+            mol_dir = os.path.join(home_dir,solute)
+            try:
+                mtime = os.stat(mol_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if force == False and solute in known and known[solute][0] == mtime:
+                if not _changed_in_place(db,mol_dir,solute,dict(zip(KINDS,known[solute][1:4])),known[solute][4]):
+                    continue
+            index, files, exits = scan(mol_dir,solute)
+            latest_ns = max([st[1] for st in latest_files(mol_dir,solute,index).values() if st is not None],default=None)
+            db.execute('INSERT OR REPLACE INTO solutes (solute, stage, ins, des, s, size, mtime_ns, latest_ns) VALUES (?,?,?,?,?,?,?,?)',
+                       (solute,solute_stage(index),index['ins'],index['des'],index['s'],sum(f[3] for f in files),mtime,latest_ns))
+            db.execute('DELETE FROM files WHERE solute = ?',(solute,))
+            db.executemany('INSERT INTO files VALUES (?,?,?,?,?)',[(solute,) + f for f in files])
+            for (stage,i),status in exits.items():
+                db.execute('INSERT OR IGNORE INTO runs (solute, stage, idx) VALUES (?,?,?)',(solute,stage,i))
+                db.execute('UPDATE runs SET exit = ?, state = ? WHERE solute = ? AND stage = ? AND idx = ?',
+                           (status,'COMPLETED' if status == 0 else 'FAILED',solute,stage,i))
+            scanned += 1
+    return scanned
+
+
+def indices(db,solute):
+    ''' Latest ins/des/s indices of a solute (all -1 if unknown) '''
+    row = db.execute('SELECT ins, des, s FROM solutes WHERE solute = ?',(solute,)).fetchone()
+    return dict(zip(KINDS,row if row else (-1,-1,-1)))
+
+
+def sim_index(index):
+    ''' Index reached by both ins and des (or by s for structures) '''
+    if index['ins'] >= 0 or index['des'] >= 0:
+        return min(index['ins'],index['des'])
+    return index['s']
+
+
+def record_job(db,solute,stage,index,job_id):
+    ''' Save submission of the run (solute, stage, index) '''
+    with db:
+        db.execute('INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?)',(solute,stage,index,str(job_id),'PENDING',None))
+
+
+def runs(db,solute,index):
+    ''' Runs of a solute at index {stage: (state, exit)} '''
+    return {row[0]: tuple(row[1:]) for row in db.execute('SELECT stage, state, exit FROM runs WHERE solute = ? AND idx = ?',(solute,index))}
+
+
+def queued(db,solute):
+    ''' True if a run of the solute is pending or running '''
+    return db.execute("SELECT COUNT(*) FROM runs WHERE solute = ? AND state IN ('PENDING','RUNNING')",(solute,)).fetchone()[0] > 0
+
+
+def update_jobs(db,sched):
+    ''' Update state of unfinished runs from the job scheduler '''
+    rows = db.execute('SELECT rowid, job_id FROM runs WHERE job_id IS NOT NULL AND state NOT IN ({})'.format(','.join('?'*len(FINAL))),FINAL).fetchall()
+    if not rows:
+        return
+    states = sched.status(sorted(set(job_id.split('_')[0] for rowid,job_id in rows)))
+    with db:
+        for rowid,job_id in rows:
+            # array tasks ({job id}_{task}) : their own state, that of the array while they have none
+            state = states.get(job_id,'UNKNOWN')
+            if state == 'UNKNOWN':
+                state = states.get(job_id.split('_')[0],'UNKNOWN')
+            if state != 'UNKNOWN':
+                db.execute('UPDATE runs SET state = ? WHERE rowid = ?',(state,rowid))
+
+
+def status(db):
+    ''' Rows (solute, stage, ins, des, s, size, pending/running runs, failed runs) '''
+    return db.execute('''SELECT s.solute, s.stage, s.ins, s.des, s.s, s.size,
+                                (SELECT COUNT(*) FROM runs r WHERE r.solute = s.solute AND r.state IN ('PENDING','RUNNING')),
+                                (SELECT COUNT(*) FROM runs r WHERE r.solute = s.solute AND r.state IN ('FAILED','CANCELLED'))
+                         FROM solutes s ORDER BY s.solute''').fetchall()
+
+
+def read_solutes(file):
+    ''' Solute names (1st column) of a solutes database file '''
+    with open(file,'r') as f:
+        return [line.split('\t')[0].strip() for line in f if line.strip()][1:]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Campaign state database")
+    parser.add_argument('command', choices=['status','refresh'], help="print state of solutes, or rescan solute directories")
+    parser.add_argument('-s','--solutes', help="File containing solute's names (default: solutes already in the database)" )
+    parser.add_argument('-j', choices=list(scheduler.SCHEDULERS), help="update state of submitted runs from the job handeling system" )
+    parser.add_argument('--force', action='store_true', help="rescan all solute directories (default: %(default)s)" )
+    parser.add_argument('--database', default=DATABASE, help="database file (default: %(default)s)" )
+    args = parser.parse_args()
+
+    home_dir = os.getcwd()
+    db = connect(home_dir,args.database)
+    solutes = read_solutes(args.solutes) if args.solutes else [r[0] for r in db.execute('SELECT solute FROM solutes')]
+    scanned = refresh(db,home_dir,solutes,force=args.force or args.command == 'refresh')
+    if args.j:
+        update_jobs(db,scheduler.get_scheduler(args.j))
+    if args.command == 'refresh':
+        print('{} solute directories scanned'.format(scanned))
+    else:
+        print('solute\tstage\tins\tdes\ts\tsize(MB)\tqueued\tfailed')
+        for row in status(db):
+            print('{}\t{}\t{}\t{}\t{}\t{:.1f}\t{}\t{}'.format(*row[:5],row[5]/1e6,*row[6:]))
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+
+"""
+
+Content-addressed store for files shared by all solute directories (h4dmc.x, dummy.in, dummy.top,
+reference acc_/r_ water boxes)
+
+    Files are added once to {store}/objects/{sha256[:2]}/{sha256[2:]} (read-only) and deployed into
+    each solute directory with one of the strategies :
+        reflink  : copy-on-write clone (btrfs, xfs, ...)
+        hardlink : hard link to the store object (store and campaign on the same filesystem)
+        symlink  : symbolic link to the store object (store reachable from the compute nodes)
+        copy     : plain copy
+        auto     : reflink, then hardlink, then copy
+    Each solute directory keeps a manifest (.store-manifest.json) of the deployed files and their digests,
+    checked by 'python H4Dtools_store.py verify'.
+
+"""
+
+STRATEGIES = ['auto', 'reflink', 'hardlink', 'symlink', 'copy']
+MANIFEST = '.store-manifest.json'
+FICLONE = 0x40049409
+
+
+def file_digest(path):
+    ''' sha256 of file content '''
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def object_path(store_dir,digest):
+    return os.path.join(store_dir,'objects',digest[:2],digest[2:])
+
+
+def store_add(path,store_dir):
+    ''' Add a file to the store (nothing is written if already there)
+        Output : digest '''
+    digest = file_digest(path)
+    obj = object_path(store_dir,digest)
+    if not os.path.isfile(obj):
+        os.makedirs(os.path.dirname(obj),exist_ok=True)
+        tmp = obj + '.tmp{}'.format(os.getpid())
+        shutil.copyfile(path,tmp)
+        # objects are read-only, executables stay executable
+        os.chmod(tmp,0o555 if os.access(path,os.X_OK) else 0o444)
+        os.replace(tmp,obj)
+    return digest
+
+
+def _reflink(src,dst):
+    import fcntl
+    with open(src,'rb') as fsrc, open(dst,'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+    shutil.copymode(src,dst)
+
+
+def _deploy(obj,tmp,strategy):
+    if strategy == 'reflink':
+        _reflink(obj,tmp)
+    elif strategy == 'hardlink':
+        os.link(obj,tmp)
+    elif strategy == 'symlink':
+        os.symlink(os.path.abspath(obj),tmp)
+    else:
+        shutil.copy(obj,tmp)
+        os.chmod(tmp,0o755 if os.access(obj,os.X_OK) else 0o644)
+
+
+def deploy(store_dir,digest,dst,strategy='auto'):
+    ''' Put store object digest at dst
+        Output : strategy used '''
+    obj = object_path(store_dir,digest)
+    if os.path.exists(dst) and os.path.samefile(obj,dst):
+        return 'present'
+    tmp = dst + '.tmp{}'.format(os.getpid())
+    candidates = ['reflink','hardlink','copy'] if strategy == 'auto' else [strategy,'copy']
+    for s in candidates:
+        try:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            _deploy(obj,tmp,s)
+            os.replace(tmp,dst)
+            return s
+        except OSError:
+            continue
+    raise OSError('cannot deploy {} to {}'.format(obj,dst))
+
+
+def deploy_files(files,mol_dir,store_dir,strategy='auto'):
+    ''' Deploy {name: digest} into mol_dir and record them in its manifest
+        Output : {name: strategy used} '''
+    used = {name: deploy(store_dir,digest,os.path.join(mol_dir,name),strategy) for name,digest in files.items()}
+    manifest = read_manifest(mol_dir)
+    manifest.update(files)
+    with open(os.path.join(mol_dir,MANIFEST),'w') as f:
+        json.dump(manifest, f, indent=1)
+    return used
+
+
+def read_manifest(mol_dir):
+    path = os.path.join(mol_dir,MANIFEST)
+    if not os.path.isfile(path):
+        return {}
+    with open(path,'r') as f:
+        return json.load(f)
+
+
+def verify(mol_dir,store_dir):
+    ''' Check files of mol_dir manifest against the store
+        Output : list of (name, problem) '''
+    problems = []
+    for name,digest in read_manifest(mol_dir).items():
+        path = os.path.join(mol_dir,name)
+        obj = object_path(store_dir,digest)
+        if not os.path.isfile(obj):
+            problems.append((name,'missing store object'))
+        elif not os.path.isfile(path):
+            problems.append((name,'missing'))
+        elif os.path.samefile(obj,path):
+            continue
+        elif file_digest(path) != digest:
+            problems.append((name,'content differs from store'))
+    return problems
+
+
+def verify_store(store_dir):
+    ''' Check that store objects match their digest
+        Output : list of corrupted objects '''
+    corrupted = []
+    objects = os.path.join(store_dir,'objects')
+    for sub in sorted(os.listdir(objects)) if os.path.isdir(objects) else []:
+        for name in sorted(n for n in os.listdir(os.path.join(objects,sub)) if '.tmp' not in n):
+            if file_digest(os.path.join(objects,sub,name)) != sub + name:
+                corrupted.append(os.path.join(objects,sub,name))
+    return corrupted
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Shared store of campaign input files")
+    parser.add_argument('command', choices=['verify','add'], help="verify solute directories and store objects, or add files to the store")
+    parser.add_argument('paths', nargs='*', help="solute directories (verify) or files (add)")
+    parser.add_argument('--store', default='.h4d-store', help="store directory (default: %(default)s)" )
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        for path in args.paths:
+            print('{}\t {}'.format(store_add(path,args.store),path))
+        sys.exit(0)
+
+    status = 0
+    for obj in verify_store(args.store):
+        print('corrupted store object : {}'.format(obj))
+        status = 1
+    for mol_dir in args.paths:
+        for name,problem in verify(mol_dir,args.store):
+            print('{} : {} : {}'.format(mol_dir,name,problem))
+            status = 1
+    print('OK' if status == 0 else 'Verification failed')
+    sys.exit(status)
@@ -0,0 +1,107 @@
+import os
+import json
+import argparse
+import itertools
+
+"""
+
+Parameter sweeps of the initialisation (1-initilisation.py -sw sweep.json)
+
+    A sweep spec (json) lists the configurations of the campaign :
+        grid   : {parameter: [values]}, all combinations
+        points : [{parameter: value}], single configurations (each combined with the grid)
+        boxes  : {water model or water model-N: reference files}, reference boxes of water settings
+                 different from the command line (-w, -N, -f)
+    Parameters are the arguments of 1-initilisation.py (T, water, wmax, v, dt, Ewald2, N, ...).
+    ex. {"grid": {"T": [288.15, 298.15, 308.15], "water": ["TIP3P", "SPCE"]},
+         "points": [{"v": 0.05, "dt": 0.02}, {"v": 0.1, "dt": 0.01}],
+         "boxes": {"SPCE": "100spce"}}
+
+    Each configuration is a campaign in its own sub-directory {name} (ex. T298.15_wSPCE_v0.1_dt0.01),
+    with the solute directories, params_ini.out, campaign-state.db and a link to input-files, so that
+    2-production.py and 3-analysis.py are run in it as in a single campaign. sweep.json in the campaign
+    directory lists the configurations and their parameters.
+    Configurations with the same water settings (model, N) start from the same reference box, deployed
+    from the shared store ; the others create their box (-b).
+
+"""
+
+LABELS = dict(T='T', water='w', wmax='wmax', v='v', dt='dt', Ewald2='E2', N='N')
+SWEEP = 'sweep.json'
+
+
+def read_spec(file):
+    ''' Sweep spec : dict(grid, points, boxes) '''
+    with open(file,'r') as f:
+        spec = json.load(f)
+    unknown = set(spec) - {'grid','points','boxes'}
+    if unknown:
+        raise ValueError('{} : unknown sweep entries {}'.format(file,', '.join(sorted(unknown))))
+    return dict(grid=spec.get('grid',{}), points=spec.get('points',[{}]) or [{}], boxes=spec.get('boxes',{}))
+
+
+def expand(spec):
+    ''' Configurations {parameter: value} of a sweep spec, in grid order, without duplicates '''
+    names = sorted(spec['grid'])
+    configs = []
+    for point in spec['points']:
+        for values in itertools.product(*(spec['grid'][n] for n in names)):
+            config = dict(point,**dict(zip(names,values)))
+            if config not in configs:
+                configs.append(config)
+    return configs
+
+
+def _label(value):
+    if isinstance(value,(list,tuple)):
+        return '.'.join(str(v) for v in value)
+    return str(value)
+
+
+def config_name(config):
+    ''' Sub-directory name of a configuration (swept parameters and their values) '''
+    return '_'.join('{}{}'.format(LABELS.get(k,k),_label(v)) for k,v in sorted(config.items())) or 'base'
+
+
+def reference_box(args,boxes):
+    ''' Reference files of the water settings (model, N) of args in boxes (None if there are none) '''
+    for key in ['{}-{}'.format(args.water,args.N), args.water]:
+        if key in boxes:
+            return boxes[key]
+    return None
+
+
+def campaigns(spec,args,home_dir):
+    ''' Configurations of the sweep as (campaign directory, arguments, {swept parameter: value})
+        args : command line arguments of 1-initilisation.py (base values of all parameters) '''
+    out = []
+    for config in expand(spec):
+        unknown = set(config) - set(vars(args))
+        if unknown:
+            raise ValueError('unknown sweep parameters {}'.format(', '.join(sorted(unknown))))
+        config_args = argparse.Namespace(**vars(args))
+        for k,v in config.items():
+            setattr(config_args,k,v)
+        # reference box of other water settings than the command line ones
+        if 'infile' not in config and (config_args.water,config_args.N) != (args.water,args.N):
+            config_args.infile = reference_box(config_args,spec['boxes'])
+        if config_args.infile is None:
+            config_args.create_box = True
+        config_args.sweep = None
+        out.append((os.path.join(home_dir,config_name(config)),config_args,config))
+    return out
+
+
+def setup(home_dir,camps,solutes_file,input_dir=None):
+    ''' Create campaign directories of the sweep (link to input-files, solutes file) and sweep.json '''
+    input_dir = input_dir or os.path.join(home_dir,'input-files')
+    for camp_dir,config_args,config in camps:
+        os.makedirs(camp_dir,exist_ok=True)
+        link = os.path.join(camp_dir,'input-files')
+        if not os.path.lexists(link):
+            os.symlink(os.path.relpath(input_dir,camp_dir),link)
+        solutes = os.path.join(camp_dir,os.path.basename(solutes_file))
+        if not os.path.lexists(solutes):
+            os.symlink(os.path.relpath(os.path.abspath(solutes_file),camp_dir),solutes)
+    with open(os.path.join(home_dir,SWEEP),'w') as f:
+        json.dump({os.path.basename(d): dict(config,infile=a.infile,create_box=a.create_box) for d,a,config in camps}, f, indent=2)
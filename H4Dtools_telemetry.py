@@ -0,0 +1,285 @@
+import os
+import re
+import sys
+import json
+import time
+import math
+import socket
+import argparse
+import subprocess
+import H4Dtools_pack as pack
+
+"""
+
+Runtime telemetry of h4dmc.x runs and wall time predictor
+
+    run     : wrapper used in job scripts instead of ./h4dmc.x < input-X > out-X. It records wall time,
+              CPU time, max RSS and bytes read/written by h4dmc.x with the run parameters
+              (params-{stage}.json written by the scripts, solute size, N and Ewald parameters
+              of the loaded acc file) in metrics-{stage}-{index}.json next to the outputs
+              (replicas input-{stage}-r{k} : metrics-{stage}-r{k}-{index}.json, fitted with their stage,
+              decks input-{stage}.{index} of runs queued ahead of time : params-{stage}.{index}.json)
+    collect : gathers metrics-*.json of all solute directories into the campaign store metrics.jsonl
+    fit     : fits log(wall time) per stage on the run parameters (least squares), saved as json
+    predict : predicted wall time of planned runs, used for --time limits and job packing
+
+    run only needs the standard library, so that it can be used on compute nodes.
+
+"""
+
+STORE = 'metrics.jsonl'
+MODEL = 'walltime-model.json'
+
+
+def run_params(args,mol_dir,solute,stage,index=None):
+    ''' Parameters of a planned run of stage from the script arguments and the solute directory '''
+    if stage == 'ini':
+        params = dict(nacc=args.equil, nint=1, ngen_vac=0, flex=os.path.isfile(os.path.join(mol_dir,solute + '.top')))
+    else:
+        params = dict(nacc=args.nacc, nint=args.nint_ins if stage == 'ins' else args.nint_des,
+                      ngen_vac=args.ngen_vac if stage == 'ins' else 0, flex=args.flex)
+    nwat = args.N if 'N' in vars(args) else pack.water_molecules(mol_dir,solute)
+    return dict(solute=solute, index=index, N=nwat, nsites=pack.solute_sites(mol_dir,solute), **params)
+
+
+def run_name(stage,replica=0):
+    ''' Name of the files of a run of stage : stage, or stage-r{replica} for replicas '''
+    return stage + ('-r{}'.format(replica) if replica else '')
+
+
+def split_name(name):
+    ''' Stage and replica (0 if none) of a run name '''
+    match = re.match(r'^(.+)-r(\d+)$',name)
+    return (match.group(1), int(match.group(2))) if match else (name, 0)
+
+
+def write_run_params(mol_dir,stage,replica=0,per_index=False,**params):
+    ''' Save parameters of the next run of stage (replica) in mol_dir/params-{stage}[-r{replica}].json
+        (params-{stage}.{index}.json with per_index, for runs queued ahead of time) '''
+    name = run_name(stage,replica) + ('.{}'.format(params['index']) if per_index else '')
+    with open(os.path.join(mol_dir,'params-{}.json'.format(name)),'w') as f:
+        json.dump(dict(stage=stage,replica=replica,**params), f, indent=1)
+
+
+def read_run_params(run_dir,stage):
+    path = os.path.join(run_dir,'params-{}.json'.format(stage))
+    if not os.path.isfile(path):
+        return {}
+    with open(path,'r') as f:
+        return json.load(f)
+
+
+def acc_parameters(file):
+    ''' N and Ewald parameters from the parametres section of an acc text file '''
+    values = []
+    with open(file,'r') as f:
+        for n,line in enumerate(f):
+            if n == 0:
+                continue
+            if n > 12:
+                break
+            values += line.split()
+    values = [float(v) for v in values]
+    return dict(N=int(values[0]), KL=values[9], Ewald_sr=values[10], Ewald_sk=values[11])
+
+
+def deck_parameters(input_file):
+    ''' Solute and loaded acc file of an input deck '''
+    with open(input_file,'r') as f:
+        lines = [l.strip() for l in f]
+    params = {}
+    for n,line in enumerate(lines[:-1]):
+        if line == '53' and 'acc' not in params:
+            params['acc'] = 'acc_' + lines[n+1].split()[0]
+        if line.endswith('.in') and 'solute_file' not in params:
+            params['solute_file'] = line.split()[0]
+    return params
+
+
+def _proc_io(pid):
+    try:
+        with open('/proc/{}/io'.format(pid),'r') as f:
+            return {k: int(v) for k,v in (l.split(':') for l in f)}
+    except (OSError,ValueError):
+        return None
+
+
+def run(input_file,log_file,exe='./h4dmc.x',interval=5.0):
+    ''' Run exe < input_file > log_file and record its resource usage
+        Output : record (dict) '''
+
+    name = re.sub(r'^input-','',os.path.basename(input_file))
+    stage, replica = split_name(re.sub(r'\.\d+$','',name))
+    match = re.search(r'-(\d+)$',log_file)
+    index = int(match.group(1)) if match else 0
+    run_dir = os.getcwd()
+    record = dict(stage=stage, replica=replica, index=index, host=socket.gethostname(), start=time.time())
+    record.update(read_run_params(run_dir,name))
+
+    # Parameters from the input deck and loaded files
+    deck = deck_parameters(input_file)
+    if deck.get('acc') and os.path.isfile(deck['acc']):
+        record.update(acc_parameters(deck['acc']))
+    solute = record.get('solute', os.path.basename(run_dir))
+    for solute_file in [deck.get('solute_file'), solute + '.in']:
+        if solute_file and os.path.isfile(solute_file):
+            with open(solute_file,'r') as f:
+                f.readline()
+                record['nsites'] = int(f.readline().split()[0])
+            break
+    record.setdefault('solute',solute)
+    record.setdefault('flex',os.path.isfile(solute + '.top'))
+
+    t0 = time.monotonic()
+    io = None
+    with open(input_file,'r') as fin, open(log_file,'w') as fout:
+        proc = subprocess.Popen([exe],stdin=fin,stdout=fout)
+        # poll until exit without reaping, so that the I/O counters of the finished process can still be read
+        delay = 0.01
+        while os.waitid(os.P_PID,proc.pid,os.WEXITED|os.WNOHANG|os.WNOWAIT) is None:
+            io = _proc_io(proc.pid) or io
+            time.sleep(delay)
+            delay = min(2*delay,interval)
+        wall = time.monotonic() - t0
+        io = _proc_io(proc.pid) or io
+        pid, status, usage = os.wait4(proc.pid,0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    record.update(wall=wall, cpu_user=usage.ru_utime, cpu_sys=usage.ru_stime,
+                  maxrss_kb=usage.ru_maxrss, exit=proc.returncode)
+    if io is not None:
+        record.update(read_bytes=io.get('rchar',0), write_bytes=io.get('wchar',0))
+    else:
+        record.update(read_bytes=usage.ru_inblock*512, write_bytes=usage.ru_oublock*512)
+    with open(os.path.join(run_dir,'metrics-{}-{}.json'.format(run_name(stage,replica),index)),'w') as f:
+        json.dump(record, f)
+    return record
+
+
+def wrapper_command():
+    ''' Command replacing ./h4dmc.x in job scripts, followed by input deck and log file '''
+    return 'python3 {} run'.format(os.path.abspath(__file__))
+
+
+def collect(home_dir,store=STORE):
+    ''' Gather metrics-*.json files of solute directories into the campaign store (one json per line)
+        Output : nb of records in the store '''
+    records = {}
+    store_path = os.path.join(home_dir,store)
+    if os.path.isfile(store_path):
+        with open(store_path,'r') as f:
+            for line in f:
+                r = json.loads(line)
+                records[(r['solute'],r['stage'],r['index'],r['start'])] = r
+    for entry in os.scandir(home_dir):
+        if not entry.is_dir():
+            continue
+        for name in os.listdir(entry.path):
+            if name.startswith('metrics-') and name.endswith('.json'):
+                with open(os.path.join(entry.path,name),'r') as f:
+                    r = json.load(f)
+                records[(r['solute'],r['stage'],r['index'],r['start'])] = r
+    with open(store_path + '.tmp','w') as f:
+        for r in sorted(records.values(),key=lambda r: r['start']):
+            f.write(json.dumps(r) + '\n')
+    os.replace(store_path + '.tmp',store_path)
+    return len(records)
+
+
+def load_store(home_dir,store=STORE):
+    with open(os.path.join(home_dir,store),'r') as f:
+        return [json.loads(line) for line in f]
+
+
+def features(r):
+    ''' Regression variables of a run : log of MC moves, log of nb of sites, flexibility, log of vacuum moves '''
+    moves = r.get('nacc',1) * r.get('nint',1)
+    sites = 3*r.get('N',100) + r.get('nsites',1)
+    return [1.0, math.log(max(moves,1)), math.log(sites), float(bool(r.get('flex',False))),
+            math.log1p(r.get('ngen_vac',0) * r.get('nacc',1))]
+
+
+def fit(records):
+    ''' Least squares fit of log(wall time) per stage on features of successful runs
+        Output : model {stage: dict(coef, rms, n)} '''
+    import numpy as np
+    model = {}
+    for stage in sorted(set(r['stage'] for r in records)):
+        runs = [r for r in records if r['stage'] == stage and r.get('exit') == 0 and r['wall'] > 0]
+        if not runs:
+            continue
+        X = np.array([features(r) for r in runs])
+        y = np.log([r['wall'] for r in runs])
+        coef = np.linalg.lstsq(X,y,rcond=None)[0]
+        rms = float(np.sqrt(np.mean((X @ coef - y)**2)))
+        model[stage] = dict(coef=[float(c) for c in coef], rms=rms, n=len(runs))
+    return model
+
+
+def predict(model,stage,params):
+    ''' Predicted wall time (s) of a run of stage with params (dict like a metrics record),
+        None if the model has no fit of the stage (no successful run of it in metrics) '''
+    if stage not in model:
+        return None
+    coef = model[stage]['coef']
+    return math.exp(sum(c*x for c,x in zip(coef,features(params))))
+
+
+def format_time(seconds):
+    ''' Slurm --time value (HH:MM:SS) '''
+    seconds = int(math.ceil(seconds))
+    return '{:02d}:{:02d}:{:02d}'.format(seconds//3600,(seconds%3600)//60,seconds%60)
+
+
+def time_limit(model,seconds,safety=1.5):
+    ''' Slurm --time value for a predicted wall time : prediction x safety x exp(2 rms of the model) '''
+    return format_time(seconds * safety * math.exp(2*max(m['rms'] for m in model.values())))
+
+
+def save_model(file,model):
+    with open(file,'w') as f:
+        json.dump(model, f, indent=1)
+
+
+def load_model(file):
+    with open(file,'r') as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Telemetry of h4dmc.x runs")
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('run', help="run ./h4dmc.x < input > log and record its resource usage")
+    p.add_argument('input')
+    p.add_argument('log')
+    p.add_argument('--exe', default='./h4dmc.x')
+    p = sub.add_parser('collect', help="gather metrics of solute directories in the campaign store")
+    p.add_argument('--home', default='.')
+    p = sub.add_parser('fit', help="fit wall time model on the campaign store")
+    p.add_argument('--home', default='.')
+    p.add_argument('--model', default=MODEL)
+    p = sub.add_parser('predict', help="predict wall time of a run")
+    p.add_argument('stage')
+    p.add_argument('--model', default=MODEL)
+    p.add_argument('--params', nargs='+', default=[], help="key=value run parameters (nacc, nint, N, nsites, flex, ngen_vac)")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        record = run(args.input,args.log,exe=args.exe)
+        sys.exit(record['exit'])
+    if args.command == 'collect':
+        print('{} runs in {}'.format(collect(args.home),os.path.join(args.home,STORE)))
+    if args.command == 'fit':
+        collect(args.home)
+        model = fit(load_store(args.home))
+        save_model(args.model,model)
+        for stage,m in model.items():
+            print('{}\t {} runs\t rms(log wall) {:.3f}'.format(stage,m['n'],m['rms']))
+    if args.command == 'predict':
+        params = {k: json.loads(v) for k,v in (p.split('=',1) for p in args.params)}
+        model = load_model(args.model)
+        seconds = predict(model,args.stage,params)
+        if seconds is None:
+            sys.exit('no {} runs in {}'.format(args.stage,args.model))
+        print('{:.1f} s\t --time={}'.format(seconds,time_limit(model,seconds)))
@@ -5,6 +5,10 @@ import argparse
 import random
 import json 
 import H4Dtools_functions as tools
+import H4Dtools_scheduler as scheduler
+import H4Dtools_store as store
+import H4Dtools_jobs as jobs
+import H4Dtools_state as state
 
 """
 
@@ -32,7 +36,13 @@ Creates initilised and equilibrated starting file for structure accumulations :
         -ss : solute symmetry
         -nmax1 : nmax for solute molecule
         -eq, --equil : nb of equilibration cycles for des
-        -j : job handeler
+        -j : job handeler (slurm, loadleveler or local)
+        -np, --ncores : nb of jobs run at the same time with -j local
+        -stg, --staging : files copied to the compute node : only those of the run (minimal) or the whole solute directory (full)
+        -dp, --deploy : how shared input files are put in solute directories (auto, reflink, hardlink, symlink, copy)
+        --store : directory of the shared store of input files
+        --trace : json lines file of timed phases (csv, setup, copy, input, submit, wait, state ...)
+        --profile : cProfile and tracemalloc of the run (profile-{script}.prof)
 
     Output :
 
@@ -63,10 +73,18 @@ parser.add_argument('-ss', type=int, default=0, help="solute symmetry (default:
 parser.add_argument('-nmax1', type=int, default=0, help="nmax for solute (default: %(default)s sqrt(kT/M)" )
 parser.add_argument('-dt',type=float, default=0.02, help="time step (default: %(default)s sqrt(M/kT)Å" )
 parser.add_argument('-eq','--equil', type=int, default=10000, help="nb of MC equilibartion cycles for destruction (default: %(default)s kT)" )
-parser.add_argument('-j', default="slurm", help=" Job handeling system : slumr or loadleveler  (default: %(default)s)" )
+parser.add_argument('-j', default="slurm", choices=list(scheduler.SCHEDULERS), help=" Job handeling system : slurm, loadleveler or local (default: %(default)s)" )
+parser.add_argument('-np','--ncores', type=int, help="nb of jobs run at the same time on this machine with -j local (default: nb of cores)" )
+parser.add_argument('-stg','--staging', default='minimal', choices=jobs.STAGING, help="files copied to the compute node : those read by the run, or the whole solute directory (default: %(default)s)" )
+parser.add_argument('-dp','--deploy', default='auto', choices=store.STRATEGIES, help="deployment of shared input files : auto (reflink, hardlink or copy), reflink, hardlink, symlink or copy (default: %(default)s)" )
+parser.add_argument('--store', default='.h4d-store', help="shared store of input files (default: %(default)s)" )
 parser.add_argument('-ns','--nostart', action='store_true', help="do not launch jobs (default: %(default)s)" )
+parser.add_argument('--trace', help="append timed phases of the run to TRACE as json lines (default: %(default)s)" )
+parser.add_argument('--profile', action='store_true', help="profile the Python side with cProfile and tracemalloc (default: %(default)s)" )
 args = parser.parse_args()
+tools.instrument(args,__file__)
 print(args)
+sched = scheduler.get_scheduler(args.j,ncores=args.ncores)
 
 # Read parameters from .json file if given
 if args.load_json: args = tools.json2args(args.load_json)
@@ -83,24 +101,29 @@ home_dir = "%s" % os.getcwd()
 input_dir = os.path.join(home_dir,'input-files')
 sol_dir = os.path.join(home_dir,'solutein')
 
+# Add shared input files to the store once
+shared = ['h4dmc.x','dummy.in','dummy.top']
+if args.infile is not None :
+    shared += ['acc_' + args.infile, 'r_' + args.infile]
+store_dir = os.path.join(home_dir,args.store)
+shared_files = {name: store.store_add(os.path.join(input_dir,name),store_dir) for name in shared}
+
+db = state.connect(home_dir)
+
 # Iterate over solutes
 for mol in molecules:
 
     # Create directory per solute
     mol_dir = os.path.join(home_dir,mol)
-    tools.mkdir_p(mol)
-
-    # Copy input files
-    shutil.copy(os.path.join(input_dir,'h4dmc.x'),mol_dir)
-    shutil.copy(os.path.join(input_dir,'dummy.in'),mol_dir)
-    shutil.copy(os.path.join(input_dir,'dummy.top'),mol_dir)
-    shutil.copy(os.path.join(sol_dir,mol + '.in'),mol_dir)
-    if os.path.isfile(os.path.join(sol_dir,mol+'.top')) == True:
-        shutil.copy(os.path.join(sol_dir,mol + '.top'),mol_dir)
+    with tools.timer('setup') :
+        tools.mkdir_p(mol)
 
-    if args.infile is not None :
-        shutil.copy(os.path.join(input_dir,'acc_' + args.infile),mol_dir)
-        shutil.copy(os.path.join(input_dir,'r_' + args.infile),mol_dir)
+    # Deploy shared input files and copy solute files
+    with tools.timer('copy',solute=mol) :
+        store.deploy_files(shared_files,mol_dir,store_dir,strategy=args.deploy)
+        shutil.copy(os.path.join(sol_dir,mol + '.in'),mol_dir)
+        if os.path.isfile(os.path.join(sol_dir,mol+'.top')) == True:
+            shutil.copy(os.path.join(sol_dir,mol + '.top'),mol_dir)
 
     # Crete and launch H4D initialisation
     tools.create_structure_initialisation_input(args,solute=mol,mol_dir=mol_dir)
@@ -108,14 +131,15 @@ for mol in molecules:
     if args.nostart == True :
         continue
     else :
-        if args.j == "slurm" :
-            shutil.copy(os.path.join(input_dir,'job-ini'),mol_dir)
-            job_file = os.path.join(mol_dir,'job-ini')
-            os.system("cd {0}; sbatch {1}; cd ..".format(mol_dir,job_file))
-        if args.j == "loadleveler" :
-            shutil.copy(os.path.join(input_dir,'job-ini'),mol_dir)
-            job_file = os.path.join(mol_dir,'job-ini')
-            os.system("cd {0}; llsubmit {1}; cd ..".format(mol_dir,job_file))
+        job_file = jobs.write_job_script(os.path.join(input_dir,'job-ini'),mol_dir,staging=args.staging)
+        with tools.timer('submit') :
+            state.record_job(db,mol,'ini',0,sched.submit(job_file,mol_dir))
+
+with tools.timer('wait') :
+    sched.wait()
+state.update_jobs(db,sched)
+with tools.timer('state') :
+    state.refresh(db,home_dir,molecules)
 
 
 
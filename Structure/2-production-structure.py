@@ -1,9 +1,13 @@
 import csv
 import os
+import sys
 import shutil
 import argparse
 import random
 import H4Dtools_functions as tools
+import H4Dtools_scheduler as scheduler
+import H4Dtools_jobs as jobs
+import H4Dtools_state as state
 
 """
 
@@ -31,15 +35,24 @@ Accumulation of ins/des for a set of solutes
         -fb : force bias parameters
         -Vxp : volume exchange probablity
         -lnV : maximum volume exchange
-        -auto : automatic determination of the starting index i
+        -auto : automatic determination of the starting index i (campaign-state.db)
         -i : manual determination of the starting index
-        -j : job handeling system
+        -j : job handeling system (slurm, loadleveler or local)
+        -np, --ncores : nb of jobs run at the same time with -j local
+        -stg, --staging : files copied to the compute node : only those of the run (minimal) or the whole solute directory (full)
+        -rep, --replicas : K independent replicas of each run started from the same files, each with its
+                           own seed and output files, merged into acc_{solute_name}_s{j} when all are done ;
+                           sets with replicas that failed or were never submitted are reported (runs of campaign-state.db)
+        -seed : campaign seed, combined with solute, index and replica into the seed of each run
+        --trace : json lines file of timed phases (csv, setup, copy, input, submit, wait, state ...)
+        --profile : cProfile and tracemalloc of the run (profile-{script}.prof)
 
     Output :
 
         solute directory : {solute_name}
             input-str
             acc_{solute_name}_s{j}, r_{solute_name}_s{j}
+            with --replicas : input-str-r{k}, acc_{solute_name}_s{j}-r{k}, r_{solute_name}_s{j}-r{k} (k = 1 .. K)
         params_struc_{j}.json file : recapitulation of run parameters
 """
 
@@ -64,10 +77,18 @@ parser.add_argument('-Vxp','--vol_ex_prob', type=float, default=0.2, help=" Volu
 parser.add_argument('-lnV', type=float, default=0.05, help="maximum ln(volume) exchange (default: %(default)s)" )
 parser.add_argument('-i', type=int,  help="index of starting file (default: %(default)s)" )
 parser.add_argument('-auto','--auto_continue', action='store_true', help="automatic determination of starting index (default: %(default)s)" )
-parser.add_argument('-j', default="slurm", help=" Job handeling system : slumr or loadleveler  (default: %(default)s)" )
+parser.add_argument('-j', default="slurm", choices=list(scheduler.SCHEDULERS), help=" Job handeling system : slurm, loadleveler or local (default: %(default)s)" )
+parser.add_argument('-np','--ncores', type=int, help="nb of jobs run at the same time on this machine with -j local (default: nb of cores)" )
+parser.add_argument('-stg','--staging', default='minimal', choices=jobs.STAGING, help="files copied to the compute node : those read by the run, or the whole solute directory (default: %(default)s)" )
+parser.add_argument('-rep','--replicas', type=int, default=1, help="nb of independent replicas of each run (default: %(default)s)" )
+parser.add_argument('-seed', type=int, default=0, help="campaign seed of the runs (default: %(default)s)" )
 parser.add_argument('-ns','--nostart', action='store_true', help="do not launch jobs (default: %(default)s)" )
+parser.add_argument('--trace', help="append timed phases of the run to TRACE as json lines (default: %(default)s)" )
+parser.add_argument('--profile', action='store_true', help="profile the Python side with cProfile and tracemalloc (default: %(default)s)" )
 args = parser.parse_args()
+tools.instrument(args,__file__)
 print(args)
+sched = scheduler.get_scheduler(args.j,ncores=args.ncores)
 
 # default parameters for single conformer solute
 if args.flex == False :
@@ -88,6 +109,10 @@ print(args)
 # Read parameters from .json file if given
 if args.load_json: args = tools.json2args(args.load_json)
 
+# replica merges need NumPy, imported only when used
+if args.replicas > 1 :
+    import H4Dtools_merge as merge
+
 # get solute names
 with open(args.solutes, 'r') as f:
     molecules = [row[0] for row in csv.reader(f)]
@@ -97,6 +122,34 @@ home_dir = "%s" % os.getcwd()
 input_dir = os.path.join(home_dir,'input-files')
 sol_dir = os.path.join(home_dir,'solutein')
 
+# Read state of solute directories (one scan of the directories changed since the last run)
+db = state.connect(home_dir)
+with tools.timer('state') :
+    state.refresh(db,home_dir,molecules)
+
+def merge_replicas(solutes):
+    ''' Merge replicas of the next runs of solutes once all of them are done,
+        report sets with replicas that failed or were never submitted (from the runs table) '''
+    merged, incomplete = 0, 0
+    for mol in solutes:
+        mol_dir, i = os.path.join(home_dir,mol), state.indices(db,mol)['s']+1
+        done = merge.merge_replicas(mol_dir,mol,'s',i,args.replicas)
+        merged += done
+        missing = {} if done else merge.incomplete_replicas(mol_dir,mol,'s',i,args.replicas,state.runs(db,mol,i),name='str')
+        if missing :
+            incomplete += 1
+            print('{} s{} : replica set incomplete, {}'.format(mol,i,', '.join('r{} {}'.format(k,s) for k,s in missing.items())))
+    if merged > 0 :
+        print('{} replica sets merged'.format(merged))
+        state.refresh(db,home_dir,solutes)
+    if incomplete > 0 :
+        print('{} replica sets incomplete : not merged until their missing replicas are run again'.format(incomplete))
+
+if args.replicas > 1 :
+    state.update_jobs(db,sched)
+    merge_replicas(molecules)
+replicas = range(1,args.replicas+1) if args.replicas > 1 else [0]
+
 # Iterate over solutes
 for mol in molecules:
 
@@ -104,26 +157,29 @@ for mol in molecules:
 
     # if auto continuation determine starting index
     if args.auto_continue == True :
-        args.i = tools.auto_sim_index(mol,mol_dir=mol_dir)    
+        args.i = state.indices(db,mol)['s']
     
     # Check that index have been defined
     if args.i == None:
-        print('No staring index : add manually with -i or automatic determination with -auto')
-
-    tools.create_structure_input(args,solute=mol,mol_dir=mol_dir)
-
-    if args.nostart == True :
-        continue
-    else :
-        if args.j == "slurm" :
-            shutil.copy(os.path.join(input_dir,'job-str'),mol_dir)
-            job_file = os.path.join(mol_dir,'job-str')
-            os.system('sed -i "s/YY/{0}/g" {1}'.format(args.i+1,job_file))
-            os.system("cd {0}; sbatch {1};  cd ..".format(mol_dir,job_file))
-        if args.j == "loadleveler" :
-            shutil.copy(os.path.join(input_dir,'job-str'),mol_dir)
-            job_file = os.path.join(mol_dir,'job-str')
-            os.system('sed -i "s/YY/{0}/g" {1}'.format(args.i+1,job_file))
-            os.system("cd {0}; llsubmit {1};  cd ..".format(mol_dir,job_file))
+        sys.exit('No staring index : add manually with -i or automatic determination with -auto')
+
+    for r in replicas:
+        tools.create_structure_input(args,solute=mol,mol_dir=mol_dir,replica=r)
+
+        if args.nostart == True :
+            continue
+        else :
+            suffix = tools.replica_suffix(r)
+            job_file = jobs.write_job_script(os.path.join(input_dir,'job-str'),mol_dir,index=args.i+1,suffix=suffix,staging=args.staging)
+            with tools.timer('submit') :
+                state.record_job(db,mol,'str' + suffix,args.i+1,sched.submit(job_file,mol_dir))
+
+with tools.timer('wait') :
+    sched.wait()
+state.update_jobs(db,sched)
+with tools.timer('state') :
+    state.refresh(db,home_dir,molecules)
+if args.replicas > 1 :
+    merge_replicas(molecules)
 
 tools.args2json('params_run_{}.out'.format(args.i+1),args)    
@@ -0,0 +1,95 @@
+import csv
+import os
+import argparse
+import numpy as np
+import H4Dtools_functions as tools
+import H4Dtools_state as state
+import H4Dtools_archive as archive
+import H4Dtools_rdf as rdf
+
+"""
+
+Radial distribution functions of a set of solutes
+
+    Input files :
+
+        solute directory : {solute_name}
+            acc_{solute_name}_s{i}
+        database file (.csv) : solute names
+
+    Input parameters :
+
+        --load_json : read paremeters from json_file (if not uses default parameters or paremeters defined in the commond line)
+        -s, --solutes : database file name
+        -e, --evol : g(r) of all indices 1 .. i instead of the last one
+        -auto : automatic determination of the index i per solute (campaign-state.db)
+        -i : manual determination of the index
+        -tail : fraction of the largest distances over which g(r) is normalised to 1
+        -o, --output : output file
+        --trace : json lines file of timed phases (csv, setup, copy, input, submit, wait, state ...)
+        --profile : cProfile and tracemalloc of the run (profile-{script}.prof)
+
+    Output :
+
+        gr.npz : solute, index, nsites (M), r (nr), g_OO, g_OH, g_HH (M x nr),
+                 g_solute_O, g_solute_H (M x nsites x nr, nan beyond the sites of a solute)
+        params_ana_struc.out file : recapitulation of analysis parameters
+"""
+
+# Parse input params #
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--load_json', help="read paremeters from json_file (if not : uses default parameters or paremeters defined in the commond line)" )
+parser.add_argument('-s','--solutes', default='solutes.csv', help="File containing solute's name (default: %(default)s)" )
+parser.add_argument('-e','--evol', action='store_true', help="g(r) of all indices up to i (default: %(default)s)" )
+parser.add_argument('-i', type=int,  help="index of analysed files (default: %(default)s)" )
+parser.add_argument('-auto','--auto_continue', action='store_true', help="automatic determination of the index (default: %(default)s)" )
+parser.add_argument('-tail', type=float, default=0.1, help="fraction of largest distances where g(r) = 1 (default: %(default)s)" )
+parser.add_argument('-o','--output', default='gr.npz', help="output file (default: %(default)s)" )
+parser.add_argument('--trace', help="append timed phases of the run to TRACE as json lines (default: %(default)s)" )
+parser.add_argument('--profile', action='store_true', help="profile the Python side with cProfile and tracemalloc (default: %(default)s)" )
+args = parser.parse_args()
+tools.instrument(args,__file__)
+print(args)
+
+# Read parameters from .json file if given
+if args.load_json: args = tools.json2args(args.load_json)
+
+# get solute names
+with open(args.solutes, 'r') as f:
+    molecules = [row[0] for row in csv.reader(f)]
+
+home_dir = "%s" % os.getcwd()
+
+if args.auto_continue == True :
+    db = state.connect(home_dir)
+    with tools.timer('state') :
+        state.refresh(db,home_dir,molecules)
+
+# List (solute, index) files
+rows, files = [], []
+for mol in molecules:
+    i = state.indices(db,mol)['s'] if args.auto_continue == True else args.i
+    if i == None or i < 0:
+        print('{} : no index : add manually with -i or automatic determination with -auto'.format(mol))
+        continue
+    for j in (range(1,i+1) if args.evol == True else [i]):
+        file = os.path.join(home_dir,mol,'acc_{}_s{}'.format(mol,j))
+        if archive.restore(file) == False:
+            print('{} : missing file'.format(file))
+            continue
+        rows.append((mol,j))
+        files.append(file)
+
+# g(r) of all files in one batch
+if len(files) == 0 :
+    print('No accumulation files')
+else :
+    with tools.timer('rdf') :
+        out = rdf.rdf_files(files,tail=args.tail)
+    with tools.timer('output') :
+        np.savez_compressed(args.output, solute=np.array([r[0] for r in rows]), index=np.array([r[1] for r in rows]), **out)
+    print('g(r) of {} files ({} solutes) saved in {}'.format(len(files),len(set(r[0] for r in rows)),args.output))
+archive.release()
+
+tools.args2json('params_ana_struc.out',args)
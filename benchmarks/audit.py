@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import runpy
+import atexit
+
+"""
+
+Runs a pipeline script (python audit.py script.py args...) counting, with Python audit hooks, its
+filesystem operations, bytes copied by shutil and started subprocesses ; counts are written as json
+in the file given by the BENCH_AUDIT environment variable when the script exits.
+
+"""
+
+EVENTS = {'open': 'open', 'os.mkdir': 'mkdir', 'os.rename': 'rename', 'os.remove': 'remove',
+          'os.rmdir': 'rmdir', 'os.symlink': 'symlink', 'os.link': 'link', 'os.listdir': 'listdir',
+          'os.scandir': 'scandir', 'os.chmod': 'chmod', 'os.utime': 'utime', 'shutil.copyfile': 'copyfile',
+          'shutil.rmtree': 'rmtree', 'subprocess.Popen': 'subprocess'}
+
+counts = dict.fromkeys(sorted(set(EVENTS.values())),0)
+counts['bytes_copied'] = 0
+skip = tuple(p for p in {sys.prefix, sys.base_prefix, os.path.dirname(os.__file__)} if p)
+
+
+def hook(event,args):
+    name = EVENTS.get(event)
+    if name is None:
+        return
+    if name == 'open':
+        path = args[0]
+        # imports and interpreter files are not part of the pipeline
+        if not isinstance(path,(str,bytes)) or str(path).endswith(('.py','.pyc')) or str(path).startswith(skip):
+            return
+    elif name == 'copyfile':
+        try:
+            counts['bytes_copied'] += os.path.getsize(args[0])
+        except OSError:
+            pass
+    counts[name] += 1
+
+
+def dump():
+    out = os.environ.get('BENCH_AUDIT')
+    if out:
+        with open(out,'w') as f:
+            json.dump(counts, f)
+
+
+if __name__ == "__main__":
+
+    script = sys.argv[1]
+    sys.argv = sys.argv[1:]
+    atexit.register(dump)
+    sys.addaudithook(hook)
+    runpy.run_path(script,run_name='__main__')
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+
+"""
+
+Benchmark of the pipeline : init --> production --> analysis of synthetic campaigns with the local scheduler
+
+    A campaign of n solutes is built from input-files : solutes named after FreeSolv-MDFT-PMV.csv (with their
+    PMV, cycled for more than 641 solutes), all with the structure of dummy.in, and h4dmc.x replaced by
+    fake_h4dmc.py (or the real binary with --h4dmc, with tiny -eq and -nacc). Each stage script is run
+    through audit.py and reports :
+        wall and CPU time of the stage (with its jobs)
+        filesystem operations and bytes copied by the scripts, subprocesses they start
+        bytes read / written by the whole process tree (/proc/{pid}/io)
+    The outputs of each stage are checked (acc_{solute}_ins0/des0 after the initialisation, ins1/des1
+    after the production, one HFE per solute in HFE-{nacc}.csv after the analysis) : a stage that fails
+    or misses outputs makes the benchmark fail (exit status 1) whatever its metrics.
+    Results are saved as json and compared with a baseline (baseline.json) : a metric is reported as a
+    regression when it is above the baseline by more than the tolerance. The baseline is not shipped :
+    the first run on a machine saves it (--save_baseline replaces it).
+
+    Only the counts of audit.py (operations of the scripts) are comparable between machines. Times, and
+    the bytes read / written by the process tree, depend on the environment : /proc/{pid}/io counts all
+    reads and writes of the interpreter (its standard library and site-packages, which differ between
+    Python builds and installed packages), of bash and its startup files in the job scripts, and the logs,
+    which hold the paths of the work directory. They are compared only with a baseline of the same
+    host, Python version and nb of cores.
+
+    The real h4dmc.x (--h4dmc) has to be compiled on the machine running the benchmark : a binary
+    built elsewhere stops on an illegal instruction in initmc_, and the benchmark then fails on the
+    missing acc_ files of the initialisation.
+
+    python benchmarks/bench.py -n 10 100 1000
+    python benchmarks/bench.py -n 10 100 --save_baseline
+
+"""
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE = os.path.join(BENCH_DIR,'baseline.json')
+STAGES = ['ini','prod','ana']
+# regressions : times above baseline x (1 + tolerance) and min_seconds, counts above baseline x (1 + count_tolerance)
+TIMES = ['wall','cpu']
+# metrics of the environment (times, bytes of the process tree, tolerance of times), compared on the same machine only
+MACHINE = TIMES + ['read_bytes','write_bytes']
+MIN_SECONDS = 0.5
+
+
+def solute_names(n,pmv_file):
+    ''' n solute names and PMV from the FreeSolv file, cycled with a suffix beyond its size '''
+    with open(pmv_file,'r') as f:
+        rows = [l.split() for l in f if l.strip()]
+    return [('{}{}'.format(rows[k % len(rows)][0],'' if k < len(rows) else '-{}'.format(k // len(rows))),rows[k % len(rows)][1])
+            for k in range(n)]
+
+
+def build_campaign(camp_dir,n,h4dmc=None):
+    ''' Campaign directory of n synthetic solutes (solutes.csv, solutein, input-files) '''
+    if os.path.isdir(camp_dir):
+        shutil.rmtree(camp_dir)
+    input_dir = os.path.join(camp_dir,'input-files')
+    shutil.copytree(os.path.join(REPO_DIR,'input-files'),input_dir)
+    os.remove(os.path.join(input_dir,'h4dmc.x'))
+    shutil.copy(h4dmc or os.path.join(BENCH_DIR,'fake_h4dmc.py'),os.path.join(input_dir,'h4dmc.x'))
+    os.chmod(os.path.join(input_dir,'h4dmc.x'),0o755)
+    os.makedirs(os.path.join(camp_dir,'solutein'))
+    with open(os.path.join(camp_dir,'solutes.csv'),'w') as f:
+        f.write('Name\tV0\tmu0\n')
+        for name,pmv in solute_names(n,os.path.join(input_dir,'FreeSolv-MDFT-PMV.csv')):
+            f.write('{}\t{}\t0.0\n'.format(name,pmv))
+            shutil.copy(os.path.join(input_dir,'dummy.in'),os.path.join(camp_dir,'solutein',name + '.in'))
+
+
+def stage_commands(args):
+    solutes = ['-s','solutes.csv']
+    local = ['-j','local'] + (['-np',str(args.ncores)] if args.ncores else [])
+    return dict(ini=['Energy/1-initilisation.py'] + solutes + local + ['-eq',str(args.equil)],
+                prod=['Energy/2-production.py'] + solutes + local + ['-auto','-nacc',str(args.nacc)],
+                ana=['Energy/3-analysis.py'] + solutes + ['-auto','-nj',str(args.ncores or os.cpu_count() or 1)])
+
+
+def _proc_io(pid):
+    try:
+        with open('/proc/{}/io'.format(pid),'r') as f:
+            return {k: int(v) for k,v in (l.split(':') for l in f)}
+    except (OSError,ValueError):
+        return {}
+
+
+def run_stage(camp_dir,command,env):
+    ''' Run a stage script through audit.py
+        Output : dict of metrics '''
+    audit_file = os.path.join(camp_dir,'.bench-audit.json')
+    env = dict(env, BENCH_AUDIT=audit_file, PYTHONPATH=REPO_DIR + os.pathsep + env.get('PYTHONPATH',''))
+    cmd = [sys.executable,os.path.join(BENCH_DIR,'audit.py'),os.path.join(REPO_DIR,command[0])] + command[1:]
+    t0 = time.monotonic()
+    with open(os.path.join(camp_dir,'bench-{}.log'.format(os.path.basename(command[0]))),'w') as log:
+        proc = subprocess.Popen(cmd,cwd=camp_dir,env=env,stdout=log,stderr=subprocess.STDOUT)
+        # I/O counters of the process tree are read before the process is reaped
+        os.waitid(os.P_PID,proc.pid,os.WEXITED|os.WNOWAIT)
+        wall = time.monotonic() - t0
+        io = _proc_io(proc.pid)
+        pid, status, usage = os.wait4(proc.pid,0)
+    metrics = dict(wall=wall, cpu=usage.ru_utime + usage.ru_stime, exit=os.waitstatus_to_exitcode(status),
+                   read_bytes=io.get('rchar',0), write_bytes=io.get('wchar',0))
+    if os.path.isfile(audit_file):
+        with open(audit_file,'r') as f:
+            metrics.update(json.load(f))
+        os.remove(audit_file)
+    return metrics
+
+
+def check_outputs(camp_dir,stage):
+    ''' Outputs missing after a stage : acc_ files of index 0 (ini) or 1 (prod) of each solute,
+        one HFE per solute (ana)
+        Output : list of messages '''
+    with open(os.path.join(camp_dir,'solutes.csv'),'r') as f:
+        solutes = [l.split()[0] for l in f.read().split('\n')[1:] if l.strip()]
+    if stage in ('ini','prod'):
+        index = 0 if stage == 'ini' else 1
+        return ['{}/acc_{}_{}{}'.format(mol,mol,kind,index) for mol in solutes for kind in ['ins','des']
+                if not os.path.isfile(os.path.join(camp_dir,mol,'acc_{}_{}{}'.format(mol,kind,index)))]
+    files = sorted((f for f in os.listdir(camp_dir) if f.startswith('HFE-') and f.endswith('.csv')),
+                   key=lambda f: os.path.getmtime(os.path.join(camp_dir,f)))
+    if not files:
+        return ['HFE-{nacc}.csv']
+    hfe = {}
+    with open(os.path.join(camp_dir,files[-1]),'r') as f:
+        for line in f.read().split('\n')[1:]:
+            cols = line.split()
+            if len(cols) > 1:
+                hfe[cols[0]] = cols[1]
+    missing = []
+    for mol in solutes:
+        try:
+            if float(hfe[mol]) != float(hfe[mol]):
+                missing.append('HFE of {} (nan)'.format(mol))
+        except (KeyError,ValueError):
+            missing.append('HFE of {}'.format(mol))
+    return missing
+
+
+def run_campaign(args,n):
+    ''' Build and run the campaign of n solutes
+        Output : {stage: metrics} '''
+    camp_dir = os.path.join(os.path.abspath(args.work),'campaign-{}'.format(n))
+    build_campaign(camp_dir,n,args.h4dmc)
+    env = dict(os.environ)
+    if args.acc_bytes and not args.h4dmc :
+        env['FAKE_H4DMC_BYTES'] = str(args.acc_bytes)
+    results = {}
+    for stage,command in stage_commands(args).items():
+        results[stage] = run_stage(camp_dir,command,env)
+        missing = check_outputs(camp_dir,stage)
+        results[stage]['missing'] = len(missing)
+        print_row(n,stage,results[stage])
+        if missing:
+            print('       {} missing outputs : {}{}'.format(len(missing),', '.join(missing[:5]),' ...' if len(missing) > 5 else ''))
+    if args.keep == False :
+        shutil.rmtree(camp_dir)
+    return results
+
+
+COLUMNS = ['wall','cpu','open','mkdir','rename','listdir','scandir','copyfile','bytes_copied','subprocess','write_bytes']
+
+def print_header():
+    print('{:>6} {:>5} '.format('n','stage') + ' '.join('{:>12}'.format(c) for c in COLUMNS))
+
+def print_row(n,stage,m):
+    values = ['{:.2f}'.format(m[c]) if c in TIMES else str(m.get(c,'-')) for c in COLUMNS]
+    print('{:>6} {:>5} '.format(n,stage) + ' '.join('{:>12}'.format(v) for v in values) + ('' if m['exit'] == 0 else '  exit {}'.format(m['exit'])))
+
+
+def failed_stages(results):
+    ''' (n, stage) of stages that exited with an error or missed outputs '''
+    return [(n,stage) for n,stages in results.items() for stage,m in stages.items() if m['exit'] != 0 or m.get('missing',0) > 0]
+
+
+def same_machine(record,baseline):
+    ''' True if baseline was run on the machine (host, Python version and nb of cores) of record '''
+    return all(baseline.get(k) == record[k] for k in ['host','python','cpus'])
+
+
+def compare(results,baseline,tolerance,count_tolerance,machine=True):
+    ''' Metrics above the baseline (machine : times and bytes of the process tree too)
+        Output : list of (n, stage, metric, value, baseline value) '''
+    regressions = []
+    for n,stages in results.items():
+        for stage,metrics in stages.items():
+            base = baseline.get(n,{}).get(stage)
+            if base is None:
+                continue
+            for metric,value in metrics.items():
+                if metric in ('exit','missing') or metric not in base or (metric in MACHINE and machine == False):
+                    continue
+                if metric in TIMES:
+                    worse = value > base[metric]*(1 + tolerance) and value - base[metric] > MIN_SECONDS
+                elif metric in MACHINE:
+                    worse = value > base[metric]*(1 + tolerance)
+                else:
+                    worse = value > base[metric]*(1 + count_tolerance)
+                if worse:
+                    regressions.append((n,stage,metric,value,base[metric]))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of the init / production / analysis pipeline")
+    parser.add_argument('-n','--solutes', type=int, nargs='+', default=[10,100], help="campaign sizes (default: %(default)s)" )
+    parser.add_argument('--h4dmc', help="real h4dmc.x instead of fake_h4dmc.py (default: %(default)s)" )
+    parser.add_argument('-eq','--equil', type=int, default=10, help="equilibration cycles of the initialisation (default: %(default)s)" )
+    parser.add_argument('-nacc', type=int, default=10, help="nb of accumulations of production (default: %(default)s)" )
+    parser.add_argument('-np','--ncores', type=int, help="nb of jobs run at the same time (default: nb of cores)" )
+    parser.add_argument('--acc_bytes', type=int, default=65536, help="size of acc_ files written by the fake h4dmc.x, 0 for full copies (default: %(default)s)" )
+    parser.add_argument('--work', default='bench-work', help="directory of the campaigns (default: %(default)s)" )
+    parser.add_argument('--keep', action='store_true', help="keep the campaigns (default: %(default)s)" )
+    parser.add_argument('-o','--output', default='bench-results.json', help="results file (default: %(default)s)" )
+    parser.add_argument('--baseline', default=BASELINE, help="baseline file (default: %(default)s)" )
+    parser.add_argument('--save_baseline', action='store_true', help="save results as the baseline, done by the first run without baseline (default: %(default)s)" )
+    parser.add_argument('--tolerance', type=float, default=0.25, help="relative tolerance of times and bytes read / written (default: %(default)s)" )
+    parser.add_argument('--count_tolerance', type=float, default=0.05, help="relative tolerance of counts (default: %(default)s)" )
+    args = parser.parse_args()
+
+    print_header()
+    results = {str(n): run_campaign(args,n) for n in args.solutes}
+    record = dict(h4dmc='real' if args.h4dmc else 'fake', equil=args.equil, nacc=args.nacc, acc_bytes=args.acc_bytes,
+                  host=platform.node(), python=sys.version.split()[0], cpus=os.cpu_count(), results=results)
+    with open(args.output,'w') as f:
+        json.dump(record, f, indent=1)
+
+    failed = failed_stages(results)
+    for n,stage in failed:
+        print('Failed : {} solutes, {} (exit {}, {} missing outputs, see bench-*.log and local-*.out with --keep)'.format(
+              n,stage,results[n][stage]['exit'],results[n][stage].get('missing',0)))
+    if failed :
+        sys.exit(1)
+
+    if args.save_baseline or not os.path.isfile(args.baseline) :
+        with open(args.baseline,'w') as f:
+            json.dump(record, f, indent=1)
+        print('Baseline saved in {}{}'.format(args.baseline,'' if args.save_baseline else ' (first run)'))
+    else :
+        with open(args.baseline,'r') as f:
+            baseline = json.load(f)
+        if (baseline['h4dmc'],baseline['equil'],baseline['nacc'],baseline['acc_bytes']) != (record['h4dmc'],args.equil,args.nacc,args.acc_bytes):
+            print('Baseline {} was run with other settings : not compared'.format(args.baseline))
+        else:
+            machine = same_machine(record,baseline)
+            if machine == False :
+                print('Baseline {} was run on another machine : times and bytes read / written not compared'.format(args.baseline))
+            regressions = compare(results,baseline['results'],args.tolerance,args.count_tolerance,machine=machine)
+            for n,stage,metric,value,base in regressions:
+                print('Regression : {} solutes, {} : {} {:.4g} (baseline {:.4g})'.format(n,stage,metric,value,base))
+            print('{} regressions against {}'.format(len(regressions),args.baseline))
+            sys.exit(1 if regressions else 0)
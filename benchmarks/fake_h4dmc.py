@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import shutil
+import hashlib
+
+"""
+
+Stand-in for h4dmc.x in benchmarks : reads an input deck on stdin like h4dmc.x and writes the same files
+
+    53 {name}  : loads acc_{name} (and r_{name})
+    12 {name}  : saves acc_{name} and r_{name}, copies of the last loaded files (a placeholder if none)
+    8 ... NCYC 0 NACC : prints NCYC / NACC 'deltaH, deltaU=' lines (one per accumulation, as counted by
+                        H4Dtools_monitor.py), spread over the run time
+    analysis decks (loads without save) : prints the accumulation count and the BAR block read by
+                                          H4Dtools_functions.read_hfe, with an HFE derived from the solute name
+
+    Environment :
+        FAKE_H4DMC_SLEEP : seconds spent per run (default 0)
+        FAKE_H4DMC_BYTES : size of the saved acc_ files, truncated copies of the loaded ones (default : full copies)
+        FAKE_H4DMC_NACC  : nb of accumulations printed by analyses (default 1000)
+        FAKE_H4DMC_FAIL  : exit status 1 for decks containing this string
+
+"""
+
+
+def save(src,name,size=None):
+    for prefix in ['acc_','r_']:
+        dst = prefix + name
+        if src and os.path.isfile(prefix + src):
+            if size is None:
+                shutil.copyfile(prefix + src,dst)
+            else:
+                with open(prefix + src,'rb') as fin, open(dst,'wb') as fout:
+                    fout.write(fin.read(size))
+        else:
+            with open(dst,'w') as f:
+                f.write('fake {}\n'.format(name))
+
+
+def accumulations(lines):
+    ''' NCYC / NACC of the first Monte-Carlo block of a deck (0 if none) '''
+    if '8' not in lines:
+        return 0
+    k = lines.index('8') + 1
+    k += 1 if lines[k] == '00' else 0
+    try:
+        return int(lines[k+1]) // max(int(lines[k+3]),1)
+    except (IndexError,ValueError):
+        return 0
+
+
+def analysis_output(solute,nacc):
+    ''' Analysis output in the layout parsed by read_hfe '''
+    h = int(hashlib.sha256(solute.encode()).hexdigest()[:8],16)
+    hfe, err = -10 + 20*(h % 10000)/10000, 0.01 + (h % 97)/1000
+    lines = [' Analyse des accumulations', ' Nombre d\'accumulations : {}'.format(nacc), '', ' BAR']
+    lines += ['   iteration {} : {:.6f}'.format(k,hfe) for k in range(1,9)]
+    lines += ['  dF  {:.6f}  {:.6f}'.format(hfe,err), '']
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+
+    deck = sys.stdin.read()
+    if os.environ.get('FAKE_H4DMC_FAIL') and os.environ['FAKE_H4DMC_FAIL'] in deck:
+        sys.exit(1)
+    sleep = float(os.environ.get('FAKE_H4DMC_SLEEP',0))
+    size = int(os.environ['FAKE_H4DMC_BYTES']) if os.environ.get('FAKE_H4DMC_BYTES') else None
+
+    lines = [l.strip() for l in deck.split('\n')]
+    nacc = accumulations(lines) if '12' in lines else 0
+    for k in range(nacc):
+        print(' deltaH, deltaU=  {:.4f}  {:.4f}'.format(0.1*k,0.2*k),flush=True)
+        time.sleep(sleep/nacc)
+    if nacc == 0:
+        time.sleep(sleep)
+    loaded, saved = [], 0
+    for k,line in enumerate(lines[:-1]):
+        if line == '53':
+            loaded.append(lines[k+1].split()[0])
+        elif line == '12' and lines[k+1]:
+            save(loaded[-1] if loaded else None,lines[k+1].split()[0],size)
+            saved += 1
+    if saved == 0 and loaded:
+        solute = loaded[0].rsplit('_',1)[0]
+        print(analysis_output(solute,os.environ.get('FAKE_H4DMC_NACC','1000')))
+    else:
+        print(' {} files saved'.format(2*saved))
@@ -0,0 +1,47 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+"""
+
+Synthetic acc_ files : parametres section in the h4dmc.x layout (niter and nacc at their HEADER
+positions), a solute-O histogram with its r grid and an energy histogram ('en dH') centred on 0
+
+"""
+
+
+def write_acc(path,hist,niter=1000,nacc=100,T=298.15,dH=0.5,gr=None):
+    ''' Write a synthetic acc_ file with energy histogram hist (2n+1 bins) and solute-O histogram gr (nr values) '''
+    n = (len(hist)-1)//2
+    gr = np.arange(20,dtype=np.float64) if gr is None else np.asarray(gr,dtype=np.float64)
+    lines = ['           parametres', '         100']
+    lines += ['   {:.16E}'.format(v) for v in [T, 100000.0, 3.1506, 0.2567, 1.0e20]]
+    lines += ['   0.9572   104.52', '   0.417', '   8.0', '   4.0   4.0', '   99.0', '           4']
+    lines += ['         {}   0.025'.format(len(gr)), '           {}           {}           0'.format(niter,nacc)]
+    lines += ['        iacc solute-O']
+    lines += ['   {:.16E}   {:.16E}'.format(0.025*(k+1),v) for k,v in enumerate(gr)]
+    lines += ['        en dH', '  {:.16E}              {}'.format(dH,n)]
+    lines += ['  ' + '  '.join('{:.16E}'.format(v) for v in hist), '   300.0']
+    with open(path,'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+def gaussian(n,mean,width,count):
+    ''' Histogram of count samples of a gaussian on 2n+1 bins of 0.5 centred on 0 '''
+    x = 0.5*np.arange(-n,n+1)
+    h = np.exp(-0.5*((x - mean)/width)**2)
+    return np.round(count*h/h.sum())
+
+
+@pytest.fixture
+def make_acc():
+    return write_acc
+
+
+@pytest.fixture
+def make_hist():
+    return gaussian
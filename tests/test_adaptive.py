@@ -0,0 +1,15 @@
+import H4Dtools_adaptive as adaptive
+
+
+def test_split_keeps_both_directions():
+    # destructions dominate the variance : insertions already have enough samples
+    e = dict(err=0.5, var_ins=1e-6, var_des=0.25, n_ins=1000, n_des=1000)
+    n = adaptive.plan_solute(e,0.1,100,0,10000,variance_split=True)
+    assert n['ins'] >= 1 and n['des'] > n['ins']
+
+
+def test_budget_keeps_both_directions():
+    errors = dict(a=dict(err=0.5, var_ins=1e-6, var_des=0.25, n_ins=1000, n_des=1000))
+    plan, converged = adaptive.allocate(errors,0.1,100,0,10000,cost=lambda mol,n: n['ins'] + n['des'],budget=10,
+                                        unit_cost=lambda mol: dict(ins=1.0, des=1.0),variance_split=True)
+    assert len(plan) == 1 and min(plan[0][1].values()) >= 1
@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def campaign(camp_dir,make_acc,make_hist,n=3):
+    ''' Campaign of one solute with cumulative segments 0 .. n-1 and the fake h4dmc.x '''
+    mol_dir = os.path.join(camp_dir,'x')
+    os.makedirs(mol_dir)
+    shutil.copy(os.path.join(REPO_DIR,'benchmarks','fake_h4dmc.py'),os.path.join(mol_dir,'h4dmc.x'))
+    os.chmod(os.path.join(mol_dir,'h4dmc.x'),0o755)
+    with open(os.path.join(camp_dir,'s.csv'),'w') as f:
+        f.write('Name\tV0\tmu0\nx\t100.0\t0.0\n')
+    ins, des = 0, 0
+    for i in range(n):
+        ins = ins + make_hist(30,1.0 + 0.1*i,2.0,400)
+        des = des + make_hist(30,-1.0,2.0,400)
+        make_acc(os.path.join(mol_dir,'acc_x_ins{}'.format(i)),ins,nacc=100*(i+1))
+        make_acc(os.path.join(mol_dir,'acc_x_des{}'.format(i)),des,nacc=100*(i+1))
+    return mol_dir
+
+
+def analysis(camp_dir,*options):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    proc = subprocess.run([sys.executable,os.path.join(REPO_DIR,'Energy','3-analysis.py'),'-s','s.csv','-i','2','-nr'] + list(options),
+                          cwd=camp_dir,env=env,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+    assert proc.returncode == 0, proc.stdout
+    with open(os.path.join(camp_dir,'HFE-1000.csv'),'r') as f:
+        header = f.readline().split()
+    return proc.stdout, header
+
+
+def test_bootstrap_cache(tmp_path,make_acc,make_hist):
+    camp_dir = str(tmp_path)
+    mol_dir = campaign(camp_dir,make_acc,make_hist)
+    out, header = analysis(camp_dir,'-bs','20')
+    assert 'No bootstrap' in out and 'ci_lo' not in header
+    # once the Python estimator agrees with h4dmc.x, the cached result without interval is not reused
+    with open(os.path.join(camp_dir,'bar-check.json'),'w') as f:
+        json.dump(dict(agree=True), f)
+    out, header = analysis(camp_dir,'-bs','20')
+    assert '1 analyses to run, 0 taken from the cache' in out and 'ci_lo' in header
+    out, header = analysis(camp_dir,'-bs','20')
+    assert '0 analyses to run, 1 taken from the cache' in out and 'ci_lo' in header
+    # an earlier segment changed : the interval is computed again
+    make_acc(os.path.join(mol_dir,'acc_x_ins0'),make_hist(30,1.0,2.0,400)//2,nacc=50)
+    out, header = analysis(camp_dir,'-bs','20')
+    assert '1 analyses to run, 0 taken from the cache' in out and 'ci_lo' in header
+
+
+def test_no_index(tmp_path,make_acc,make_hist):
+    camp_dir = str(tmp_path)
+    campaign(camp_dir,make_acc,make_hist)
+    proc = subprocess.run([sys.executable,os.path.join(REPO_DIR,'Energy','3-analysis.py'),'-s','s.csv','-nr'],cwd=camp_dir,
+                          env=dict(os.environ, PYTHONPATH=REPO_DIR),stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+    assert proc.returncode == 1 and 'No staring index' in proc.stdout
@@ -0,0 +1,28 @@
+import os
+import math
+import H4Dtools_bootstrap as bootstrap
+
+
+def write_segments(mol_dir,mol,make_acc,make_hist,n=4):
+    ''' Cumulative acc_ files of n segments of each direction '''
+    os.makedirs(mol_dir)
+    ins, des = 0, 0
+    for i in range(n):
+        ins = ins + make_hist(30,1.0 + 0.1*i,2.0,400)
+        des = des + make_hist(30,-1.0,2.0,400)
+        make_acc(os.path.join(mol_dir,'acc_{}_ins{}'.format(mol,i)),ins,nacc=100*(i+1))
+        make_acc(os.path.join(mol_dir,'acc_{}_des{}'.format(mol,i)),des,nacc=100*(i+1))
+
+
+def test_bootstrap_jobs(tmp_path,make_acc,make_hist):
+    for mol in ['a','b','c']:
+        write_segments(str(tmp_path / mol),mol,make_acc,make_hist)
+    pairs = [(mol,i) for mol in ['a','b','c'] for i in [2,3]]
+    serial, failed = bootstrap.bootstrap_results(str(tmp_path),pairs,nboot=200,seed=1)
+    assert failed == {} and sorted(serial) == sorted(pairs)
+    for r in serial.values():
+        assert r['lo'] <= r['dF'] <= r['hi'] and math.isfinite(r['err'])
+    # same resamples whatever the nb of workers
+    parallel, failed = bootstrap.bootstrap_results(str(tmp_path),pairs + [('d',3)],nboot=200,seed=1,jobs=3)
+    assert list(failed) == ['d']
+    assert all(parallel[k] == serial[k] for k in serial)
@@ -0,0 +1,20 @@
+import os
+import H4Dtools_cache as cache
+
+
+def test_evict_in_stored_mode(tmp_path,make_acc,make_hist):
+    mol_dir = tmp_path / 'a'
+    os.makedirs(str(mol_dir))
+    for kind in ['ins','des']:
+        make_acc(str(mol_dir / 'acc_a_{}1'.format(kind)),make_hist(10,0.0,1.0,100))
+    dict_cache = {}
+    for content_hash,i in [(False,1),(True,1)]:
+        sig = cache.entry_signature('a',i,0.0,{},str(mol_dir),content_hash=content_hash)
+        cache.store(dict_cache,'a',i,sig,dict(hfe=1.0),content_hash=content_hash)
+        assert dict_cache['a/1']['content_hash'] == content_hash
+        assert cache.evict(dict_cache,str(tmp_path)) == 0
+        assert cache.cached_result(dict_cache,'a',1,str(mol_dir)) == dict(hfe=1.0)
+    # content changed, same size
+    with open(str(mol_dir / 'acc_a_ins1'),'r+') as f:
+        f.write('xx')
+    assert cache.evict(dict_cache,str(tmp_path)) == 1 and dict_cache == {}
@@ -0,0 +1,42 @@
+import os
+import H4Dtools_dag as dag
+
+
+class StepScheduler:
+    ''' LoadLeveler without llsubmit : records the submitted job command files '''
+
+    supports_dependencies = False
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self,job_file,cwd,dependencies=None,array=None,options=None):
+        assert dependencies is None
+        self.submitted.append((job_file,cwd))
+        return 'host.{}'.format(len(self.submitted))
+
+
+def test_steps_with_analysis(tmp_path):
+    home_dir = str(tmp_path)
+    nodes, ends = [], []
+    for mol in ['a','1-b']:
+        mol_dir = os.path.join(home_dir,mol)
+        os.makedirs(mol_dir)
+        nodes.append(dag.node((mol,'ini',0),os.path.join(mol_dir,'job-ini'),mol_dir))
+        for stage in ['ins','des']:
+            prev = (mol,'ini',0)
+            for k in [1,2]:
+                nodes.append(dag.node((mol,stage,k),os.path.join(mol_dir,'job-{}.{}'.format(stage,k)),mol_dir,[prev]))
+                prev = (mol,stage,k)
+            ends.append(prev)
+    nodes.append(dag.node(('analysis',),os.path.join(home_dir,'job-analysis'),home_dir,ends))
+    sched = StepScheduler()
+    ids = dag.submit_steps(sched,nodes)
+    # one job for the whole graph, one step id per node
+    assert sched.submitted == [(os.path.join(home_dir,'job-dag'),home_dir)]
+    assert ids[('a','ins',1)] == 'host.1.1' and ids[('analysis',)] == 'host.1.{}'.format(len(nodes)-1)
+    with open(os.path.join(home_dir,'job-dag'),'r') as f:
+        text = f.read()
+    assert '# @ step_name = ins2.1_b' in text
+    assert '# @ dependency = (ins2.a == 0 && des2.a == 0 && ins2.1_b == 0 && des2.1_b == 0)' in text
+    assert '  analysis) SLURM_SUBMIT_DIR={} bash job-analysis ;;'.format(home_dir) in text
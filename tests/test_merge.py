@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pytest
+import H4Dtools_acc as acc
+import H4Dtools_merge as merge
+
+
+def read(file):
+    data = acc.read_acc(file,use_sidecar=False)
+    return acc.header(data), data['en_dH.1'], data['iacc_solute_O.0']
+
+
+def test_merge_sums(tmp_path,make_acc,make_hist):
+    a = make_acc(str(tmp_path / 'acc_a'),make_hist(20,0.0,2.0,300),niter=1000,nacc=100,gr=np.arange(20))
+    b = make_acc(str(tmp_path / 'acc_b'),make_hist(20,1.0,2.0,500),niter=3000,nacc=250,gr=2*np.arange(20))
+    nacc = merge.merge([a,b],str(tmp_path / 'acc_c'))
+    head, hist, gr = read(str(tmp_path / 'acc_c'))
+    assert nacc == 350 and head['nacc'] == 350 and head['niter'] == 4000
+    np.testing.assert_allclose(hist,make_hist(20,0.0,2.0,300) + make_hist(20,1.0,2.0,500))
+    np.testing.assert_allclose(gr[:,1],3*np.arange(20))
+    # grid column kept
+    np.testing.assert_allclose(gr[:,0],0.025*np.arange(1,21))
+    assert not os.path.isfile(str(tmp_path / 'acc_c.tmp'))
+
+
+def test_merge_base(tmp_path,make_acc,make_hist):
+    base = make_acc(str(tmp_path / 'acc_s_ins0'),make_hist(20,0.0,2.0,100),niter=500,nacc=50)
+    for k,count in [(1,300),(2,200)]:
+        make_acc(str(tmp_path / 'acc_s_ins1-r{}'.format(k)),make_hist(20,0.0,2.0,100) + make_hist(20,0.0,2.0,count),niter=1500,nacc=150)
+    assert merge.merge_replicas(str(tmp_path),'s','ins',1,2)
+    head, hist, gr = read(str(tmp_path / 'acc_s_ins1'))
+    assert head['nacc'] == 250 and head['niter'] == 2500
+    np.testing.assert_allclose(hist,make_hist(20,0.0,2.0,100) + make_hist(20,0.0,2.0,300) + make_hist(20,0.0,2.0,200))
+
+
+def test_merge_normalised(tmp_path,make_acc,make_hist):
+    h = [make_hist(20,0.0,2.0,300), make_hist(20,1.0,2.0,300)]
+    a = make_acc(str(tmp_path / 'acc_a'),h[0]/h[0].sum(),nacc=100)
+    b = make_acc(str(tmp_path / 'acc_b'),h[1]/h[1].sum(),nacc=300)
+    merge.merge([a,b],str(tmp_path / 'acc_c'))
+    head, hist, gr = read(str(tmp_path / 'acc_c'))
+    assert head['nacc'] == 400
+    np.testing.assert_allclose(hist,(100*h[0]/h[0].sum() + 300*h[1]/h[1].sum())/400)
+    assert hist.sum() == pytest.approx(1)
+
+
+def test_merge_different_sections(tmp_path,make_acc,make_hist):
+    a = make_acc(str(tmp_path / 'acc_a'),make_hist(20,0.0,2.0,300))
+    b = make_acc(str(tmp_path / 'acc_b'),make_hist(10,0.0,2.0,300),gr=np.arange(10))
+    with pytest.raises(ValueError):
+        merge.merge([a,b],str(tmp_path / 'acc_c'))
+    assert not os.path.isfile(str(tmp_path / 'acc_c'))
+
+
+def test_incomplete_replicas(tmp_path,make_acc,make_hist):
+    make_acc(str(tmp_path / 'acc_s_ins1-r1'),make_hist(20,0.0,2.0,100))
+    runs = {'ins-r1': ('COMPLETED',0), 'ins-r2': ('FAILED',1), 'ins-r3': ('RUNNING',None)}
+    assert merge.incomplete_replicas(str(tmp_path),'s','ins',1,4,runs) == {2: 'FAILED (exit 1)', 4: 'not submitted'}
+    # set not started, or merged
+    assert merge.incomplete_replicas(str(tmp_path),'s','des',1,4,{}) == {}
+    assert not merge.merge_replicas(str(tmp_path),'s','ins',1,4)
+    make_acc(str(tmp_path / 'acc_s_ins1'),make_hist(20,0.0,2.0,100))
+    assert merge.incomplete_replicas(str(tmp_path),'s','ins',1,4,runs) == {}
@@ -0,0 +1,33 @@
+import os
+import json
+import math
+import argparse
+import H4Dtools_pilot as pilot
+
+
+def write_pilot(mol_dir,mol,make_acc,make_hist,index=1,cpu=10.0):
+    os.makedirs(mol_dir)
+    make_acc(os.path.join(mol_dir,'acc_{}_ins{}'.format(mol,index)),make_hist(40,1.0,2.0,500))
+    make_acc(os.path.join(mol_dir,'acc_{}_des{}'.format(mol,index)),make_hist(40,-1.0,2.0,500))
+    for stage in ['ins','des']:
+        with open(os.path.join(mol_dir,'metrics-{}-{}.json'.format(stage,index)),'w') as f:
+            json.dump(dict(cpu_user=cpu, cpu_sys=0.5), f)
+
+
+def test_results(tmp_path,make_acc,make_hist):
+    camps = []
+    for k,v in enumerate([1.0, 2.0]):
+        camp_dir = str(tmp_path / 'v{}'.format(k))
+        write_pilot(os.path.join(camp_dir,'a'),'a',make_acc,make_hist,cpu=10.0*(k+1))
+        camps.append((camp_dir,argparse.Namespace(v=v, dt=0.1, wmax=4.0),{}))
+    # solute without pilot files
+    rows = pilot.results(camps,['a','b'])
+    assert len(rows) == 4
+    a = [row for row in rows if row['solute'] == 'a']
+    for row in a:
+        assert math.isfinite(row['err']) and row['err'] > 0
+        assert math.isclose(row['cost'],row['err']**2 * row['cpu'])
+    assert [row['cpu'] for row in a] == [21.0, 41.0]
+    assert all(math.isnan(row['cost']) for row in rows if row['solute'] == 'b')
+    tuned = pilot.best(rows)
+    assert list(tuned) == ['a'] and tuned['a']['v'] == 1.0
@@ -0,0 +1,19 @@
+import os
+import sys
+import subprocess
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('script,options', [('Energy/2-production.py',[]),
+                                            ('Energy/2-production.py',['-dag','2']),
+                                            ('Structure/2-production-structure.py',[])])
+def test_no_index(tmp_path,script,options):
+    camp_dir = str(tmp_path)
+    os.makedirs(os.path.join(camp_dir,'x'))
+    with open(os.path.join(camp_dir,'s.csv'),'w') as f:
+        f.write('Name\tV0\tmu0\nx\t100.0\t0.0\n')
+    proc = subprocess.run([sys.executable,os.path.join(REPO_DIR,script),'-s','s.csv','-j','local'] + options,cwd=camp_dir,
+                          env=dict(os.environ, PYTHONPATH=REPO_DIR),stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+    assert proc.returncode == 1 and 'No staring index' in proc.stdout
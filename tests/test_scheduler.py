@@ -0,0 +1,39 @@
+import os
+import H4Dtools_scheduler as scheduler
+
+
+def test_local_ids(tmp_path,monkeypatch):
+    # environment file of the job scripts written in the current directory
+    monkeypatch.chdir(tmp_path)
+    job = tmp_path / 'job'
+    job.write_text('echo $SLURM_ARRAY_TASK_ID\n')
+    ids = []
+    for run in range(2):
+        sched = scheduler.LocalScheduler(ncores=2)
+        ids += [sched.submit('job',str(tmp_path)), sched.submit('job',str(tmp_path),array=(2,0))]
+        sched.wait()
+        assert set(sched.status(ids[-2:]).values()) == {scheduler.COMPLETED}
+    # each script run gets new ids : outputs of earlier runs are kept
+    assert len(set(ids)) == 4 and not any('_' in j for j in ids)
+    assert len([f for f in os.listdir(str(tmp_path)) if f.startswith('local-')]) == 6
+
+
+def test_slurm_array_tasks(monkeypatch):
+    sacct = '123_1|COMPLETED\n123_2|FAILED\n123_[3-4%1]|PENDING\n124|RUNNING\n'
+    monkeypatch.setattr(scheduler,'_run',lambda cmd,cwd=None: sacct)
+    states = scheduler.SlurmScheduler().status(['123','124','125'])
+    assert states['123_1'] == scheduler.COMPLETED and states['123_2'] == scheduler.FAILED
+    # tasks without their own row : state of the array
+    assert states['123'] == scheduler.PENDING and '123_3' not in states
+    assert states['124'] == scheduler.RUNNING and states['125'] == scheduler.UNKNOWN
+
+
+def test_local_array_tasks(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'job').write_text('exit $(( SLURM_ARRAY_TASK_ID == 2 ))\n')
+    sched = scheduler.LocalScheduler(ncores=2)
+    job_id = sched.submit('job',str(tmp_path),array=(3,0))
+    sched.wait()
+    states = sched.status([job_id])
+    assert states[job_id] == scheduler.FAILED
+    assert [states['{}_{}'.format(job_id,t)] for t in [1,2,3]] == [scheduler.COMPLETED, scheduler.FAILED, scheduler.COMPLETED]
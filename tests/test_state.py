@@ -0,0 +1,25 @@
+import H4Dtools_state as state
+import H4Dtools_scheduler as scheduler
+
+
+class FakeScheduler(scheduler.Scheduler):
+
+    def __init__(self,states):
+        self.states = states
+        self.asked = []
+
+    def status(self,job_ids):
+        self.asked.append(list(job_ids))
+        return {j: s for j,s in self.states.items() if j.split('_')[0] in job_ids}
+
+
+def test_update_array_tasks(tmp_path):
+    db = state.connect(str(tmp_path))
+    for task,mol in enumerate(['a','b','c'],start=1):
+        state.record_job(db,mol,'ins',1,'123_{}'.format(task))
+    sched = FakeScheduler({'123_1': 'COMPLETED', '123_2': 'FAILED', '123': 'PENDING'})
+    state.update_jobs(db,sched)
+    assert sched.asked == [['123']]
+    runs = {mol: state.runs(db,mol,1)['ins'][0] for mol in ['a','b','c']}
+    assert runs == dict(a='COMPLETED', b='FAILED', c='PENDING')
+    assert not state.queued(db,'b') and state.queued(db,'c')